@@ -1,9 +1,12 @@
 import sys
 import argparse
+import multiprocessing
 from . import commands, VERSION
 
 
 def main():
+    # in a frozen binary, a spawned worker process runs the worker and exits here
+    multiprocessing.freeze_support()
     advanced = "--advanced" in sys.argv
     version = "--version" in sys.argv
     full_help = "--full_help" in sys.argv
@@ -68,6 +68,20 @@ class Command:
             default=False,
             required=False,
         )
+        parser.add_argument(
+            "--workers",
+            help="Number of workers used to read the image EXIF, or the GPS data of the videos, in parallel. Default is to read the images one by one, and the videos with a process per CPU.",
+            type=int,
+            default=None,
+            required=False,
+        )
+        parser.add_argument(
+            "--worker_type",
+            help="Use threads (suited for images on network storage) or processes (suited for images on local disks) as workers.",
+            choices=["thread", "process"],
+            default="thread",
+            required=False,
+        )
 
     def run(self, args):
         vars_args = vars(args)
@@ -207,6 +207,20 @@ class Command:
             default=False,
             required=False,
         )
+        parser.add_argument(
+            "--workers",
+            help="Number of workers used to read the image EXIF, or the GPS data of the videos, in parallel. Default is to read the images one by one, and the videos with a process per CPU.",
+            type=int,
+            default=None,
+            required=False,
+        )
+        parser.add_argument(
+            "--worker_type",
+            help="Use threads (suited for images on network storage) or processes (suited for images on local disks) as workers.",
+            choices=["thread", "process"],
+            default="thread",
+            required=False,
+        )
 
         # sequence
         parser.add_argument(
@@ -267,7 +281,7 @@ class Command:
         )
         parser.add_argument(
             "--number_threads",
-            help="Specify the number of upload threads.",
+            help="Specify the number of sequences uploaded concurrently. By default it is probed from the upload throughput.",
             type=int,
             default=None,
             required=False,
@@ -279,6 +293,40 @@ class Command:
             default=None,
             required=False,
         )
+        parser.add_argument(
+            "--zip_compression",
+            help="Compression of the images in the uploaded zip archives: stored (uncompressed), deflate, or auto to deflate only if it saves space on the first images. Default is auto.",
+            choices=["stored", "deflate", "auto"],
+            default="auto",
+            required=False,
+        )
+        parser.add_argument(
+            "--read_ahead_chunks",
+            help="Number of chunks of a sequence read ahead, in a background thread, while a chunk is uploaded. The chunks are still uploaded one after another. The default 0 reads each chunk before uploading it.",
+            type=int,
+            default=0,
+            required=False,
+        )
+        parser.add_argument(
+            "--max_upload_rate",
+            help='Limit the total upload rate in bytes per second, e.g. 512K or 2M. A comma separated time of day schedule is accepted too, e.g. "08:00-18:00=512K,2M" limits to 512K during the window and 2M otherwise. Default is unlimited.',
+            default=None,
+            required=False,
+        )
+        parser.add_argument(
+            "--optimize_jpeg",
+            help="Upload copies of the images with optimized Huffman tables, which are smaller without any quality loss. Requires jpegtran.",
+            action="store_true",
+            default=False,
+            required=False,
+        )
+        parser.add_argument(
+            "--upload_engine",
+            help='Engine that uploads the sequences: "threads" uploads them in a pool of threads, "async" on an event loop, which scales to hundreds of concurrent sequences and requires httpx. With "async", --number_threads is the number of concurrent sequences, and --read_ahead_chunks is not used. Default is "threads".',
+            choices=["threads", "async"],
+            default="threads",
+            required=False,
+        )
         parser.add_argument(
             "--overwrite_all_EXIF_tags",
             help="Overwrite the rest of the EXIF tags, whose values are changed during the processing. Default is False, which will result in the processed values to be inserted only in the EXIF Image Description tag.",
@@ -0,0 +1,155 @@
+import datetime
+import os
+import time
+import typing as T
+
+from .exif_read import ExifRead
+from .process_state import get_process_state, register_cache_data
+
+"""
+Cache of the fields extracted from the image EXIF, stored in the process state of
+each image next to the data of the process stages. An entry is valid as long as
+the image has the same size and modification time as when it was read, so the
+EXIF of an image is parsed once per content version across commands and runs.
+"""
+
+
+EXIF_CACHE_ENABLED = os.getenv("MAPILLARY_TOOLS_EXIF_CACHE", "YES") == "YES"
+EXIF_CACHE_DATA_NAME = register_cache_data("exif_cache")
+# bump it when the extracted fields change to invalidate the existing entries
+EXIF_CACHE_VERSION = 1
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# files modified within it are not cached: the mtime resolution of the file system
+# may not tell apart a later same-size edit, such as an in-place EXIF rewrite
+RACY_MTIME_WINDOW_NS = int(2e9)
+
+
+def _format_datetime(dt: T.Optional[datetime.datetime]) -> T.Optional[str]:
+    if dt is None:
+        return None
+    return dt.strftime(DATETIME_FORMAT)
+
+
+def _parse_datetime(value: T.Optional[str]) -> T.Optional[datetime.datetime]:
+    if value is None:
+        return None
+    return datetime.datetime.strptime(value, DATETIME_FORMAT)
+
+
+_EXTRACTORS: T.Dict[str, T.Callable[[ExifRead], T.Any]] = {
+    "altitude": lambda exif: exif.extract_altitude(),
+    "capture_time": lambda exif: _format_datetime(exif.extract_capture_time()),
+    "direction": lambda exif: exif.extract_direction(),
+    "gps_time": lambda exif: _format_datetime(exif.extract_gps_time()),
+    "image_description": lambda exif: exif.extract_image_description(),
+    "image_history": lambda exif: exif.extract_image_history(),
+    "image_size": lambda exif: list(exif.extract_image_size()),
+    "lon_lat": lambda exif: list(exif.extract_lon_lat()),
+    "make": lambda exif: exif.extract_make(),
+    "model": lambda exif: exif.extract_model(),
+    "orientation": lambda exif: exif.extract_orientation(),
+    "subsec": lambda exif: exif.extract_subsec(),
+}
+
+
+def extract_exif_fields(exif: ExifRead) -> T.Dict[str, T.Any]:
+    """
+    Extract the JSON serializable fields from the EXIF. The fields that fail to be
+    extracted are left out, and raise again when read from the cache.
+    """
+    fields = {}
+    for name, extract in _EXTRACTORS.items():
+        try:
+            fields[name] = extract(exif)
+        except Exception:
+            pass
+    return fields
+
+
+class CachedExifRead(ExifRead):
+    """
+    ExifRead backed by the cached fields instead of the EXIF tags
+    """
+
+    def __init__(self, filename: str, fields: T.Dict[str, T.Any]) -> None:
+        self.filename = filename
+        self.fields = fields
+
+    def _field(self, name: str) -> T.Any:
+        if name not in self.fields:
+            raise ValueError(f"EXIF field {name} could not be extracted")
+        return self.fields[name]
+
+    def extract_image_history(self) -> str:
+        return self._field("image_history")
+
+    def extract_altitude(self) -> float:
+        return self._field("altitude")
+
+    def extract_capture_time(self) -> T.Optional[datetime.datetime]:
+        return _parse_datetime(self._field("capture_time"))
+
+    def extract_direction(self) -> float:
+        return self._field("direction")
+
+    def extract_gps_time(self) -> T.Optional[datetime.datetime]:
+        return _parse_datetime(self._field("gps_time"))
+
+    def extract_image_size(self):
+        width, height = self._field("image_size")
+        return width, height
+
+    def extract_image_description(self) -> T.Optional[str]:
+        return self._field("image_description")
+
+    def extract_lon_lat(self) -> T.Tuple[T.Optional[float], T.Optional[float]]:
+        lon, lat = self._field("lon_lat")
+        return lon, lat
+
+    def extract_make(self) -> str:
+        return self._field("make")
+
+    def extract_model(self) -> str:
+        return self._field("model")
+
+    def extract_orientation(self) -> int:
+        return self._field("orientation")
+
+    def extract_subsec(self) -> str:
+        return self._field("subsec")
+
+
+def read_exif(image: str) -> ExifRead:
+    """
+    Return the EXIF fields of the image from the cache if the image has not changed
+    since it was cached, otherwise read them from the image and cache them.
+    Raise like ExifRead if the image can not be read.
+    """
+    if not EXIF_CACHE_ENABLED:
+        return ExifRead(image)
+
+    stat = os.stat(image)
+    state = get_process_state()
+    entry = state.load_data(image, EXIF_CACHE_DATA_NAME)
+    if (
+        entry.get("version") == EXIF_CACHE_VERSION
+        and entry.get("size") == stat.st_size
+        and entry.get("mtime_ns") == stat.st_mtime_ns
+        and isinstance(entry.get("fields"), dict)
+    ):
+        return CachedExifRead(image, entry["fields"])
+
+    fields = extract_exif_fields(ExifRead(image))
+    if int(time.time() * 1e9) - stat.st_mtime_ns < RACY_MTIME_WINDOW_NS:
+        return CachedExifRead(image, fields)
+    state.save_data(
+        image,
+        EXIF_CACHE_DATA_NAME,
+        {
+            "version": EXIF_CACHE_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "fields": fields,
+        },
+    )
+    return CachedExifRead(image, fields)
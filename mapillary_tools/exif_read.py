@@ -1,17 +1,24 @@
-from typing import List, Optional, Tuple, Type, Union, Any
+from typing import BinaryIO, Dict, List, Optional, Tuple, Type, Union, Any
 import datetime
 import json
 import os
 import logging
+import struct
 
 import exifread
 
 from .geo import normalize_bearing
+from exifread.tags import EXIF_TAGS, FIELD_TYPES, GPS_TAGS, IGNORE_TAGS
 from exifread.utils import Ratio
 
 
 LOG = logging.getLogger()
 
+# how much of the file is read at first when looking for the EXIF segment
+EXIF_HEADER_READ_SIZE = 64 * 1024
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+
 
 def eval_frac(value: Ratio) -> float:
     if value.den == 0:
@@ -75,6 +82,168 @@ def exif_gps_date_fields() -> List[List[str]]:
     return [["GPS GPSDate", "EXIF GPS GPSDate"]]
 
 
+class ExifTag:
+    """
+    A parsed EXIF tag value, compatible with the values of exifread's IfdTag
+    """
+
+    __slots__ = ("tag", "field_type", "values")
+
+    def __init__(self, tag: int, field_type: int, values: Any) -> None:
+        self.tag = tag
+        self.field_type = field_type
+        self.values = values
+
+    def __repr__(self) -> str:
+        return f"ExifTag(0x{self.tag:04X}, {self.values!r})"
+
+
+def read_exif_segment(
+    fp: BinaryIO, initial_size: int = EXIF_HEADER_READ_SIZE
+) -> Optional[bytes]:
+    """
+    Return the TIFF data of the EXIF APP1 segment of a JPEG file. Only the segments
+    before it are read, starting with initial_size bytes and reading more if the
+    segments are larger. Return None if the file is not a JPEG or has no EXIF
+    segment before the image data.
+    """
+    buf = fp.read(initial_size)
+
+    def _ensure(size: int) -> bool:
+        nonlocal buf
+        while len(buf) < size:
+            more = fp.read(max(size - len(buf), len(buf)))
+            if not more:
+                return False
+            buf += more
+        return True
+
+    if buf[:2] != b"\xff\xd8":
+        return None
+
+    offset = 2
+    while _ensure(offset + 4):
+        if buf[offset] != 0xFF:
+            return None
+        marker = buf[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        # start of scan or end of image: no more metadata segments
+        if marker in (0xDA, 0xD9):
+            return None
+        (length,) = struct.unpack_from(">H", buf, offset + 2)
+        segment_start = offset + 4
+        segment_end = offset + 2 + length
+        if marker == 0xE1:
+            if not _ensure(segment_start + 6):
+                return None
+            if buf[segment_start : segment_start + 6] == b"Exif\x00\x00":
+                if not _ensure(segment_end):
+                    return None
+                return buf[segment_start + 6 : segment_end]
+        offset = segment_end
+    return None
+
+
+def _decode_tag_values(
+    tiff: bytes, endian: str, field_type: int, count: int, offset: int
+) -> Any:
+    type_length = FIELD_TYPES[field_type][0]
+    if field_type == 2:
+        # null-terminated ASCII string
+        if count == 0:
+            return None
+        values: Any = tiff[offset : offset + count].split(b"\x00", 1)[0]
+        try:
+            return values.decode("utf-8")
+        except UnicodeDecodeError:
+            return values
+
+    # same as exifread, skip the values of large arrays
+    if count >= 1000:
+        return []
+
+    signed = field_type in (6, 8, 9, 10)
+    if field_type in (5, 10):
+        fmt = "l" if signed else "L"
+        nums = struct.unpack_from(f"{endian}{count * 2}{fmt}", tiff, offset)
+        return [Ratio(nums[i], nums[i + 1]) for i in range(0, len(nums), 2)]
+    fmt = {1: "B", 2: "H", 4: "L"}[type_length]
+    if signed:
+        fmt = fmt.lower()
+    return list(struct.unpack_from(f"{endian}{count}{fmt}", tiff, offset))
+
+
+def parse_exif_tags(tiff: bytes) -> Dict[str, ExifTag]:
+    """
+    Parse the image (IFD0), EXIF and GPS directories of the TIFF data into tags
+    named as exifread does, e.g. "EXIF DateTimeOriginal". MakerNote, user comment
+    and the thumbnail directory are skipped.
+    """
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ValueError("Invalid TIFF header in EXIF")
+
+    (ifd0_offset,) = struct.unpack_from(f"{endian}L", tiff, 4)
+    tags: Dict[str, ExifTag] = {}
+    pending: List[Tuple[str, int, Dict]] = [("Image", ifd0_offset, EXIF_TAGS)]
+    visited = set()
+
+    while pending:
+        ifd_name, ifd_offset, tag_dict = pending.pop(0)
+        if ifd_offset in visited or ifd_offset + 2 > len(tiff):
+            continue
+        visited.add(ifd_offset)
+        (entries,) = struct.unpack_from(f"{endian}H", tiff, ifd_offset)
+        for idx in range(entries):
+            entry = ifd_offset + 2 + 12 * idx
+            if entry + 12 > len(tiff):
+                break
+            tag, field_type, count = struct.unpack_from(f"{endian}HHL", tiff, entry)
+            if tag in IGNORE_TAGS or not 0 < field_type < len(FIELD_TYPES):
+                continue
+            offset = entry + 8
+            if count * FIELD_TYPES[field_type][0] > 4:
+                (offset,) = struct.unpack_from(f"{endian}L", tiff, offset)
+            if offset + count * FIELD_TYPES[field_type][0] > len(tiff):
+                continue
+            values = _decode_tag_values(tiff, endian, field_type, count, offset)
+
+            tag_entry = tag_dict.get(tag)
+            tag_name = tag_entry[0] if tag_entry else f"Tag 0x{tag:04X}"
+            tags[f"{ifd_name} {tag_name}"] = ExifTag(tag, field_type, values)
+
+            if values and isinstance(values, list):
+                if tag == EXIF_IFD_POINTER and ifd_name == "Image":
+                    pending.append(("EXIF", values[0], EXIF_TAGS))
+                elif tag == GPS_IFD_POINTER:
+                    pending.append(("GPS", values[0], GPS_TAGS))
+
+    return tags
+
+
+def read_exif_tags(fp: BinaryIO, details: bool = False) -> Dict[str, Any]:
+    """
+    Read the EXIF tags from the header of the image only, falling back to exifread
+    for details, non-JPEG images, or EXIF that can not be parsed
+    """
+    if not details:
+        start = fp.tell()
+        try:
+            tiff = read_exif_segment(fp)
+            if tiff is not None:
+                return parse_exif_tags(tiff)
+        except (ValueError, struct.error):
+            LOG.debug("Failed to parse the EXIF header, fall back to exifread")
+        fp.seek(start)
+    return exifread.process_file(fp, details=details)
+
+
 class ExifRead:
     """
     EXIF class for reading exif from an image
@@ -87,9 +256,9 @@ class ExifRead:
         self.filename = filename
         if isinstance(filename, str):
             with open(filename, "rb") as fp:
-                self.tags = exifread.process_file(fp, details=details)
+                self.tags = read_exif_tags(fp, details=details)
         else:
-            self.tags = exifread.process_file(filename, details=details)
+            self.tags = read_exif_tags(filename, details=details)
 
     def _extract_alternative_fields(
         self,
@@ -338,3 +507,26 @@ class ExifRead:
                 if not val.strip():
                     return False
         return True
+
+
+if __name__ == "__main__":
+    import sys
+    import timeit
+
+    # benchmark the header-only reader against exifread
+    # usage: python -m mapillary_tools.exif_read IMAGE [IMAGE ...]
+    def _read_with_exifread(path: str) -> None:
+        with open(path, "rb") as fp:
+            exifread.process_file(fp, details=False)
+
+    for path in sys.argv[1:]:
+        size = os.path.getsize(path)
+        fast = min(timeit.repeat(lambda: ExifRead(path), number=10, repeat=3)) / 10
+        slow = (
+            min(timeit.repeat(lambda: _read_with_exifread(path), number=10, repeat=3))
+            / 10
+        )
+        print(
+            f"{path} ({size / 1024 / 1024:.1f} MB): header reader {fast * 1000:.2f} ms, "
+            f"exifread {slow * 1000:.2f} ms ({slow / fast:.1f}x)"
+        )
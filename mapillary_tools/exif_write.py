@@ -1,10 +1,113 @@
 import json
+import os
+import shutil
+import struct
+import tempfile
+import typing as T
 
 import piexif
 
 from .error import print_error
 from .geo import decimal_to_dms
 
+JPEG_SOI = b"\xff\xd8"
+JPEG_SOS = b"\xff\xda"
+JPEG_APP0 = b"\xff\xe0"
+JPEG_APP1 = b"\xff\xe1"
+EXIF_HEADER = b"Exif\x00\x00"
+# the EXIF segment is padded to a multiple of it when the file is rewritten,
+# leaving room for later edits to be written in place
+EXIF_SEGMENT_ALIGNMENT = 1024
+MAX_SEGMENT_LENGTH = 0xFFFF
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _read_segment_header(fp: T.BinaryIO, offset: int) -> T.Tuple[bytes, int]:
+    """
+    Return the first bytes of the JPEG segment at the offset, and where it ends
+    (-1 for the image data that follows SOS)
+    """
+    fp.seek(offset)
+    header = fp.read(10)
+    if len(header) < 4 or header[0:1] != b"\xff":
+        raise piexif.InvalidImageDataError("Wrong JPEG data.")
+    if header[:2] == JPEG_SOS:
+        return header, -1
+    (length,) = struct.unpack(">H", header[2:4])
+    return header, offset + 2 + length
+
+
+def _is_exif_segment(header: bytes) -> bool:
+    return header[:2] == JPEG_APP1 and header[4:10] == EXIF_HEADER
+
+
+def exif_segment_range(fp: T.BinaryIO) -> T.Tuple[int, int]:
+    """
+    Locate where piexif.insert puts the EXIF segment in a JPEG file. Return where
+    the bytes replaced by the new segment after SOI end, and the offset of the
+    existing EXIF segment in them (-1 if there is none).
+    """
+    fp.seek(0)
+    if fp.read(2) != JPEG_SOI:
+        raise piexif.InvalidImageDataError("Given data isn't JPEG.")
+    first, first_end = _read_segment_header(fp, 2)
+    if first[:2] == JPEG_APP0:
+        second, second_end = _read_segment_header(fp, first_end)
+        # like piexif, drop the APP0 segment followed by the EXIF segment
+        if _is_exif_segment(second):
+            return second_end, first_end
+        # and replace the APP0 segment otherwise
+        return first_end, -1
+    if _is_exif_segment(first):
+        return first_end, 2
+    return 2, -1
+
+
+def _exif_segment(exif_bytes: bytes, size: int) -> bytes:
+    """
+    Build the APP1 segment of the EXIF bytes, padded with zeros to the size
+    """
+    padding = b"\x00" * (size - len(exif_bytes) - 4)
+    return JPEG_APP1 + struct.pack(">H", size - 2) + exif_bytes + padding
+
+
+def _aligned_segment_size(exif_bytes: bytes) -> int:
+    size = len(exif_bytes) + 4
+    aligned = -(-size // EXIF_SEGMENT_ALIGNMENT) * EXIF_SEGMENT_ALIGNMENT
+    return max(size, min(aligned, MAX_SEGMENT_LENGTH + 2))
+
+
+def _copy_file_range(src: T.BinaryIO, dst: T.BinaryIO, offset: int) -> None:
+    """
+    Copy the source file from the offset to its end into the destination file,
+    in the kernel where possible
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    remaining = os.fstat(src_fd).st_size - offset
+    dst.flush()
+    for copy in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, copy):
+            continue
+        try:
+            while remaining > 0:
+                if copy == "copy_file_range":
+                    copied = os.copy_file_range(  # type: ignore
+                        src_fd, dst_fd, remaining, offset
+                    )
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, remaining)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+            return
+        except OSError:
+            # not supported between the files, fall back to the next method
+            continue
+    src.seek(offset)
+    dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
 
 class ExifEdit:
     _filename: str
@@ -90,6 +193,56 @@ class ExifEdit:
                 raise
 
         with open(self._filename, "rb") as fp:
-            img = fp.read()
-
-        piexif.insert(exif_bytes, img, filename)
+            try:
+                end, exif_start = exif_segment_range(fp)
+            except piexif.InvalidImageDataError:
+                # not a JPEG, let piexif handle it (e.g. WebP) or raise
+                fp.seek(0)
+                piexif.insert(exif_bytes, fp.read(), filename)
+                return
+
+            in_place = exif_start >= 0 and os.path.abspath(filename) == os.path.abspath(
+                self._filename
+            )
+            if in_place and len(exif_bytes) + 4 <= end - exif_start:
+                fp.close()
+                self._write_in_place(
+                    _exif_segment(exif_bytes, end - exif_start), exif_start
+                )
+                return
+
+            segment = _exif_segment(exif_bytes, _aligned_segment_size(exif_bytes))
+            self._write_copy(fp, filename, JPEG_SOI + segment, end)
+
+    def _write_in_place(self, segment: bytes, offset: int) -> None:
+        """
+        Overwrite the EXIF segment of the same size in the file
+        """
+        with open(self._filename, "r+b") as fp:
+            if hasattr(os, "pwrite"):
+                os.pwrite(fp.fileno(), segment, offset)
+            else:
+                fp.seek(offset)
+                fp.write(segment)
+
+    def _write_copy(
+        self, fp: T.BinaryIO, filename: str, head: bytes, offset: int
+    ) -> None:
+        """
+        Write the head followed by the source file from the offset to a temporary
+        file next to the target, and rename it to the target
+        """
+        dirname = os.path.dirname(os.path.abspath(filename))
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=dirname, prefix=f".{os.path.basename(filename)}.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(tmp_fd, "wb") as tmp_fp:
+                tmp_fp.write(head)
+                _copy_file_range(fp, tmp_fp, offset)
+            shutil.copymode(self._filename, tmp_path)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import datetime
 import math
 import logging
 
 import pytz
-from typing import Any, List, Tuple
+from typing import Any, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, the array variants fall back to the scalar functions without it
+    np = None  # type: ignore
 
 WGS84_a = 6378137.0
 WGS84_b = 6356752.314245
@@ -21,8 +28,8 @@ def ecef_from_lla(lat: float, lon: float, alt: float) -> Tuple[float, float, flo
     Check results here http://www.oc.nps.edu/oc2902w/coord/llhxyz.htm
 
     """
-    a2 = WGS84_a ** 2
-    b2 = WGS84_b ** 2
+    a2 = WGS84_a**2
+    b2 = WGS84_b**2
     lat = math.radians(lat)
     lon = math.radians(lon)
     L = 1.0 / math.sqrt(a2 * math.cos(lat) ** 2 + b2 * math.sin(lat) ** 2)
@@ -49,6 +56,47 @@ def gps_distance(latlon_1: Tuple[float, float], latlon_2: Tuple[float, float]) -
     return dis
 
 
+def _ecef_from_lla_array(lats, lons):
+    """
+    Array variant of ecef_from_lla at altitude 0 (requires NumPy)
+    """
+    a2 = WGS84_a**2
+    b2 = WGS84_b**2
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    cos_lats = np.cos(lats)
+    sin_lats = np.sin(lats)
+    L = 1.0 / np.sqrt(a2 * cos_lats**2 + b2 * sin_lats**2)
+    x = a2 * L * cos_lats * np.cos(lons)
+    y = a2 * L * cos_lats * np.sin(lons)
+    z = b2 * L * sin_lats
+    return x, y, z
+
+
+def gps_distance_array(
+    lats_1: Sequence[float],
+    lons_1: Sequence[float],
+    lats_2: Sequence[float],
+    lons_2: Sequence[float],
+) -> List[float]:
+    """
+    Distances between the (lat, lon) pairs of the arrays, element-wise.
+
+    >>> d = gps_distance_array([42.1, 42.1], [-11.1, -11.1], [42.2, 42.1], [-11.3, -11.1])
+    >>> 19000 < d[0] < 20000 and d[1] == 0
+    True
+    """
+    if np is None:
+        return [
+            gps_distance((lat_1, lon_1), (lat_2, lon_2))
+            for lat_1, lon_1, lat_2, lon_2 in zip(lats_1, lons_1, lats_2, lons_2)
+        ]
+    x1, y1, z1 = _ecef_from_lla_array(lats_1, lons_1)
+    x2, y2, z2 = _ecef_from_lla_array(lats_2, lons_2)
+    dis = np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2 + (z1 - z2) ** 2)
+    return dis.tolist()
+
+
 def get_max_distance_from_start(latlon_track):
     """
     Returns the radius of an entire GPS track. Used to calculate whether or not the entire sequence was just stationary video
@@ -162,6 +210,44 @@ def compute_bearing(start_lat, start_lon, end_lat, end_lon) -> float:
     return bearing
 
 
+def compute_bearing_array(
+    start_lats: Sequence[float],
+    start_lons: Sequence[float],
+    end_lats: Sequence[float],
+    end_lons: Sequence[float],
+) -> List[float]:
+    """
+    Compass bearings from the start points to the end points of the arrays,
+    element-wise.
+    """
+    if np is None:
+        return [
+            compute_bearing(start_lat, start_lon, end_lat, end_lon)
+            for start_lat, start_lon, end_lat, end_lon in zip(
+                start_lats, start_lons, end_lats, end_lons
+            )
+        ]
+    start_lat = np.radians(np.asarray(start_lats, dtype=float))
+    start_lon = np.radians(np.asarray(start_lons, dtype=float))
+    end_lat = np.radians(np.asarray(end_lats, dtype=float))
+    end_lon = np.radians(np.asarray(end_lons, dtype=float))
+
+    dLong = end_lon - start_lon
+    dLong = np.where(
+        np.abs(dLong) > math.pi,
+        np.where(dLong > 0.0, -(2.0 * math.pi - dLong), 2.0 * math.pi + dLong),
+        dLong,
+    )
+
+    y = np.sin(dLong) * np.cos(end_lat)
+    x = np.cos(start_lat) * np.sin(end_lat) - np.sin(start_lat) * np.cos(
+        end_lat
+    ) * np.cos(dLong)
+    bearing = (np.degrees(np.arctan2(y, x)) + 360.0) % 360.0
+
+    return bearing.tolist()
+
+
 def diff_bearing(b1, b2):
     """
     Compute difference between two bearings
@@ -197,61 +283,11 @@ class MapillaryInterpolationError(RuntimeError):
     pass
 
 
-def interpolate_lat_lon(points: list, t: datetime.datetime, tolerant=10):
-    """
-    Return interpolated lat, lon and compass bearing for time t.
-
-    Points is a list of tuples (time, lat, lon, elevation), t a datetime object.
-    """
-    if tolerant < 0:
-        raise ValueError(f"tolerant must be non-negative in seconds but got {tolerant}")
-
-    min_time: datetime.datetime = points[0][0]
-    max_time: datetime.datetime = points[-1][0]
-
-    if min_time > max_time:
-        raise ValueError(
-            f"Expect trace's start time {min_time} <= trace's end time {max_time}"
-        )
-
-    max_dt = datetime.timedelta(seconds=tolerant)
-
-    if min_time < t < max_time:
-        for i, point in enumerate(points):
-            if t < point[0]:
-                if i > 0:
-                    before = points[i - 1]
-                else:
-                    before = points[i]
-                after = points[i]
-                break
-    else:
-        if t < min_time - max_dt:
-            raise MapillaryInterpolationError(
-                f"Unable to interpolate the point captured at {t} because it is behind the trace start time {min_time} by {(min_time - t).total_seconds()} seconds",
-            )
-
-        if max_time + max_dt < t:
-            raise MapillaryInterpolationError(
-                f"Unable to interpolate the point captured at {t} because it is beyond the trace end time {max_time} by {(t - max_time).total_seconds()} seconds",
-            )
-
-        if t < min_time:
-            before = points[0]
-            after = points[1]
-        else:
-            before = points[-2]
-            after = points[-1]
-        bearing = compute_bearing(before[1], before[2], after[1], after[2])
-
-        if t == min_time:
-            x = points[0]
-            return x[1], x[2], bearing, x[3]
+def _total_microseconds(delta: datetime.timedelta) -> int:
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
 
-        if t == max_time:
-            x = points[-1]
-            return x[1], x[2], bearing, x[3]
 
+def _interpolate_between(before, after, t: datetime.datetime):
     # weight based on time
     weight = (t - before[0]).total_seconds() / (after[0] - before[0]).total_seconds()
 
@@ -278,12 +314,129 @@ def interpolate_lat_lon(points: list, t: datetime.datetime, tolerant=10):
     return lat, lon, bearing, ele
 
 
+class GpsTrace:
+    """
+    GPS trace for interpolating the positions at many times.
+
+    Points is a list of tuples (time, lat, lon, elevation) sorted by time. The point
+    times are converted once to microseconds from the first point, so that a lookup
+    is a binary search instead of a scan over the trace.
+    """
+
+    def __init__(self, points: list, tolerant=10):
+        if tolerant < 0:
+            raise ValueError(
+                f"tolerant must be non-negative in seconds but got {tolerant}"
+            )
+
+        min_time: datetime.datetime = points[0][0]
+        max_time: datetime.datetime = points[-1][0]
+
+        if min_time > max_time:
+            raise ValueError(
+                f"Expect trace's start time {min_time} <= trace's end time {max_time}"
+            )
+
+        self.points = points
+        self.tolerant = tolerant
+        self._offsets = [_total_microseconds(p[0] - min_time) for p in points]
+        # unsorted traces are scanned like before to find the same points
+        self._sorted = all(a <= b for a, b in zip(self._offsets, self._offsets[1:]))
+
+    def _offset(self, t: datetime.datetime) -> int:
+        return _total_microseconds(t - self.points[0][0])
+
+    def _within(self, offset: int) -> bool:
+        return 0 < offset < self._offsets[-1]
+
+    def _interpolate_at(self, t: datetime.datetime, offset: int, index: int):
+        """
+        Interpolate for time t between the point at the index and the point before it,
+        where the index is the first point after t
+        """
+        if not self._sorted:
+            index = next(i for i, o in enumerate(self._offsets) if offset < o)
+        before = self.points[index - 1] if index > 0 else self.points[index]
+        return _interpolate_between(before, self.points[index], t)
+
+    def _interpolate_outside(self, t: datetime.datetime):
+        points = self.points
+        min_time: datetime.datetime = points[0][0]
+        max_time: datetime.datetime = points[-1][0]
+        max_dt = datetime.timedelta(seconds=self.tolerant)
+
+        if t < min_time - max_dt:
+            raise MapillaryInterpolationError(
+                f"Unable to interpolate the point captured at {t} because it is behind the trace start time {min_time} by {(min_time - t).total_seconds()} seconds",
+            )
+
+        if max_time + max_dt < t:
+            raise MapillaryInterpolationError(
+                f"Unable to interpolate the point captured at {t} because it is beyond the trace end time {max_time} by {(t - max_time).total_seconds()} seconds",
+            )
+
+        if t < min_time:
+            before = points[0]
+            after = points[1]
+        else:
+            before = points[-2]
+            after = points[-1]
+
+        if t == min_time or t == max_time:
+            x = points[0] if t == min_time else points[-1]
+            bearing = compute_bearing(before[1], before[2], after[1], after[2])
+            return x[1], x[2], bearing, x[3]
+
+        return _interpolate_between(before, after, t)
+
+    def interpolate(self, t: datetime.datetime):
+        """
+        Return interpolated lat, lon, compass bearing and elevation for time t
+        """
+        offset = self._offset(t)
+        if not self._within(offset):
+            return self._interpolate_outside(t)
+        index = bisect.bisect_right(self._offsets, offset) if self._sorted else -1
+        return self._interpolate_at(t, offset, index)
+
+    def interpolate_many(self, times: List[datetime.datetime]) -> list:
+        """
+        Return the interpolations of the times, in the same order. The times are
+        walked in sorted order along the trace. Raise for the first time, in the
+        given order, that is out of the trace.
+        """
+        offsets = [self._offset(t) for t in times]
+        results: list = [None] * len(times)
+        within = []
+        for idx, (t, offset) in enumerate(zip(times, offsets)):
+            if self._within(offset):
+                within.append(idx)
+            else:
+                results[idx] = self._interpolate_outside(t)
+
+        index = 0
+        for idx in sorted(within, key=offsets.__getitem__):
+            if self._sorted:
+                while self._offsets[index] <= offsets[idx]:
+                    index += 1
+            results[idx] = self._interpolate_at(times[idx], offsets[idx], index)
+
+        return results
+
+
+def interpolate_lat_lon(points: list, t: datetime.datetime, tolerant=10):
+    """
+    Return interpolated lat, lon and compass bearing for time t.
+
+    Points is a list of tuples (time, lat, lon, elevation), t a datetime object.
+    Use GpsTrace to interpolate many times in the same trace.
+    """
+    return GpsTrace(points, tolerant).interpolate(t)
+
+
 def write_gpx(filename, gps_trace):
     time_format = "%Y-%m-%dT%H:%M:%S.%f"
-    gpx = "<gpx>" + "\n"
-    gpx += "<trk>" + "\n"
-    gpx += "<name>Mapillary GPX</name>" + "\n"
-    gpx += "<trkseg>" + "\n"
+    lines = ["<gpx>", "<trk>", "<name>Mapillary GPX</name>", "<trkseg>"]
     for point in gps_trace:
         lat = point[1]
         lon = point[2]
@@ -291,15 +444,13 @@ def write_gpx(filename, gps_trace):
             continue
         time = datetime.datetime.strftime(point[0], time_format)[:-3]
         elevation = point[3] if len(point) > 3 else 0
-        gpx += '<trkpt lat="' + str(lat) + '" lon="' + str(lon) + '">' + "\n"
-        gpx += "<ele>" + str(elevation) + "</ele>" + "\n"
-        gpx += "<time>" + time + "</time>" + "\n"
-        gpx += "</trkpt>" + "\n"
-    gpx += "</trkseg>" + "\n"
-    gpx += "</trk>" + "\n"
-    gpx += "</gpx>" + "\n"
+        lines.append(f'<trkpt lat="{lat}" lon="{lon}">')
+        lines.append(f"<ele>{elevation}</ele>")
+        lines.append(f"<time>{time}</time>")
+        lines.append("</trkpt>")
+    lines.extend(["</trkseg>", "</trk>", "</gpx>"])
     with open(filename, "w") as fout:
-        fout.write(gpx)
+        fout.write("\n".join(lines) + "\n")
 
 
 def get_timezone_and_utc_offset(lat, lon):
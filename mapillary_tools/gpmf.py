@@ -1,134 +1,285 @@
-import binascii
 import datetime
+import operator
 import struct
+import typing as T
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, the samples are decoded with struct.iter_unpack without it
+    np = None  # type: ignore
 
 # author https://github.com/stilldavid
 
 """
-does the heavy lifting of parsing the GPMF format from a binary file
-"""
-
-
-def parse_gps(toparse: bytes, data: dict, scale):
-    gps = struct.unpack(">lllll", toparse)
-
-    data["gps"].append(
-        {
-            "lat": float(gps[0]) / scale[0],
-            "lon": float(gps[1]) / scale[1],
-            "alt": float(gps[2]) / scale[3],
-            "spd": float(gps[3]) / scale[3],
-            "s3d": float(gps[4]) / scale[4],
-        }
-    )
-
-
-def parse_time(toparse: bytes, data: dict, scale):
-    datetime_object = datetime.datetime.strptime(
-        toparse.decode("utf-8"), "%y%m%d%H%M%S.%f"
-    )
-    data["time"] = datetime_object
-
-
-def parse_accl(toparse: bytes, data: dict, scale):
-    # todo: fusion
-    if 6 == len(toparse):
-        data["accl"] = struct.unpack(">hhh", toparse)
-
-
-def parse_gyro(toparse: bytes, data: dict, scale):
-    # todo: fusion
-    if 6 == len(toparse):
-        data["gyro"] = struct.unpack(">hhh", toparse)
-
-
-def parse_fix(toparse: bytes, data: dict, scale):
-    data["gps_fix"] = struct.unpack(">I", toparse)[0]
-
+does the heavy lifting of parsing the GPMF format
 
-def parse_precision(toparse: bytes, data: dict, scale):
-    data["gps_precision"] = struct.unpack(">H", toparse)[0]
+GPMF is a sequence of KLV entries: a FourCC key, a type, the size of a sample and
+the number of samples, followed by the samples padded to 4 bytes. Entries of type
+0 are containers (DEVC, STRM) whose payload is a sequence of entries, so walking
+the headers one after another visits the nested entries too.
 
+The samples of each GPS5, ACCL and GYRO entry are decoded in one call, into a
+(samples, values) numpy array if numpy is installed, otherwise into a list of
+tuples, and divided by the SCAL of their stream.
 
-"""
-since we only get 1Hz timestamps and ~18Hz GPS, interpolate timestamps
-in between known good times.
-
-Sometimes it's 18Hz, sometimes 19Hz, so peek at the next row and grab their
-timestamp. On the last one, just add 1 second as a best guess, worst case it's
-off by ~50 milliseconds
+A GPMF payload is one sample of the gpmd track of the video, so its start time
+and duration come from the MP4 time table. parse_telemetry spreads the samples
+of each sensor evenly over the duration of their payload, which times them all,
+not only the GPS ones at 1 Hz.
 """
 
 
-def interpolate_times(frame, until):
-    tot = len(frame["gps"])
-    diff = until - frame["time"]
-    offset = diff / tot
+# GPMF type -> struct format of one value
+GPMF_TYPES = {
+    ord("b"): "b",
+    ord("B"): "B",
+    ord("c"): "c",
+    ord("d"): "d",
+    ord("f"): "f",
+    ord("j"): "q",
+    ord("J"): "Q",
+    ord("l"): "i",
+    ord("L"): "I",
+    ord("s"): "h",
+    ord("S"): "H",
+    ord("U"): "c",
+}
+# the number of values of a sample of each sensor stream
+SENSOR_VALUES = {b"GPS5": 5, b"ACCL": 3, b"GYRO": 3}
+
+# a decoded sensor stream: a numpy array with numpy, a list of tuples without it
+Samples = T.Any
+
+
+class GPMFFrame:
+    """
+    The telemetry of a device in one GPMF payload, about one second of recording.
+    gps holds the (lat, lon, alt, 2D speed, 3D speed) samples, accl the (x, y, z)
+    accelerations in m/s², and gyro the (x, y, z) rotation rates in rad/s.
+    """
+
+    def __init__(self) -> None:
+        self.time: T.Optional[datetime.datetime] = None
+        self.gps_fix: T.Optional[int] = None
+        self.gps_precision: T.Optional[int] = None
+        self.gps: Samples = _empty_samples(SENSOR_VALUES[b"GPS5"])
+        self.accl: Samples = _empty_samples(SENSOR_VALUES[b"ACCL"])
+        self.gyro: Samples = _empty_samples(SENSOR_VALUES[b"GYRO"])
+
+
+def _empty_samples(values: int) -> Samples:
+    if np is None:
+        return []
+    return np.empty((0, values))
+
+
+def _empty_times() -> Samples:
+    if np is None:
+        return []
+    return np.empty(0)
+
+
+def _join_samples(parts: T.List[Samples], empty: Samples) -> Samples:
+    if not parts:
+        return empty
+    if np is None:
+        return [sample for part in parts for sample in part]
+    return np.concatenate(parts)
+
+
+def _concat_samples(first: Samples, second: Samples) -> Samples:
+    if not len(first):
+        return second
+    if np is None:
+        return first + second
+    return np.concatenate([first, second])
+
+
+def iter_klv(
+    buf: T.Any, start: int = 0, end: T.Optional[int] = None
+) -> T.Iterator[T.Tuple[bytes, int, int, int, int]]:
+    """
+    Walk the KLV headers of the buffer and yield the key, the type, the sample size,
+    the number of samples and the offset of the samples of each entry
+    """
+    if end is None:
+        end = len(buf)
+    offset = start
+    while offset + 8 <= end:
+        key = bytes(buf[offset : offset + 4])
+        type_, size, repeat = struct.unpack_from(">BBH", buf, offset + 4)
+        offset += 8
+        yield key, type_, size, repeat, offset
+        if type_ == 0:
+            # a container, or a null entry: continue with its nested entries
+            continue
+        length = size * repeat
+        offset += length + (-length % 4)
+
+
+def decode_samples(
+    buf: T.Any, offset: int, type_: int, size: int, repeat: int
+) -> Samples:
+    """
+    Decode the samples of an entry in one call, each sample into a tuple (or an
+    array row) of its values
+    """
+    fmt = GPMF_TYPES.get(type_)
+    if fmt is None:
+        raise ValueError(f"Unsupported GPMF type {chr(type_)}")
+    width = struct.calcsize(fmt)
+    if size % width:
+        raise ValueError(f"GPMF sample size {size} is not a multiple of {width}")
+    count = size // width
+    if np is not None and fmt != "c":
+        return np.frombuffer(
+            buf,
+            dtype=np.dtype(fmt).newbyteorder(">"),
+            count=count * repeat,
+            offset=offset,
+        ).reshape(repeat, count)
+    return list(
+        struct.iter_unpack(">" + fmt * count, buf[offset : offset + size * repeat])
+    )
 
-    for i, row in enumerate(frame["gps"]):
-        toadd = datetime.timedelta(microseconds=(offset.microseconds * i))
-        frame["gps"][i]["time"] = frame["time"] + toadd
 
+def apply_scale(samples: Samples, scale: T.Sequence[float]) -> Samples:
+    """
+    Divide the values of the samples by their SCAL, one divisor per value or one
+    for all
+    """
+    if not scale:
+        scale = [1]
+    if np is not None:
+        return np.asarray(samples, dtype=float) / np.asarray(scale, dtype=float)
+    if len(scale) == 1:
+        scale = [scale[0]] * (len(samples[0]) if samples else 0)
+    return [tuple(map(operator.truediv, sample, scale)) for sample in samples]
+
+
+def _has_samples(frame: GPMFFrame, gps_only: bool) -> bool:
+    if gps_only:
+        return bool(len(frame.gps))
+    return bool(len(frame.gps) or len(frame.accl) or len(frame.gyro))
+
+
+def parse_gpmf(buf: T.Any, gps_only: bool = True) -> T.List[GPMFFrame]:
+    """
+    Parse the GPMF in the buffer (bytes, or a memory map) into frames, one per
+    device payload with GPS samples, or with any sensor samples if not gps_only
+    """
+    output: T.List[GPMFFrame] = []
+    frame = GPMFFrame()
+    # the SCAL of the current stream, applied to the following sensor entries
+    scale: T.List[float] = []
+
+    for key, type_, size, repeat, offset in iter_klv(buf):
+        if type_ == 0:
+            if key == b"STRM":
+                scale = []
+            continue
+
+        if key == b"DVID":
+            if _has_samples(frame, gps_only):  # first one is empty
+                output.append(frame)
+            frame = GPMFFrame()
+        elif key == b"SCAL":
+            scale = [
+                value
+                for sample in decode_samples(buf, offset, type_, size, repeat)
+                for value in sample
+            ]
+        elif key in SENSOR_VALUES:
+            samples = apply_scale(
+                decode_samples(buf, offset, type_, size, repeat), scale
+            )
+            if key == b"GPS5":
+                frame.gps = _concat_samples(frame.gps, samples)
+            elif key == b"ACCL":
+                frame.accl = _concat_samples(frame.accl, samples)
+            else:
+                frame.gyro = _concat_samples(frame.gyro, samples)
+        elif key == b"GPSU":
+            frame.time = datetime.datetime.strptime(
+                bytes(buf[offset : offset + size]).decode("utf-8"), "%y%m%d%H%M%S.%f"
+            )
+        elif key == b"GPSF":
+            (frame.gps_fix,) = struct.unpack_from(">I", buf, offset)
+        elif key == b"GPSP":
+            (frame.gps_precision,) = struct.unpack_from(">H", buf, offset)
+
+    if _has_samples(frame, gps_only):
+        output.append(frame)
 
-def parse_bin(path: str) -> list:
-    # f = open(path, "rb")
+    return output
 
-    s: dict = {}  # the current Scale data to apply to next requester
-    output = []
 
-    # handlers for various fourCC codes
-    methods = {
-        b"GPS5": parse_gps,
-        b"GPSU": parse_time,
-        b"GPSF": parse_fix,
-        b"GPSP": parse_precision,
-        b"ACCL": parse_accl,
-        b"GYRO": parse_gyro,
+class GPMFTelemetry:
+    """
+    All the sensor samples of a recording. gps, accl and gyro are arrays like the
+    ones of GPMFFrame, and gps_times, accl_times and gyro_times the time of each of
+    their samples in seconds from the start of the video. gps_fix is the GPS fix of
+    each GPS sample, and gps_epoch the GPS time at the start of the video, from the
+    first GPSU, or None if there is none.
+    """
+
+    def __init__(self) -> None:
+        self.gps: Samples = _empty_samples(SENSOR_VALUES[b"GPS5"])
+        self.gps_times: Samples = _empty_times()
+        self.gps_fix: T.List[T.Optional[int]] = []
+        self.gps_epoch: T.Optional[datetime.datetime] = None
+        self.accl: Samples = _empty_samples(SENSOR_VALUES[b"ACCL"])
+        self.accl_times: Samples = _empty_times()
+        self.gyro: Samples = _empty_samples(SENSOR_VALUES[b"GYRO"])
+        self.gyro_times: Samples = _empty_times()
+
+    def gps_datetimes(self) -> T.List[datetime.datetime]:
+        """
+        Return the GPS time of each GPS sample
+        """
+        if self.gps_epoch is None:
+            return []
+        epoch = self.gps_epoch
+        return [epoch + datetime.timedelta(seconds=float(t)) for t in self.gps_times]
+
+
+def sample_times(start: float, duration: float, count: int) -> Samples:
+    """
+    Return the times of count samples spread evenly from start over duration
+    """
+    if np is not None:
+        return start + np.arange(count) * (duration / count)
+    return [start + duration * i / count for i in range(count)]
+
+
+def parse_telemetry(
+    payloads: T.Iterable[T.Tuple[float, float, T.Any]],
+) -> GPMFTelemetry:
+    """
+    Parse the GPMF payloads of a recording, each given with its start time and its
+    duration in seconds from the start of the video, into one telemetry
+    """
+    telemetry = GPMFTelemetry()
+    parts: T.Dict[str, T.List[Samples]] = {
+        name: []
+        for name in ["gps", "gps_times", "accl", "accl_times", "gyro", "gyro_times"]
     }
 
-    d: dict = {"gps": []}  # up to date dictionary, iterate and fill then flush
-
-    with open(path, "rb") as f:
-        while True:
-            label: bytes = f.read(4)
-            if not label:  # eof
-                break
-
-            desc: bytes = f.read(4)
-            if not desc:  # eof
-                break
-
-            # null length
-            if b"00" == binascii.hexlify(desc[:1]):
-                continue
-
-            val_size: int = struct.unpack(">b", desc[1:2])[0]
-            num_values: int = struct.unpack(">h", desc[2:4])[0]
-            length = val_size * num_values
-
-            if label == b"DVID":
-                if len(d["gps"]):  # first one is empty
-                    output.append(d)
-                d = {"gps": []}  # reset
-
-            for i in range(num_values):
-                data: bytes = f.read(val_size)
-
-                if label in methods:
-                    methods[label](data, d, s)
-
-                if label == b"SCAL":
-                    if 2 == val_size:
-                        s[i] = struct.unpack(">h", data)[0]
-                    elif 4 == val_size:
-                        s[i] = struct.unpack(">i", data)[0]
-                    else:
-                        raise Exception("unknown scal size")
-
-            # pack
-            mod = length % 4
-            if mod != 0:
-                seek = 4 - mod
-                f.read(seek)  # discarded
-
-    return output
+    for start, duration, buf in payloads:
+        for frame in parse_gpmf(buf, gps_only=False):
+            if frame.time is not None and telemetry.gps_epoch is None:
+                telemetry.gps_epoch = frame.time - datetime.timedelta(seconds=start)
+            for name in ["gps", "accl", "gyro"]:
+                samples = getattr(frame, name)
+                if len(samples):
+                    parts[name].append(samples)
+                    parts[name + "_times"].append(
+                        sample_times(start, duration, len(samples))
+                    )
+            telemetry.gps_fix.extend([frame.gps_fix] * len(frame.gps))
+
+    for name in parts:
+        setattr(telemetry, name, _join_samples(parts[name], getattr(telemetry, name)))
+
+    return telemetry
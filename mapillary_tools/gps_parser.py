@@ -45,6 +45,34 @@ def get_lat_lon_time_from_gpx(
     return points
 
 
+def get_lat_lon_time_from_points(
+    points, local_time=True
+) -> T.List[T.Tuple[datetime.datetime, float, float, float]]:
+    """
+    Read location and time stamps from the points extracted from a video, as
+    get_lat_lon_time_from_gpx reads them back from a GPX file of the points.
+
+    Returns a list of tuples (time, lat, lon, elevation).
+
+    The points are in UTC, by default we assume your camera used the local time
+    and convert accordingly. Points at latitude or longitude 0 are skipped like
+    write_gpx does.
+    """
+    trace = []
+    for point in points:
+        t, lat, lon = point[0], point[1], point[2]
+        if lat == 0 or lon == 0:
+            continue
+        if local_time:
+            t = utc_to_localtime(t)
+        trace.append((t, lat, lon, point[3] if len(point) > 3 else 0))
+
+    # sort by time just in case
+    trace.sort()
+
+    return trace
+
+
 def get_lat_lon_time_from_nmea(
     nmea_file, local_time=True
 ) -> T.List[T.Tuple[datetime.datetime, float, float, float]]:
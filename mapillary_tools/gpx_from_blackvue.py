@@ -191,12 +191,23 @@ def is_video_stationary(max_distance_from_start) -> bool:
     )
 
 
-def gpx_from_blackvue(bv_video, use_nmea_stream_timestamp=False) -> Tuple[str, bool]:
+def blackvue_trace(bv_video, use_nmea_stream_timestamp=False) -> Tuple[list, bool]:
+    """
+    Return the GPS points of the video sorted by time, and whether the video is
+    stationary, run in worker processes
+    """
     bv_data = get_points_from_bv(bv_video, use_nmea_stream_timestamp)
+    if not bv_data:
+        return [], True
+    bv_data.sort(key=lambda x: x[0])
+    return bv_data, is_video_stationary(get_max_distance_from_start(bv_data))
+
+
+def gpx_from_blackvue(bv_video, use_nmea_stream_timestamp=False) -> Tuple[str, bool]:
+    bv_data, is_stationary = blackvue_trace(bv_video, use_nmea_stream_timestamp)
     if not bv_data:
         return "", True
     basename, extension = os.path.splitext(bv_video)
     gpx_path = basename + ".gpx"
-    bv_data.sort(key=lambda x: x[0])
     write_gpx(gpx_path, bv_data)
-    return gpx_path, is_video_stationary(get_max_distance_from_start(bv_data))
+    return gpx_path, is_stationary
@@ -1,50 +1,62 @@
-from . import exif_read
+import functools
+
+from .exif_cache import read_exif
 from .geo import write_gpx
+from .utils import map_with_workers
+
+
+def get_point_from_exif(file, verbose=False):
+    point = ()
+    try:
+        exif = read_exif(file)
+    except:
+        if verbose:
+            print(f"Warning, EXIF could not be read for image {file}.")
+        return None
+    try:
+        lon, lat = exif.extract_lon_lat()
+    except:
+        if verbose:
+            print(f"Warning {file} image latitude or longitude tag not in EXIF.")
+        return None
+    try:
+        timestamp = exif.extract_capture_time()
+    except:
+        if verbose:
+            print(f"Warning {file} image capture time tag not in EXIF.")
+        return None
+    if lon is not None and lat is not None and timestamp is not None:
+        point = point + (timestamp, lat, lon)
+    else:
+        return None
+    try:
+        altitude = exif.extract_altitude()
+        point = point + (altitude,)
+    except:
+        pass
+    try:
+        heading = exif.extract_direction()
+        point = point + (heading,)
+    except:
+        pass
+    return point
 
 
-def get_points_from_exif(file_list, verbose=False):
-    data = []
-    for file in file_list:
-        point = ()
-        try:
-            exif = exif_read.ExifRead(file)
-        except:
-            if verbose:
-                print(f"Warning, EXIF could not be read for image {file}.")
-            continue
-        try:
-            lon, lat = exif.extract_lon_lat()
-        except:
-            if verbose:
-                print(f"Warning {file} image latitude or longitude tag not in EXIF.")
-            continue
-        try:
-            timestamp = exif.extract_capture_time()
-        except:
-            if verbose:
-                print(f"Warning {file} image capture time tag not in EXIF.")
-            continue
-        if lon is not None and lat is not None and timestamp is not None:
-            point = point + (timestamp, lat, lon)
-        else:
-            continue
-        try:
-            altitude = exif.extract_altitude()
-            point = point + (altitude,)
-        except:
-            pass
-        try:
-            heading = exif.extract_direction()
-            point = point + (heading,)
-        except:
-            pass
-        if point:
-            data.append(point)
-    return data
+def get_points_from_exif(file_list, verbose=False, workers=None, worker_type="thread"):
+    points = map_with_workers(
+        functools.partial(get_point_from_exif, verbose=verbose),
+        file_list,
+        workers=workers,
+        worker_type=worker_type,
+        desc="Reading gps data from image EXIF",
+    )
+    return [point for point in points if point]
 
 
-def gpx_from_exif(file_list, import_path, verbose=False):
-    data = get_points_from_exif(file_list, verbose)
+def gpx_from_exif(
+    file_list, import_path, verbose=False, workers=None, worker_type="thread"
+):
+    data = get_points_from_exif(file_list, verbose, workers, worker_type)
     data = sorted(data, key=lambda x: x[0])
     gpx_path = import_path + ".gpx"
     write_gpx(gpx_path, data)
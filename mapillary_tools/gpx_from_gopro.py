@@ -1,80 +1,61 @@
-import datetime
 import os
 
-from .ffmpeg import extract_stream, get_ffprobe
 from .geo import write_gpx
-from .gpmf import parse_bin, interpolate_times
+from .gpmf import GPMFTelemetry, parse_telemetry
+from .mp4_samples import find_track, read_sample_table, read_samples
 
 # author https://github.com/stilldavid
 
 """
 Pulls data out of a GoPro 5+ recording while GPS was enabled.
-"""
-
-
-def extract_bin(path: str) -> str:
-    info = get_ffprobe(path)
-
-    format_name = info["format"]["format_name"].lower()
-    if "mp4" not in format_name:
-        raise IOError("File must be an mp4")
-
-    stream_id = None
-    for stream in info["streams"]:
-        if (
-            "codec_tag_string" in stream
-            and "gpmd" in stream["codec_tag_string"].lower()
-        ):
-            stream_id = stream["index"]
 
-    if stream_id is None:
-        raise IOError("No GoPro metadata track found - was GPS turned on?")
-
-    basename, extension = os.path.splitext(path)
-    bin_path = basename + ".bin"
+The GPMF samples are read from the gpmd track of the video in place, using its
+MP4 sample table, instead of extracting the track to a .bin file with ffmpeg.
+Every GPS sample is timed from the video start by the track's time table, and
+placed in GPS time by the first GPSU.
+"""
 
-    extract_stream(path, bin_path, stream_id)
 
-    return bin_path
+def extract_telemetry(path: str) -> GPMFTelemetry:
+    """
+    Parse the GPMF samples of the gpmd track, read from the video in place and
+    timed by the track's time table
+    """
+    with open(path, "rb") as fp:
+        mdia = find_track(fp, b"gpmd")
+        if mdia is None:
+            raise IOError("No GoPro metadata track found - was GPS turned on?")
+        samples = read_sample_table(fp, mdia)
+        return parse_telemetry(
+            (sample.time, sample.duration, data)
+            for sample, data in zip(samples, read_samples(fp, samples))
+        )
 
 
 def get_points_from_gpmf(path: str) -> list:
-    bin_path = extract_bin(path)
-
-    gpmf_data = parse_bin(bin_path)
-    rows = len(gpmf_data)
-
-    points = []
-    for i, frame in enumerate(gpmf_data):
-        t = frame["time"]
-
-        if i < rows - 1:
-            next_ts = gpmf_data[i + 1]["time"]
-        else:
-            next_ts = t + datetime.timedelta(seconds=1)
+    telemetry = extract_telemetry(path)
 
-        interpolate_times(frame, next_ts)
+    return [
+        (point_time, float(point[0]), float(point[1]), float(point[2]), gps_fix)
+        for point_time, point, gps_fix in zip(
+            telemetry.gps_datetimes(), telemetry.gps, telemetry.gps_fix
+        )
+    ]
 
-        for point in frame["gps"]:
-            points.append(
-                (
-                    point["time"],
-                    point["lat"],
-                    point["lon"],
-                    point["alt"],
-                    frame["gps_fix"],
-                )
-            )
 
-    return points
+def gopro_trace(gopro_video: str) -> list:
+    """
+    Return the GPS points of the video sorted by time, run in worker processes
+    """
+    return sorted(get_points_from_gpmf(gopro_video))
 
 
 def gpx_from_gopro(gopro_video):
-    gopro_data = get_points_from_gpmf(gopro_video)
+    gopro_data = gopro_trace(gopro_video)
 
     basename, extension = os.path.splitext(gopro_video)
     gpx_path = basename + ".gpx"
 
-    write_gpx(gpx_path, sorted(gopro_data))
+    write_gpx(gpx_path, gopro_data)
 
     return gpx_path
@@ -4,8 +4,8 @@ import sys
 from tqdm import tqdm
 
 from . import processing
-from . import uploader
 from .error import print_error
+from .process_state import get_process_state
 
 
 def insert_MAPJson(
@@ -65,20 +65,16 @@ def insert_MAPJson(
             "If the images have already been processed and not yet uploaded, they can be processed again, by passing the argument --rerun"
         )
 
+    state = get_process_state()
     for image in tqdm(
         process_file_list, desc="Inserting mapillary image description in image EXIF"
     ):
         # check the processing logs
-        log_root = uploader.log_rootpath(image)
-
-        duplicate_path = os.path.join(log_root, "duplicate")
-
-        if os.path.isfile(duplicate_path):
+        if state.has_flag(image, "duplicate"):
             continue
 
         final_mapillary_image_description = (
             processing.get_final_mapillary_image_description(
-                log_root,
                 image,
                 master_upload,
                 verbose,
@@ -9,9 +9,9 @@ from . import process_csv
 from . import processing
 from . import uploader
 from .error import print_error
-from .exif_read import ExifRead
+from .exif_cache import read_exif
 from .exif_write import ExifEdit
-from .geo import interpolate_lat_lon
+from .geo import GpsTrace
 from .process_import_meta_properties import add_meta_tag
 
 EPOCH = datetime.datetime.utcfromtimestamp(0)
@@ -145,14 +145,20 @@ def interpolation(
                 f"Interpolating gps for {len(missing_geotags)} images missing geotags."
             )
 
+            try:
+                trace = GpsTrace(geotags, max_time_delta)
+            except ValueError as e:
+                print_error(
+                    f"Error, {e}, interpolation of latitude and longitude failed"
+                )
+                sys.exit(1)
+
             for image, timestamp in tqdm(
                 missing_geotags, desc="Interpolating missing gps"
             ):
                 # interpolate
                 try:
-                    lat, lon, bearing, elevation = interpolate_lat_lon(
-                        geotags, timestamp, max_time_delta
-                    )
+                    lat, lon, bearing, elevation = trace.interpolate(timestamp)
                 except Exception as e:
                     print_error(
                         f"Error, {e}, interpolation of latitude and longitude failed for image {image}"
@@ -197,7 +203,7 @@ def interpolation(
             ):
 
                 # load exif
-                exif = ExifRead(image)
+                exif = read_exif(image)
                 timestamp = exif.extract_capture_time()
                 if timestamp:
                     timestamps.append(timestamp)
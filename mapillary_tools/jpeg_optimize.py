@@ -0,0 +1,160 @@
+import logging
+import os
+import shutil
+import subprocess
+import time
+import typing as T
+from concurrent import futures
+
+import piexif
+
+"""
+Lossless optimization of the JPEG images before uploading.
+
+JPEG images written by cameras and by ffmpeg use the default Huffman tables.
+jpegtran -optimize recomputes optimal tables for each image, which makes the
+entropy-coded data a few percent smaller without changing a single pixel, and
+-copy all keeps all the markers, including EXIF. The optimized copies are written
+to a staging directory and uploaded instead of the images, which are left as they
+are. Copies that are not smaller, or whose EXIF differs from the image, are not
+used.
+"""
+
+
+LOG = logging.getLogger()
+
+JPEGTRAN = os.getenv("MAPILLARY_TOOLS_JPEGTRAN", "jpegtran")
+
+
+class OptimizeResult:
+    """
+    Result of optimizing an image: the path to upload (the copy, or the image if the
+    copy is not used), the sizes before and after, and the CPU seconds of jpegtran
+    """
+
+    def __init__(
+        self,
+        image: str,
+        path: str,
+        original_size: int,
+        optimized_size: int,
+        cpu_seconds: float,
+    ) -> None:
+        self.image = image
+        self.path = path
+        self.original_size = original_size
+        self.optimized_size = optimized_size
+        self.cpu_seconds = cpu_seconds
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_size - self.optimized_size
+
+
+def staging_dir(file_list: T.List[str], sequence_uuid: str) -> str:
+    """
+    Return the directory where the optimized copies of the sequence are kept until
+    the sequence is uploaded
+    """
+    return os.path.join(
+        os.path.dirname(file_list[0]), ".mapillary", "uploads", sequence_uuid
+    )
+
+
+def check_jpegtran() -> None:
+    if shutil.which(JPEGTRAN) is None:
+        raise RuntimeError(
+            f"{JPEGTRAN} not found. Please make sure it is installed in your PATH (e.g. from libjpeg-turbo), or set MAPILLARY_TOOLS_JPEGTRAN to its path"
+        )
+
+
+def _run_jpegtran(image: str, output: str) -> float:
+    """
+    Run jpegtran and return the CPU seconds it spent
+    """
+    cmd = [JPEGTRAN, "-copy", "all", "-optimize", "-outfile", output, image]
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        check_jpegtran()
+        raise
+    assert proc.stderr is not None
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    if hasattr(os, "wait4"):
+        # the resource usage of this child only, not of the other workers'
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    else:
+        start = time.perf_counter()
+        proc.wait()
+        cpu_seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Error optimizing {image}: {stderr.decode('utf-8', 'replace').strip()}"
+        )
+    return cpu_seconds
+
+
+def optimize_image(image: str, output: str) -> OptimizeResult:
+    """
+    Write the optimized copy of the image to output, and return the result. The
+    copy is removed if it is not used.
+    """
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    original_size = os.path.getsize(image)
+    cpu_seconds = _run_jpegtran(image, output)
+    optimized_size = os.path.getsize(output)
+    if optimized_size >= original_size:
+        os.remove(output)
+        return OptimizeResult(image, image, original_size, original_size, cpu_seconds)
+    if piexif.load(output) != piexif.load(image):
+        LOG.warning(f"The EXIF of the optimized {image} differs, using the original")
+        os.remove(output)
+        return OptimizeResult(image, image, original_size, original_size, cpu_seconds)
+    return OptimizeResult(image, output, original_size, optimized_size, cpu_seconds)
+
+
+def optimize_images(
+    file_list: T.List[str],
+    root_dir: str,
+    output_dir: str,
+    max_workers: T.Optional[int] = None,
+    on_file: T.Optional[T.Callable[[str], None]] = None,
+) -> T.List[OptimizeResult]:
+    """
+    Optimize the images in a pool of workers, each to the same path relative to
+    output_dir as the image relative to root_dir, and return the results in the
+    order of the images
+    """
+    check_jpegtran()
+
+    def _optimize(image: str) -> OptimizeResult:
+        output = os.path.join(output_dir, os.path.relpath(image, root_dir))
+        result = optimize_image(image, output)
+        LOG.debug(
+            f"Optimized {image}: saved {result.saved_bytes} of {result.original_size} bytes in {result.cpu_seconds:.3f} CPU seconds"
+        )
+        if on_file is not None:
+            on_file(image)
+        return result
+
+    with futures.ThreadPoolExecutor(
+        max_workers=max_workers or os.cpu_count()
+    ) as executor:
+        return list(executor.map(_optimize, file_list))
+
+
+def summarize(results: T.List[OptimizeResult]) -> str:
+    original_size = sum(result.original_size for result in results)
+    saved_bytes = sum(result.saved_bytes for result in results)
+    cpu_seconds = sum(result.cpu_seconds for result in results)
+    ratio = saved_bytes / original_size if original_size else 0.0
+    return f"Optimized {len(results)} images: saved {saved_bytes} bytes ({ratio:.1%}) in {cpu_seconds:.1f} CPU seconds"
+
+
+def remove_staging_dir(file_list: T.List[str], sequence_uuid: str) -> None:
+    path = staging_dir(file_list, sequence_uuid)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
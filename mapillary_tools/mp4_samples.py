@@ -0,0 +1,204 @@
+import io
+import struct
+import typing as T
+
+from pymp4.parser import Box
+
+"""
+Read the samples of an MP4 track without extracting the track with ffmpeg.
+
+The box headers are walked with seeks only, so the media data is never read, and
+the sample table boxes of the track (stsd, stsc, stsz, stco or co64, stts) are
+parsed with pymp4. The samples are then read at their offsets, which for a
+telemetry track such as GoPro's gpmd is a few MB out of a multi-GB video.
+"""
+
+
+class Sample:
+    """
+    A sample of a track: its offset and size in the file, and its time and duration
+    in seconds from the start of the track
+    """
+
+    def __init__(self, offset: int, size: int, time: float, duration: float) -> None:
+        self.offset = offset
+        self.size = size
+        self.time = time
+        self.duration = duration
+
+
+def iter_boxes(
+    fp: T.BinaryIO, start: int, end: int
+) -> T.Iterator[T.Tuple[bytes, int, int]]:
+    """
+    Yield the type, the offset and the end of each box between start and end,
+    without reading their payloads
+    """
+    offset = start
+    while offset + 8 <= end:
+        fp.seek(offset)
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack(">I4s", header)
+        if size == 1:
+            (size,) = struct.unpack(">Q", fp.read(8))
+        elif size == 0:
+            # the box extends to the end
+            size = end - offset
+        if size < 8:
+            raise IOError(f"Invalid size {size} of MP4 box {box_type!r} at {offset}")
+        yield box_type, offset, min(offset + size, end)
+        offset += size
+
+
+def _children(
+    fp: T.BinaryIO, start: int, end: int
+) -> T.Iterator[T.Tuple[bytes, int, int]]:
+    fp.seek(start)
+    header = fp.read(8)
+    size, _ = struct.unpack(">I4s", header)
+    header_size = 16 if size == 1 else 8
+    return iter_boxes(fp, start + header_size, end)
+
+
+def _parse_box(fp: T.BinaryIO, start: int, end: int) -> T.Any:
+    fp.seek(start)
+    return Box.parse(fp.read(end - start))
+
+
+def _find_child(
+    fp: T.BinaryIO, start: int, end: int, box_type: bytes
+) -> T.Optional[T.Tuple[int, int]]:
+    for child_type, child_start, child_end in _children(fp, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _find_path(
+    fp: T.BinaryIO, start: int, end: int, path: T.List[bytes]
+) -> T.Optional[T.Tuple[int, int]]:
+    found: T.Optional[T.Tuple[int, int]] = (start, end)
+    for box_type in path:
+        assert found is not None
+        found = _find_child(fp, found[0], found[1], box_type)
+        if found is None:
+            return None
+    return found
+
+
+def _sample_entry_format(fp: T.BinaryIO, start: int, end: int) -> T.Optional[bytes]:
+    # stsd: header, version and flags, entry count, then the first sample entry
+    # (size and format), read directly since pymp4 may not know the format
+    fp.seek(start)
+    size, _ = struct.unpack(">I4s", fp.read(8))
+    header_size = 16 if size == 1 else 8
+    fp.seek(start + header_size + 8 + 4)
+    entry_format = fp.read(4)
+    return entry_format if len(entry_format) == 4 else None
+
+
+def find_track(fp: T.BinaryIO, sample_format: bytes) -> T.Optional[T.Tuple[int, int]]:
+    """
+    Return the offset and the end of the mdia box of the first track whose samples
+    have the given format (e.g. gpmd), or None if there is no such track
+    """
+    fp.seek(0, io.SEEK_END)
+    file_size = fp.tell()
+    moov = None
+    for box_type, start, end in iter_boxes(fp, 0, file_size):
+        if box_type == b"moov":
+            moov = (start, end)
+            break
+    if moov is None:
+        raise IOError("No moov box found, the file is not an MP4 video")
+
+    for box_type, start, end in _children(fp, *moov):
+        if box_type != b"trak":
+            continue
+        mdia = _find_child(fp, start, end, b"mdia")
+        if mdia is None:
+            continue
+        stsd = _find_path(fp, mdia[0], mdia[1], [b"minf", b"stbl", b"stsd"])
+        if stsd is not None and _sample_entry_format(fp, *stsd) == sample_format:
+            return mdia
+    return None
+
+
+def read_sample_table(fp: T.BinaryIO, mdia: T.Tuple[int, int]) -> T.List[Sample]:
+    """
+    Return the samples of the track from the sample table boxes of its mdia box
+    """
+    mdhd = _find_child(fp, mdia[0], mdia[1], b"mdhd")
+    stbl = _find_path(fp, mdia[0], mdia[1], [b"minf", b"stbl"])
+    if mdhd is None or stbl is None:
+        raise IOError("Incomplete MP4 track: expect mdhd and stbl")
+    timescale = _parse_box(fp, *mdhd).timescale
+    if not timescale:
+        raise IOError("Invalid MP4 track timescale 0")
+
+    tables: T.Dict[bytes, T.Any] = {}
+    for box_type, start, end in _children(fp, *stbl):
+        if box_type in (b"stsc", b"stsz", b"stco", b"co64", b"stts"):
+            tables[box_type] = _parse_box(fp, start, end)
+
+    stsz = tables.get(b"stsz")
+    stsc = tables.get(b"stsc")
+    stts = tables.get(b"stts")
+    chunk_offset_box = tables.get(b"co64", tables.get(b"stco"))
+    if stsz is None or stsc is None or stts is None or chunk_offset_box is None:
+        raise IOError(
+            "Incomplete MP4 sample table: expect stsz, stsc, stts and stco/co64"
+        )
+
+    if stsz.sample_size:
+        sizes = [stsz.sample_size] * stsz.sample_count
+    else:
+        sizes = list(stsz.entry_sizes)
+    chunk_offsets = [entry.chunk_offset for entry in chunk_offset_box.entries]
+    # stts runs: sample_count samples of sample_delta each, in timescale units
+    deltas = [
+        entry.sample_delta for entry in stts.entries for _ in range(entry.sample_count)
+    ]
+    if len(deltas) < len(sizes):
+        raise IOError(f"The MP4 time table times {len(deltas)} of {len(sizes)} samples")
+
+    # stsc runs: from first_chunk (1-based) until the next run, each chunk has
+    # samples_per_chunk samples, stored one after another
+    samples: T.List[Sample] = []
+    elapsed = 0
+    runs = list(stsc.entries)
+    for idx, run in enumerate(runs):
+        last_chunk = (
+            runs[idx + 1].first_chunk - 1 if idx + 1 < len(runs) else len(chunk_offsets)
+        )
+        for chunk in range(run.first_chunk - 1, last_chunk):
+            offset = chunk_offsets[chunk]
+            for _ in range(run.samples_per_chunk):
+                if len(samples) >= len(sizes):
+                    break
+                size, delta = sizes[len(samples)], deltas[len(samples)]
+                samples.append(
+                    Sample(offset, size, elapsed / timescale, delta / timescale)
+                )
+                offset += size
+                elapsed += delta
+
+    if len(samples) != len(sizes):
+        raise IOError(
+            f"The MP4 sample table maps {len(samples)} of {len(sizes)} samples"
+        )
+    return samples
+
+
+def read_samples(fp: T.BinaryIO, samples: T.Iterable[Sample]) -> T.Iterator[bytes]:
+    """
+    Yield the data of each sample, seeking to it
+    """
+    for sample in samples:
+        fp.seek(sample.offset)
+        data = fp.read(sample.size)
+        if len(data) != sample.size:
+            raise IOError(f"Truncated MP4 sample at {sample.offset}")
+        yield data
@@ -5,25 +5,21 @@ import sys
 
 from tqdm import tqdm
 
-from . import exif_read
+from .exif_cache import read_exif
 from . import ipc
 from . import processing
 from . import uploader
+from .process_state import get_process_state
 
 
 def map_images_to_sequences(destination_mapping, total_files):
     unique_sequence_uuids = []
     sequence_counter = 0
+    state = get_process_state()
     for image in tqdm(
         total_files, desc="Reading sequence information stored in log files"
     ):
-        log_root = uploader.log_rootpath(image)
-        sequence_data_path = os.path.join(log_root, "sequence_process.json")
-
-        if os.path.isfile(sequence_data_path):
-            sequence_data = processing.load_json(sequence_data_path)
-        else:
-            sequence_data = None
+        sequence_data = state.load_data(image, "sequence_process")
 
         if sequence_data and "MAPSequenceUUID" in sequence_data:
             sequence_uuid = sequence_data["MAPSequenceUUID"]
@@ -44,19 +40,19 @@ def map_images_to_sequences(destination_mapping, total_files):
     return destination_mapping
 
 
-def get_local_mapping(import_path):
-    total_files = uploader.get_total_file_list(import_path)
+def get_local_mapping(import_path, total_files=None):
+    if total_files is None:
+        total_files = uploader.get_total_file_list(import_path)
 
     local_mapping = []
+    state = get_process_state()
     for file in tqdm(total_files, desc="Reading image uuids"):
         image_file_uuid = None
         relative_path = file.lstrip(os.path.abspath(import_path))
-        log_rootpath = uploader.log_rootpath(file)
-        image_description_json_path = os.path.join(
-            log_rootpath, "mapillary_image_description.json"
-        )
-        if os.path.isfile(image_description_json_path):
-            image_description_json = processing.load_json(image_description_json_path)
+        if state.has_data(file, "mapillary_image_description"):
+            image_description_json = state.load_data(
+                file, "mapillary_image_description"
+            )
             if "MAPPhotoUUID" in image_description_json:
                 image_file_uuid = image_description_json["MAPPhotoUUID"]
             else:
@@ -64,7 +60,7 @@ def get_local_mapping(import_path):
                     "Error, photo uuid not in mapillary_image_description.json log file."
                 )
         else:
-            image_exif = exif_read.ExifRead(file)
+            image_exif = read_exif(file)
             description = image_exif.extract_image_description()
             if description is None:
                 description = ""
@@ -153,8 +149,10 @@ def post_process(
         print("Error, import directory " + import_path + " does not exist, exiting...")
         sys.exit(1)
 
+    status_index = uploader.StatusIndex(import_path, skip_subfolders)
+
     if save_local_mapping:
-        local_mapping = get_local_mapping(import_path)
+        local_mapping = get_local_mapping(import_path, status_index.total_file_list())
         local_mapping_filepath = os.path.join(
             os.path.dirname(import_path),
             os.path.basename(import_path)
@@ -166,45 +164,34 @@ def post_process(
                 csvwriter.writerow(row)
 
     if push_images:
-        to_be_pushed_files = uploader.get_success_only_manual_upload_file_list(
-            import_path, skip_subfolders
-        )
+        to_be_pushed_files = status_index.success_only_manual_upload_file_list()
         params = {}
+        state = get_process_state()
         for image in tqdm(to_be_pushed_files, desc="Pushing images"):
-            log_root = uploader.log_rootpath(image)
-            upload_params_path = os.path.join(log_root, "upload_params_process.json")
-            if os.path.isfile(upload_params_path):
-                with open(upload_params_path, "rb") as jf:
-                    params[image] = json.load(jf)
+            if state.has_data(image, "upload_params_process"):
+                params[image] = state.load_data(image, "upload_params_process")
 
         # flag finalization for each file
         uploader.flag_finalization(to_be_pushed_files)
+        status_index.refresh()
 
     if summarize or list_file_status or move_uploaded:
         # upload logs
-        uploaded_files = uploader.get_success_upload_file_list(
-            import_path, skip_subfolders
-        )
+        uploaded_files = status_index.success_upload_file_list()
         uploaded_files_count = len(uploaded_files)
-        failed_upload_files = uploader.get_failed_upload_file_list(
-            import_path, skip_subfolders
-        )
+        failed_upload_files = status_index.failed_upload_file_list()
         failed_upload_files_count = len(failed_upload_files)
-        to_be_finalized_files = uploader.get_finalize_file_list(import_path)
+        to_be_finalized_files = status_index.finalize_file_list()
         to_be_finalized_files_count = len(to_be_finalized_files)
-        to_be_uploaded_files = uploader.get_upload_file_list(
-            import_path, skip_subfolders
-        )
+        to_be_uploaded_files = status_index.upload_file_list()
         to_be_uploaded_files_count = len(to_be_uploaded_files)
 
     if summarize or move_sequences:
-        total_files = uploader.get_total_file_list(import_path)
+        total_files = status_index.total_file_list()
         total_files_count = len(total_files)
 
     if summarize or move_duplicates or list_file_status:
-        duplicates_file_list = processing.get_duplicate_file_list(
-            import_path, skip_subfolders
-        )
+        duplicates_file_list = status_index.duplicate_file_list()
         duplicates_file_list_count = len(duplicates_file_list)
 
     if summarize:
@@ -228,15 +215,9 @@ def post_process(
         ]
         for step in process_steps:
             process_success = len(
-                processing.get_process_status_file_list(
-                    import_path, step, "success", skip_subfolders
-                )
-            )
-            process_failed = len(
-                processing.get_process_status_file_list(
-                    import_path, step, "failed", skip_subfolders
-                )
+                status_index.process_status_file_list(step, "success")
             )
+            process_failed = len(status_index.process_status_file_list(step, "failed"))
             summary_dict["process summary"][step] = {
                 "failed": process_failed,
                 "success": process_success,
@@ -341,10 +322,4 @@ def post_process(
         if not os.path.isdir(os.path.dirname(image_destination_path)):
             os.makedirs(os.path.dirname(image_destination_path))
         os.rename(image, image_destination_path)
-        image_logs_dir = uploader.log_rootpath(image)
-        destination_logs_dir = uploader.log_rootpath(image_destination_path)
-        if not os.path.isdir(image_logs_dir):
-            continue
-        if not os.path.isdir(os.path.dirname(destination_logs_dir)):
-            os.makedirs(os.path.dirname(destination_logs_dir))
-        os.rename(image_logs_dir, destination_logs_dir)
+        get_process_state().move(image, image_destination_path)
@@ -18,6 +18,8 @@ def process_geotag_properties(
     rerun=False,
     skip_subfolders=False,
     video_import_path=None,
+    workers=None,
+    worker_type="thread",
 ):
     # sanity check if video file is passed
     if (
@@ -63,7 +65,13 @@ def process_geotag_properties(
     # function calls
     if geotag_source == "exif":
         processing.geotag_from_exif(
-            process_file_list, import_path, offset_time, offset_angle, verbose
+            process_file_list,
+            import_path,
+            offset_time,
+            offset_angle,
+            verbose,
+            workers=workers,
+            worker_type=worker_type,
         )
 
     elif geotag_source == "gpx" or geotag_source == "nmea":
@@ -89,6 +97,7 @@ def process_geotag_properties(
             sub_second_interval,
             use_gps_start_time,
             verbose,
+            workers=workers,
         )
     elif geotag_source == "blackvue_videos":
         processing.geotag_from_blackvue_video(
@@ -101,5 +110,6 @@ def process_geotag_properties(
             sub_second_interval,
             use_gps_start_time,
             verbose,
+            workers=workers,
         )
     print("Sub process ended")
@@ -1,14 +1,19 @@
 import typing as T
 import datetime
 import os
-import time
 import uuid
 
 from tqdm import tqdm
 
 from . import processing
-from . import uploader
-from .geo import compute_bearing, gps_distance, diff_bearing, gps_speed
+from .process_state import get_process_state
+from .geo import (
+    compute_bearing_array,
+    gps_distance,
+    gps_distance_array,
+    diff_bearing,
+    gps_speed,
+)
 
 MAX_SEQUENCE_LENGTH = 500
 MAX_CAPTURE_SPEED = 45  # in m/s
@@ -93,12 +98,13 @@ def process_sequence_properties(
         directions = sequence["directions"]
         latlons = sequence["latlons"]
         capture_times = sequence["capture_times"]
+        lats = [lat for lat, _ in latlons]
+        lons = [lon for _, lon in latlons]
 
         # COMPUTE DIRECTIONS --------------------------------------
-        interpolated_directions = [
-            compute_bearing(ll1[0], ll1[1], ll2[0], ll2[1])
-            for ll1, ll2 in zip(latlons[:-1], latlons[1:])
-        ]
+        interpolated_directions = compute_bearing_array(
+            lats[:-1], lons[:-1], lats[1:], lons[1:]
+        )
         if len(interpolated_directions):
             interpolated_directions.append(interpolated_directions[-1])
         else:
@@ -118,9 +124,9 @@ def process_sequence_properties(
             (t1 - t0).total_seconds()
             for t0, t1 in zip(capture_times[:-1], capture_times[1:])
         ]
-        computed_distances = [
-            gps_distance(l1, l0) for l0, l1 in zip(latlons[:-1], latlons[1:])
-        ]
+        computed_distances = gps_distance_array(
+            lats[1:], lons[1:], lats[:-1], lons[:-1]
+        )
         computed_speed = gps_speed(
             computed_distances, computed_delta_ts
         )  # in meters/second
@@ -143,12 +149,8 @@ def process_sequence_properties(
             final_capture_times = [capture_times[0]]
             prev_latlon = latlons[0]
             prev_direction = directions[0]
+            state = get_process_state()
             for i, filename in enumerate(file_list[1:]):
-                log_root = uploader.log_rootpath(filename)
-                duplicate_flag_path = os.path.join(log_root, "duplicate")
-                sequence_process_success_path = os.path.join(
-                    log_root, "sequence_process_success"
-                )
                 k = i + 1
                 distance = gps_distance(latlons[k], prev_latlon)
                 if directions[k] is not None and prev_direction is not None:
@@ -158,14 +160,11 @@ def process_sequence_properties(
                     # available
                     direction_diff = 360
                 if distance < duplicate_distance and direction_diff < duplicate_angle:
-                    open(duplicate_flag_path, "w").close()
-                    open(sequence_process_success_path, "w").close()
-                    open(
-                        sequence_process_success_path
-                        + "_"
-                        + str(time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())),
-                        "w",
-                    ).close()
+                    with state.transaction():
+                        state.set_flag(filename, "duplicate")
+                        state.set_flag(
+                            filename, "sequence_process_success", record_history=True
+                        )
                 else:
                     prev_latlon = latlons[k]
                     prev_direction = directions[k]
@@ -0,0 +1,497 @@
+import contextlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing as T
+
+"""
+Storage of the per-image process state: status flags (e.g. geotag_process_success,
+duplicate, upload_success), the JSON data produced by each process stage, and the
+history of when each flag was set.
+
+Two backends are available, selected with MAPILLARY_TOOLS_PROCESS_STATE:
+- "files" (default): the original layout, one directory per image under
+  .mapillary/logs with an empty file per flag and a JSON file per stage
+- "sqlite": one SQLite database (WAL mode) per image directory, stored at
+  .mapillary/process_state.db, where the original layout is migrated on first use
+"""
+
+
+LOG = logging.getLogger()
+
+PROCESS_STATE_BACKEND = os.getenv("MAPILLARY_TOOLS_PROCESS_STATE", "files")
+STATE_DB_FILENAME = "process_state.db"
+HISTORY_TIME_FORMAT = "%Y_%m_%d_%H_%M_%S"
+_HISTORY_SUFFIX_REGEX = re.compile(r"^(.+)_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})$")
+# data caching what is read from the image, saved also for images that were never
+# processed, so it does not count as process state; see register_cache_data
+CACHE_DATA_NAMES: T.Set[str] = set()
+
+
+def register_cache_data(name: str) -> str:
+    """
+    Register the data name of a cache of what is read from the image, which does
+    not count as process state, and return it
+    """
+    CACHE_DATA_NAMES.add(name)
+    return name
+
+
+def log_rootpath(filepath: str) -> str:
+    return os.path.join(
+        os.path.dirname(filepath),
+        ".mapillary",
+        "logs",
+        os.path.splitext(os.path.basename(filepath))[0],
+    )
+
+
+def state_db_path(dirpath: str) -> str:
+    return os.path.join(dirpath, ".mapillary", STATE_DB_FILENAME)
+
+
+def _history_suffix() -> str:
+    return time.strftime(HISTORY_TIME_FORMAT, time.gmtime())
+
+
+class ProcessState:
+    """
+    Interface of the process state backends. Images are identified by their paths,
+    flags and data by the names previously used for the log files (without ".json").
+    """
+
+    def flags(self, image: str) -> T.Set[str]:
+        raise NotImplementedError
+
+    def has_flag(self, image: str, flag: str) -> bool:
+        return flag in self.flags(image)
+
+    def directory_flags(
+        self, dirpath: str, filenames: T.Iterable[str]
+    ) -> T.Dict[str, T.Set[str]]:
+        """
+        Return the flags of the given files in the directory, keyed by file name
+        """
+        return {
+            filename: self.flags(os.path.join(dirpath, filename))
+            for filename in filenames
+        }
+
+    def set_flag(self, image: str, flag: str, record_history: bool = False) -> None:
+        raise NotImplementedError
+
+    def clear_flag(self, image: str, flag: str) -> None:
+        raise NotImplementedError
+
+    def has_data(self, image: str, name: str) -> bool:
+        raise NotImplementedError
+
+    def load_data(self, image: str, name: str) -> T.Dict:
+        """
+        Return the data saved for the stage, or an empty dict if it is missing or invalid
+        """
+        raise NotImplementedError
+
+    def save_data(self, image: str, name: str, data: T.Dict[str, T.Any]) -> None:
+        raise NotImplementedError
+
+    def remove_data(self, image: str, name: str) -> None:
+        raise NotImplementedError
+
+    def has_state(self, image: str) -> bool:
+        """
+        Return whether any process stage left flags or data for the image, apart
+        from the cache data
+        """
+        raise NotImplementedError
+
+    def move(self, image: str, destination: str) -> None:
+        """
+        Move the state of the image to its new path after the image has been moved
+        """
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def transaction(self) -> T.Generator[None, None, None]:
+        """
+        Group the writes within the block so that they are persisted together
+        """
+        yield
+
+
+def _dump_json(data: T.Dict[str, T.Any]) -> str:
+    try:
+        return json.dumps(data, indent=4)
+    except Exception:
+        raise RuntimeError(f"Error JSON serializing {data}")
+
+
+class FileProcessState(ProcessState):
+    def flags(self, image: str) -> T.Set[str]:
+        try:
+            names = os.listdir(log_rootpath(image))
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        return {
+            name
+            for name in names
+            if not name.endswith(".json") and not _HISTORY_SUFFIX_REGEX.match(name)
+        }
+
+    def has_flag(self, image: str, flag: str) -> bool:
+        return os.path.isfile(os.path.join(log_rootpath(image), flag))
+
+    def directory_flags(
+        self, dirpath: str, filenames: T.Iterable[str]
+    ) -> T.Dict[str, T.Set[str]]:
+        try:
+            log_dirs = set(os.listdir(os.path.join(dirpath, ".mapillary", "logs")))
+        except (FileNotFoundError, NotADirectoryError):
+            log_dirs = set()
+        flags_by_stem: T.Dict[str, T.Set[str]] = {}
+        flags = {}
+        for filename in filenames:
+            stem, _ = os.path.splitext(filename)
+            if stem not in flags_by_stem:
+                if stem in log_dirs:
+                    flags_by_stem[stem] = self.flags(os.path.join(dirpath, filename))
+                else:
+                    flags_by_stem[stem] = set()
+            flags[filename] = flags_by_stem[stem]
+        return flags
+
+    def set_flag(self, image: str, flag: str, record_history: bool = False) -> None:
+        log_root = log_rootpath(image)
+        os.makedirs(log_root, exist_ok=True)
+        flag_path = os.path.join(log_root, flag)
+        open(flag_path, "a").close()
+        if record_history:
+            open(f"{flag_path}_{_history_suffix()}", "w").close()
+
+    def clear_flag(self, image: str, flag: str) -> None:
+        flag_path = os.path.join(log_rootpath(image), flag)
+        if os.path.isfile(flag_path):
+            os.remove(flag_path)
+
+    def has_data(self, image: str, name: str) -> bool:
+        return os.path.isfile(os.path.join(log_rootpath(image), name + ".json"))
+
+    def load_data(self, image: str, name: str) -> T.Dict:
+        try:
+            with open(os.path.join(log_rootpath(image), name + ".json"), "rb") as fp:
+                return json.load(fp)
+        except Exception:
+            return {}
+
+    def save_data(self, image: str, name: str, data: T.Dict[str, T.Any]) -> None:
+        buf = _dump_json(data)
+        log_root = log_rootpath(image)
+        os.makedirs(log_root, exist_ok=True)
+        # replace the file so that a crash never leaves it half written
+        data_path = os.path.join(log_root, name + ".json")
+        with open(data_path + ".tmp", "w") as fp:
+            fp.write(buf)
+        os.replace(data_path + ".tmp", data_path)
+
+    def remove_data(self, image: str, name: str) -> None:
+        data_path = os.path.join(log_rootpath(image), name + ".json")
+        if os.path.isfile(data_path):
+            os.remove(data_path)
+
+    def has_state(self, image: str) -> bool:
+        try:
+            names = os.listdir(log_rootpath(image))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        cache_files = {name + ".json" for name in CACHE_DATA_NAMES}
+        return any(name not in cache_files for name in names)
+
+    def move(self, image: str, destination: str) -> None:
+        image_logs_dir = log_rootpath(image)
+        destination_logs_dir = log_rootpath(destination)
+        if not os.path.isdir(image_logs_dir):
+            return
+        os.makedirs(os.path.dirname(destination_logs_dir), exist_ok=True)
+        os.rename(image_logs_dir, destination_logs_dir)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flags (
+    path TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    PRIMARY KEY (path, flag)
+);
+CREATE TABLE IF NOT EXISTS data (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+);
+CREATE TABLE IF NOT EXISTS history (
+    path TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+class SQLiteProcessState(ProcessState):
+    """
+    Keep the state of all images of a directory in a single SQLite database in
+    the directory's .mapillary folder, keyed by the image file name.
+    """
+
+    def __init__(self) -> None:
+        self._connections: T.Dict[str, sqlite3.Connection] = {}
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
+        self._pid = os.getpid()
+
+    def _connect(
+        self, image: str, create: bool = False
+    ) -> T.Optional[sqlite3.Connection]:
+        return self._connect_directory(os.path.dirname(os.path.abspath(image)), create)
+
+    def _connect_directory(
+        self, dirpath: str, create: bool = False
+    ) -> T.Optional[sqlite3.Connection]:
+        with self._lock:
+            if self._pid != os.getpid():
+                # connections can not be shared with a forked worker process
+                self._connections = {}
+                self._transaction_depth = 0
+                self._pid = os.getpid()
+            conn = self._connections.get(dirpath)
+            if conn is not None:
+                return conn
+            db_path = state_db_path(dirpath)
+            logs_dir = os.path.join(dirpath, ".mapillary", "logs")
+            exists = os.path.isfile(db_path)
+            if not exists and not create and not os.path.isdir(logs_dir):
+                return None
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SQLITE_SCHEMA)
+            self._connections[dirpath] = conn
+            if not exists and os.path.isdir(logs_dir):
+                migrate_logs(dirpath, conn)
+            return conn
+
+    def _write(self, image: str, statements: T.List[T.Tuple[str, tuple]]) -> None:
+        with self._lock:
+            conn = self._connect(image, create=True)
+            assert conn is not None
+            for sql, params in statements:
+                conn.execute(sql, params)
+            if not self._transaction_depth:
+                conn.commit()
+
+    def _read(self, image: str, sql: str, params: tuple = ()) -> T.List[tuple]:
+        with self._lock:
+            conn = self._connect(image)
+            if conn is None:
+                return []
+            return conn.execute(sql, (os.path.basename(image),) + params).fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self) -> T.Generator[None, None, None]:
+        with self._lock:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    for conn in self._connections.values():
+                        conn.commit()
+
+    def flags(self, image: str) -> T.Set[str]:
+        rows = self._read(image, "SELECT flag FROM flags WHERE path = ?")
+        return {flag for flag, in rows}
+
+    def directory_flags(
+        self, dirpath: str, filenames: T.Iterable[str]
+    ) -> T.Dict[str, T.Set[str]]:
+        flags: T.Dict[str, T.Set[str]] = {filename: set() for filename in filenames}
+        with self._lock:
+            conn = self._connect_directory(os.path.abspath(dirpath))
+            if conn is None:
+                return flags
+            for path, flag in conn.execute("SELECT path, flag FROM flags"):
+                if path in flags:
+                    flags[path].add(flag)
+        return flags
+
+    def set_flag(self, image: str, flag: str, record_history: bool = False) -> None:
+        path = os.path.basename(image)
+        statements: T.List[T.Tuple[str, tuple]] = [
+            ("INSERT OR IGNORE INTO flags (path, flag) VALUES (?, ?)", (path, flag))
+        ]
+        if record_history:
+            statements.append(
+                (
+                    "INSERT INTO history (path, flag, created_at) VALUES (?, ?, ?)",
+                    (path, flag, _history_suffix()),
+                )
+            )
+        self._write(image, statements)
+
+    def clear_flag(self, image: str, flag: str) -> None:
+        if self._connect(image) is None:
+            return
+        self._write(
+            image,
+            [
+                (
+                    "DELETE FROM flags WHERE path = ? AND flag = ?",
+                    (os.path.basename(image), flag),
+                )
+            ],
+        )
+
+    def has_data(self, image: str, name: str) -> bool:
+        return bool(
+            self._read(image, "SELECT 1 FROM data WHERE path = ? AND name = ?", (name,))
+        )
+
+    def load_data(self, image: str, name: str) -> T.Dict:
+        rows = self._read(
+            image, "SELECT content FROM data WHERE path = ? AND name = ?", (name,)
+        )
+        if not rows:
+            return {}
+        try:
+            return json.loads(rows[0][0])
+        except Exception:
+            return {}
+
+    def save_data(self, image: str, name: str, data: T.Dict[str, T.Any]) -> None:
+        self._write(
+            image,
+            [
+                (
+                    "INSERT OR REPLACE INTO data (path, name, content) VALUES (?, ?, ?)",
+                    (os.path.basename(image), name, _dump_json(data)),
+                )
+            ],
+        )
+
+    def remove_data(self, image: str, name: str) -> None:
+        if self._connect(image) is None:
+            return
+        self._write(
+            image,
+            [
+                (
+                    "DELETE FROM data WHERE path = ? AND name = ?",
+                    (os.path.basename(image), name),
+                )
+            ],
+        )
+
+    def has_state(self, image: str) -> bool:
+        cache_names = sorted(CACHE_DATA_NAMES)
+        placeholders = ", ".join("?" * len(cache_names))
+        return bool(
+            self._read(image, "SELECT 1 FROM flags WHERE path = ? LIMIT 1")
+            or self._read(
+                image,
+                f"SELECT 1 FROM data WHERE path = ? AND name NOT IN ({placeholders}) LIMIT 1",
+                tuple(cache_names),
+            )
+        )
+
+    def move(self, image: str, destination: str) -> None:
+        with self._lock:
+            source = self._connect(image)
+            if source is None:
+                return
+            path = os.path.basename(image)
+            new_path = os.path.basename(destination)
+            tables = ["flags", "data", "history"]
+            rows = {
+                table: source.execute(
+                    f"SELECT * FROM {table} WHERE path = ?", (path,)
+                ).fetchall()
+                for table in tables
+            }
+            target = self._connect(destination, create=True)
+            assert target is not None
+            with self.transaction():
+                for table in tables:
+                    source.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+                    for row in rows[table]:
+                        placeholders = ", ".join("?" * len(row))
+                        target.execute(
+                            f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})",
+                            (new_path,) + tuple(row[1:]),
+                        )
+
+
+def migrate_logs(dirpath: str, conn: sqlite3.Connection) -> int:
+    """
+    Import the .mapillary/logs layout of the directory into the state database.
+    The log files are left untouched. Returns the number of images migrated.
+    """
+    logs_dir = os.path.join(dirpath, ".mapillary", "logs")
+    # the log directories are named after the image file names without extension
+    images_by_stem: T.Dict[str, T.List[str]] = {}
+    for entry in os.scandir(dirpath):
+        if entry.is_file():
+            stem, _ = os.path.splitext(entry.name)
+            images_by_stem.setdefault(stem, []).append(entry.name)
+
+    migrated = 0
+    with conn:
+        for log_entry in os.scandir(logs_dir):
+            if not log_entry.is_dir():
+                continue
+            for path in images_by_stem.get(log_entry.name, [log_entry.name]):
+                for entry in os.scandir(log_entry.path):
+                    if not entry.is_file():
+                        continue
+                    if entry.name.endswith(".json"):
+                        with open(entry.path, "r") as fp:
+                            content = fp.read()
+                        conn.execute(
+                            "INSERT OR REPLACE INTO data (path, name, content) VALUES (?, ?, ?)",
+                            (path, entry.name[: -len(".json")], content),
+                        )
+                        continue
+                    matched = _HISTORY_SUFFIX_REGEX.match(entry.name)
+                    if matched:
+                        conn.execute(
+                            "INSERT INTO history (path, flag, created_at) VALUES (?, ?, ?)",
+                            (path, matched.group(1), matched.group(2)),
+                        )
+                    else:
+                        conn.execute(
+                            "INSERT OR IGNORE INTO flags (path, flag) VALUES (?, ?)",
+                            (path, entry.name),
+                        )
+                migrated += 1
+    LOG.info(f"Migrated the process logs of {migrated} files in {dirpath}")
+    return migrated
+
+
+_STATE: T.Optional[ProcessState] = None
+
+
+def get_process_state() -> ProcessState:
+    global _STATE
+    if _STATE is None:
+        if PROCESS_STATE_BACKEND == "files":
+            _STATE = FileProcessState()
+        elif PROCESS_STATE_BACKEND == "sqlite":
+            _STATE = SQLiteProcessState()
+        else:
+            raise RuntimeError(
+                f"Invalid process state backend {PROCESS_STATE_BACKEND}, expect files or sqlite"
+            )
+    return _STATE
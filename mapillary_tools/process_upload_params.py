@@ -5,8 +5,8 @@ from tqdm import tqdm
 
 from . import login
 from . import processing
-from . import uploader
 from .error import print_error
+from .process_state import get_process_state
 
 
 def process_upload_params(
@@ -72,20 +72,16 @@ def process_upload_params(
         user_upload_token = credentials["user_upload_token"]
         user_key = credentials["MAPSettingsUserKey"]
 
+    state = get_process_state()
     for image in tqdm(process_file_list, desc="Processing image upload parameters"):
         # check the status of the sequence processing
-        log_root = uploader.log_rootpath(image)
-        duplicate_flag_path = os.path.join(log_root, "duplicate")
-        upload_params_path = os.path.join(log_root, "upload_params_process.json")
+        state.remove_data(image, "upload_params_process")
 
-        if os.path.isfile(upload_params_path):
-            os.remove(upload_params_path)
-
-        if os.path.isfile(duplicate_flag_path) or master_upload:
+        if state.has_flag(image, "duplicate") or master_upload:
             continue
 
         upload_params_properties = processing.get_upload_param_properties(
-            log_root, image, user_name, user_upload_token, user_key, verbose
+            image, user_name, user_upload_token, user_key, verbose
         )
 
         processing.create_and_log_process(
@@ -96,7 +92,6 @@ def process_upload_params(
             verbose=verbose,
         )
         # flag manual upload
-        log_manual_upload = os.path.join(log_root, "manual_upload")
-        open(log_manual_upload, "a").close()
+        state.set_flag(image, "manual_upload")
 
     print("Sub process ended")
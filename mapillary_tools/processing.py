@@ -1,11 +1,11 @@
 import base64
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import datetime
+import functools
 import hashlib
 import json
 import os
-import time
 import uuid
 from collections import OrderedDict
 import logging
@@ -15,20 +15,26 @@ from tqdm import tqdm
 
 from . import ipc
 from . import uploader
+from .process_state import get_process_state
 from .error import print_error
-from .exif_read import ExifRead
+from .exif_cache import read_exif
 from .exif_write import ExifEdit
 from .geo import (
     normalize_bearing,
-    interpolate_lat_lon,
-    gps_distance,
+    gps_distance_array,
+    GpsTrace,
     MapillaryInterpolationError,
+    write_gpx,
 )
-from .gps_parser import get_lat_lon_time_from_gpx, get_lat_lon_time_from_nmea
-from .gpx_from_blackvue import gpx_from_blackvue
+from .gps_parser import (
+    get_lat_lon_time_from_gpx,
+    get_lat_lon_time_from_nmea,
+    get_lat_lon_time_from_points,
+)
+from .gpx_from_blackvue import blackvue_trace
 from .gpx_from_exif import gpx_from_exif
-from .gpx_from_gopro import gpx_from_gopro
-from .utils import force_decode
+from .gpx_from_gopro import gopro_trace
+from .utils import force_decode, map_with_workers
 
 """
 auxillary processing functions
@@ -37,6 +43,10 @@ auxillary processing functions
 
 LOG = logging.getLogger()
 
+# the video traces are geotagged from memory, and written as GPX files next to the
+# videos only when asked
+WRITE_VIDEO_GPX = os.getenv("MAPILLARY_TOOLS_WRITE_VIDEO_GPX", "NO") == "YES"
+
 
 def geotag_from_exif(
     process_file_list: List[str],
@@ -44,21 +54,39 @@ def geotag_from_exif(
     offset_time: float = 0.0,
     offset_angle: float = 0.0,
     verbose: bool = False,
+    workers: Optional[int] = None,
+    worker_type: str = "thread",
 ) -> None:
     if offset_time == 0:
-        for image in tqdm(
-            process_file_list, desc="Extracting gps data from image EXIF"
-        ):
-            geotag_properties = get_geotag_properties_from_exif(
-                image, offset_angle, verbose
-            )
+        geotag_properties_list = map_with_workers(
+            functools.partial(
+                get_geotag_properties_from_exif,
+                offset_angle=offset_angle,
+                verbose=verbose,
+            ),
+            process_file_list,
+            workers=workers,
+            worker_type=worker_type,
+            desc="Extracting gps data from image EXIF",
+        )
 
-            create_and_log_process(
-                image, "geotag_process", "success", geotag_properties, verbose
-            )
+        # log in the main thread, in one batch
+        with get_process_state().transaction():
+            for image, geotag_properties in zip(
+                process_file_list, geotag_properties_list
+            ):
+                create_and_log_process(
+                    image, "geotag_process", "success", geotag_properties, verbose
+                )
     else:
         try:
-            geotag_source_path = gpx_from_exif(process_file_list, import_path, verbose)
+            geotag_source_path = gpx_from_exif(
+                process_file_list,
+                import_path,
+                verbose,
+                workers=workers,
+                worker_type=worker_type,
+            )
             if not geotag_source_path or not os.path.isfile(geotag_source_path):
                 raise Exception
         except Exception as e:
@@ -81,7 +109,7 @@ def get_geotag_properties_from_exif(
     image: str, offset_angle: float = 0.0, verbose: bool = False
 ) -> Optional[Dict]:
     try:
-        exif = ExifRead(image)
+        exif = read_exif(image)
     except:
         print_error(
             "Error, EXIF could not be read for image "
@@ -156,6 +184,16 @@ def get_geotag_properties_from_exif(
     return geotag_properties
 
 
+def _video_workers(workers: Optional[int]) -> int:
+    # parsing the telemetry is CPU-bound, so use a process per core by default
+    return workers if workers is not None else (os.cpu_count() or 1)
+
+
+def _write_video_gpx(video: str, points: list) -> None:
+    basename, _ = os.path.splitext(video)
+    write_gpx(basename + ".gpx", points)
+
+
 def geotag_from_gopro_video(
     process_file_list,
     import_path,
@@ -166,6 +204,7 @@ def geotag_from_gopro_video(
     sub_second_interval,
     use_gps_start_time=False,
     verbose=False,
+    workers=None,
 ):
     if geotag_source_path is None:
         raise RuntimeError(
@@ -177,12 +216,20 @@ def geotag_from_gopro_video(
             f"The path specified in geotag_source_path {geotag_source_path} is not a directory"
         )
 
-    # for each video, create gpx trace and geotag the corresponding video
-    # frames
+    # extract the gps traces of the videos in parallel, then for each video,
+    # geotag the corresponding video frames with its trace
     gopro_videos = uploader.get_video_file_list(geotag_source_path)
-    for gopro_video in gopro_videos:
+    gopro_traces = map_with_workers(
+        gopro_trace,
+        gopro_videos,
+        workers=_video_workers(workers),
+        worker_type="process",
+        desc="Extracting gps data from GoPro videos",
+    )
+    for gopro_video, points in zip(gopro_videos, gopro_traces):
         gopro_video_filename, _ = os.path.splitext(os.path.basename(gopro_video))
-        gpx_path = gpx_from_gopro(gopro_video)
+        if WRITE_VIDEO_GPX:
+            _write_video_gpx(gopro_video, points)
 
         process_file_sublist = [
             x
@@ -201,14 +248,15 @@ def geotag_from_gopro_video(
 
         geotag_from_gps_trace(
             process_file_sublist,
-            "gpx",
-            gpx_path,
+            "gopro_videos",
+            gopro_video,
             offset_time,
             offset_angle,
             local_time,
             sub_second_interval,
             use_gps_start_time,
             verbose,
+            gps_points=points,
         )
 
 
@@ -222,6 +270,7 @@ def geotag_from_blackvue_video(
     sub_second_interval,
     use_gps_start_time=False,
     verbose=False,
+    workers=None,
 ):
     if geotag_source_path is None:
         raise RuntimeError(
@@ -233,23 +282,32 @@ def geotag_from_blackvue_video(
             f"The path specified in --geotag_source_path {geotag_source_path} is not a directory"
         )
 
-    # for each video, create gpx trace and geotag the corresponding video
-    # frames
+    # extract the gps traces of the videos in parallel, then for each video,
+    # geotag the corresponding video frames with its trace
     blackvue_videos = uploader.get_video_file_list(geotag_source_path)
-    for blackvue_video in blackvue_videos:
+    blackvue_traces = map_with_workers(
+        functools.partial(blackvue_trace, use_nmea_stream_timestamp=False),
+        blackvue_videos,
+        workers=_video_workers(workers),
+        worker_type="process",
+        desc="Extracting gps data from BlackVue videos",
+    )
+    for blackvue_video, (points, is_stationary_video) in zip(
+        blackvue_videos, blackvue_traces
+    ):
         blackvue_video_filename = (
             os.path.basename(blackvue_video).replace(".mp4", "").replace(".MP4", "")
         )
-        [gpx_path, is_stationary_video] = gpx_from_blackvue(
-            blackvue_video, use_nmea_stream_timestamp=False
-        )
 
-        if not gpx_path or not os.path.isfile(gpx_path):
+        if not points:
             print_error(
                 f"Warning: Skipping blackvue video that has no GPS data found: {blackvue_video}"
             )
             continue
 
+        if WRITE_VIDEO_GPX:
+            _write_video_gpx(blackvue_video, points)
+
         if is_stationary_video:
             print_error(
                 f"Warning: Skipping stationary blackvue video: {blackvue_video}"
@@ -273,14 +331,15 @@ def geotag_from_blackvue_video(
 
         geotag_from_gps_trace(
             process_file_sublist,
-            "gpx",
-            gpx_path,
+            "blackvue_videos",
+            blackvue_video,
             offset_time,
             offset_angle,
             local_time,
             sub_second_interval,
             use_gps_start_time,
             verbose,
+            gps_points=points,
         )
 
 
@@ -294,23 +353,29 @@ def geotag_from_gps_trace(
     sub_second_interval=0.0,
     use_gps_start_time=False,
     verbose=False,
+    gps_points=None,
 ):
-    if geotag_source == "gpx":
-        file_desc = "a GPX file"
-    elif geotag_source == "nmea":
-        file_desc = "an NMEA file"
-    else:
-        raise RuntimeError(f"Invalid geotag source {geotag_source}")
+    """
+    Geotag the images with the gps trace read from the file geotag_source_path, or
+    with gps_points, the points already extracted from it (e.g. from a video)
+    """
+    if gps_points is None:
+        if geotag_source == "gpx":
+            file_desc = "a GPX file"
+        elif geotag_source == "nmea":
+            file_desc = "an NMEA file"
+        else:
+            raise RuntimeError(f"Invalid geotag source {geotag_source}")
 
-    if geotag_source_path is None:
-        raise RuntimeError(
-            f"{file_desc} is required to be specified in --geotag_source_path",
-        )
+        if geotag_source_path is None:
+            raise RuntimeError(
+                f"{file_desc} is required to be specified in --geotag_source_path",
+            )
 
-    if not os.path.isfile(geotag_source_path):
-        raise RuntimeError(
-            f"The path specified in geotag_source_path {geotag_source_path} is not {file_desc}"
-        )
+        if not os.path.isfile(geotag_source_path):
+            raise RuntimeError(
+                f"The path specified in geotag_source_path {geotag_source_path} is not {file_desc}"
+            )
 
     # print time now to warn in case local_time
     if local_time:
@@ -325,7 +390,9 @@ def geotag_from_gps_trace(
         )
 
     # read gps file to get track locations
-    if geotag_source == "gpx":
+    if gps_points is not None:
+        gps_trace = get_lat_lon_time_from_points(gps_points, local_time)
+    elif geotag_source == "gpx":
         gps_trace = get_lat_lon_time_from_gpx(geotag_source_path, local_time)
     elif geotag_source == "nmea":
         gps_trace = get_lat_lon_time_from_nmea(geotag_source_path, local_time)
@@ -341,7 +408,7 @@ def geotag_from_gps_trace(
         )
         return
 
-    pairs = [(ExifRead(f).extract_capture_time(), f) for f in process_file_list]
+    pairs = [(read_exif(f).extract_capture_time(), f) for f in process_file_list]
 
     if use_gps_start_time:
         filtered_pairs: List[Tuple[datetime.datetime, str]] = [
@@ -355,6 +422,21 @@ def geotag_from_gps_trace(
                 f"Use GPS start time, which is same as using offset_time={offset_time}"
             )
 
+    trace = GpsTrace(gps_trace)
+    try:
+        interpolations: Optional[Iterator[Tuple]] = iter(
+            trace.interpolate_many(
+                [
+                    capture_time - datetime.timedelta(seconds=offset_time)
+                    for capture_time, _ in pairs
+                    if capture_time is not None
+                ]
+            )
+        )
+    except MapillaryInterpolationError:
+        # interpolate the images one by one below to report the failed image
+        interpolations = None
+
     for capture_time, image in tqdm(
         pairs,
         desc="Inserting gps data into image EXIF",
@@ -365,7 +447,12 @@ def geotag_from_gps_trace(
         else:
             try:
                 geotag_properties = get_geotag_properties_from_gps_trace(
-                    image, capture_time, gps_trace, offset_angle, offset_time
+                    image,
+                    capture_time,
+                    trace,
+                    offset_angle,
+                    offset_time,
+                    interpolation=next(interpolations) if interpolations else None,
                 )
             except MapillaryInterpolationError as ex:
                 raise RuntimeError(
@@ -384,13 +471,18 @@ def geotag_from_gps_trace(
 def get_geotag_properties_from_gps_trace(
     image,
     capture_time: datetime.datetime,
-    gps_trace: list,
+    gps_trace: Union[list, GpsTrace],
     offset_angle=0.0,
     offset_time=0.0,
+    interpolation: Optional[Tuple] = None,
 ) -> dict:
     capture_time = capture_time - datetime.timedelta(seconds=offset_time)
 
-    lat, lon, bearing, elevation = interpolate_lat_lon(gps_trace, capture_time)
+    if interpolation is None:
+        if not isinstance(gps_trace, GpsTrace):
+            gps_trace = GpsTrace(gps_trace)
+        interpolation = gps_trace.interpolate(capture_time)
+    lat, lon, bearing, elevation = interpolation
 
     geotag_properties = {
         "MAPLatitude": lat,
@@ -414,14 +506,14 @@ def get_geotag_properties_from_gps_trace(
 
 
 def get_upload_param_properties(
-    log_root: str,
     image: str,
     user_name: str,
     user_upload_token: str,
     user_key: str,
     verbose: bool = False,
 ) -> Optional[Dict]:
-    if not os.path.isdir(log_root):
+    state = get_process_state()
+    if not state.has_state(image):
         print(
             "Warning, sequence process has not been done for image "
             + image
@@ -430,8 +522,7 @@ def get_upload_param_properties(
         return None
 
     # check if geotag process was a success
-    log_sequence_process_success = os.path.join(log_root, "sequence_process_success")
-    if not os.path.isfile(log_sequence_process_success):
+    if not state.has_flag(image, "sequence_process_success"):
         print(
             "Warning, sequence process failed for image "
             + image
@@ -439,14 +530,9 @@ def get_upload_param_properties(
         )
         return None
 
-    upload_params_process_success_path = os.path.join(
-        log_root, "upload_params_process_success"
-    )
-
     # load the sequence json
-    user_process_json_path = os.path.join(log_root, "user_process.json")
     try:
-        user_data = load_json(user_process_json_path)
+        user_data = state.load_data(image, "user_process")
     except:
         print(
             f"Warning, user data not read for image {image}, therefore it will not be included in the upload params processing."
@@ -464,9 +550,8 @@ def get_upload_param_properties(
     private = user_data.get("MAPPrivate", False)
 
     # load the sequence json
-    sequence_process_json_path = os.path.join(log_root, "sequence_process.json")
     try:
-        sequence_data = load_json(sequence_process_json_path)
+        sequence_data = state.load_data(image, "sequence_process")
     except:
         print(
             "Warning, sequence data not read for image "
@@ -497,15 +582,13 @@ def get_upload_param_properties(
     x = base64.b64encode(image.encode("utf-8")).decode("utf-8")
     s = f"{user_upload_token}{user_key}{x}"
     settings_upload_hash = hashlib.sha256(s.encode("utf-8")).hexdigest()
-    save_json(
-        {"MAPSettingsUploadHash": settings_upload_hash},
-        os.path.join(log_root, "settings_upload_hash.json"),
+    state.save_data(
+        image, "settings_upload_hash", {"MAPSettingsUploadHash": settings_upload_hash}
     )
     return upload_params
 
 
 def get_final_mapillary_image_description(
-    log_root: str,
     image: str,
     master_upload: bool = False,
     verbose: bool = False,
@@ -526,12 +609,12 @@ def get_final_mapillary_image_description(
         "import_meta_data_process",
     ]
     final_mapillary_image_description = {}
+    state = get_process_state()
+    flags = state.flags(image)
 
     for sub_command in sub_commands:
-        sub_command_status = os.path.join(log_root, sub_command + "_failed")
-
         if (
-            os.path.isfile(sub_command_status)
+            sub_command + "_failed" in flags
             and sub_command != "import_meta_data_process"
         ):
             LOG.warning(
@@ -540,9 +623,8 @@ def get_final_mapillary_image_description(
             )
             return None
 
-        sub_command_data_path = os.path.join(log_root, sub_command + ".json")
         if (
-            not os.path.isfile(sub_command_data_path)
+            not state.has_data(image, sub_command)
             and sub_command != "import_meta_data_process"
         ):
             if (
@@ -562,11 +644,11 @@ def get_final_mapillary_image_description(
         ):
             continue
         try:
-            sub_command_data = load_json(sub_command_data_path)
+            sub_command_data = state.load_data(image, sub_command)
             if not sub_command_data:
                 if verbose:
                     LOG.warning(
-                        f"Warning, no data read from json file {sub_command_data_path}",
+                        f"Warning, no {sub_command} data read for image {image}",
                         exc_info=True,
                     )
                 return None
@@ -575,13 +657,13 @@ def get_final_mapillary_image_description(
         except Exception:
             if sub_command == "import_meta_data_process":
                 LOG.warning(
-                    "Warning, could not load json file " + sub_command_data_path,
+                    f"Warning, could not load {sub_command} data for image {image}",
                     exc_info=True,
                 )
                 continue
             else:
                 LOG.warning(
-                    "Warning, could not load json file " + sub_command_data_path,
+                    f"Warning, could not load {sub_command} data for image {image}",
                     exc_info=True,
                 )
                 return None
@@ -643,15 +725,15 @@ def get_final_mapillary_image_description(
     return final_mapillary_image_description
 
 
-def get_geotag_data(log_root: str, image: str, verbose: bool = False) -> Optional[Dict]:
-    if not os.path.isdir(log_root):
+def get_geotag_data(image: str, verbose: bool = False) -> Optional[Dict]:
+    state = get_process_state()
+    if not state.has_state(image):
         if verbose:
             print("Warning, no logs for image " + image)
         return None
 
     # check if geotag process was a success
-    log_geotag_process_success = os.path.join(log_root, "geotag_process_success")
-    if not os.path.isfile(log_geotag_process_success):
+    if not state.has_flag(image, "geotag_process_success"):
         print(
             "Warning, geotag process failed for image "
             + image
@@ -659,9 +741,8 @@ def get_geotag_data(log_root: str, image: str, verbose: bool = False) -> Optiona
         )
         return None
     # load the geotag json
-    geotag_process_json_path = os.path.join(log_root, "geotag_process.json")
     try:
-        geotag_data = load_json(geotag_process_json_path)
+        geotag_data = state.load_data(image, "geotag_process")
         return geotag_data
     except:
         if verbose:
@@ -720,13 +801,9 @@ def get_process_file_list(
     rerun: bool = False,
     skip_subfolders: bool = False,
 ) -> List[str]:
-    files = uploader.iterate_files(import_path, not skip_subfolders)
-    sorted_files = sorted(
-        file
-        for file in files
-        if uploader.is_image_file(file) and preform_process(file, process, rerun)
+    return uploader.StatusIndex(import_path, skip_subfolders).process_file_list(
+        process, rerun
     )
-    return sorted_files
 
 
 def get_process_status_file_list(
@@ -735,41 +812,29 @@ def get_process_status_file_list(
     status: str,
     skip_subfolders: bool = False,
 ) -> List[str]:
-    files = uploader.iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file
-        for file in files
-        if uploader.is_image_file(file) and process_status(file, process, status)
+    return uploader.StatusIndex(import_path, skip_subfolders).process_status_file_list(
+        process, status
     )
 
 
 def process_status(file_path: str, process: str, status: str) -> bool:
-    log_root = uploader.log_rootpath(file_path)
-    status_file = os.path.join(log_root, process + "_" + status)
-    return os.path.isfile(status_file)
+    return get_process_state().has_flag(file_path, process + "_" + status)
 
 
 def get_duplicate_file_list(
     import_path: str, skip_subfolders: bool = False
 ) -> List[str]:
-    files = uploader.iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file for file in files if uploader.is_image_file(file) and is_duplicate(file)
-    )
+    return uploader.StatusIndex(import_path, skip_subfolders).duplicate_file_list()
 
 
 def is_duplicate(file_path: str) -> bool:
-    log_root = uploader.log_rootpath(file_path)
-    duplicate_flag_path = os.path.join(log_root, "duplicate")
-    return os.path.isfile(duplicate_flag_path)
+    return get_process_state().has_flag(file_path, "duplicate")
 
 
 def preform_process(file_path: str, process: str, rerun: bool = False) -> bool:
-    log_root = uploader.log_rootpath(file_path)
-    process_succes = os.path.join(log_root, process + "_success")
-    upload_succes = os.path.join(log_root, "upload_success")
-    preform = not os.path.isfile(upload_succes) and (
-        not os.path.isfile(process_succes) or rerun
+    flags = get_process_state().flags(file_path)
+    preform = "upload_success" not in flags and (
+        process + "_success" not in flags or rerun
     )
     return preform
 
@@ -803,28 +868,18 @@ def video_upload(video_file, import_path, verbose=False):
 
 
 def create_and_log_video_process(video_file, import_path):
-    log_root = uploader.log_rootpath(video_file)
-    if not os.path.isdir(log_root):
-        os.makedirs(log_root)
-    # set the log flags for process
-    log_process = os.path.join(log_root, "video_process.json")
+    state = get_process_state()
     import_paths = video_import_paths(video_file)
     if import_path in import_paths:
         return
     import_paths.append(import_path)
-    video_process = load_json(log_process)
+    video_process = state.load_data(video_file, "video_process")
     video_process.update({"sample_paths": import_paths})
-    save_json(video_process, log_process)
+    state.save_data(video_file, "video_process", video_process)
 
 
 def video_import_paths(video_file):
-    log_root = uploader.log_rootpath(video_file)
-    if not os.path.isdir(log_root):
-        return []
-    log_process = os.path.join(log_root, "video_process.json")
-    if not os.path.isfile(log_process):
-        return []
-    video_process = load_json(log_process)
+    video_process = get_process_state().load_data(video_file, "video_process")
     if "sample_paths" in video_process:
         return video_process["sample_paths"]
     return []
@@ -853,43 +908,28 @@ def create_and_log_process(
     if mapillary_description is None:
         mapillary_description = {}
 
-    # set log path
-    log_root = uploader.log_rootpath(image)
-    # make all the dirs if not there
-    if not os.path.isdir(log_root):
-        os.makedirs(log_root)
-
-    # set the log flags for process
-    log_process = os.path.join(log_root, process)
-    log_process_succes = f"{log_process}_success"
-    log_process_failed = f"{log_process}_failed"
-    log_MAPJson = os.path.join(log_root, process + ".json")
+    state = get_process_state()
 
     if not mapillary_description:
         status = "failed"
 
-    if status == "success":
-        suffix = str(time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime()))
-        save_json(mapillary_description, log_MAPJson)
-        open(log_process_succes, "w").close()
-        open(f"{log_process_succes}_{suffix}", "w").close()
-        # if there is a failed log from before, remove it
-        if os.path.isfile(log_process_failed):
-            os.remove(log_process_failed)
-    else:
-        open(log_process_failed, "w").close()
-        suffix = str(time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime()))
-        open(f"{log_process_failed}_{suffix}", "w").close()
-        # if there is a success log from before, remove it
-        if os.path.isfile(log_process_succes):
-            os.remove(log_process_succes)
-        # if there is meta data from before, remove it
-        if os.path.isfile(log_MAPJson):
-            if verbose:
-                print(
-                    f"Warning, {process} in this run has failed, previously generated properties will be removed."
-                )
-            os.remove(log_MAPJson)
+    with state.transaction():
+        if status == "success":
+            state.save_data(image, process, mapillary_description)
+            state.set_flag(image, f"{process}_success", record_history=True)
+            # if there is a failed log from before, remove it
+            state.clear_flag(image, f"{process}_failed")
+        else:
+            state.set_flag(image, f"{process}_failed", record_history=True)
+            # if there is a success log from before, remove it
+            state.clear_flag(image, f"{process}_success")
+            # if there is meta data from before, remove it
+            if state.has_data(image, process):
+                if verbose:
+                    print(
+                        f"Warning, {process} in this run has failed, previously generated properties will be removed."
+                    )
+                state.remove_data(image, process)
 
     decoded_image = force_decode(image)
 
@@ -912,9 +952,9 @@ def load_geotag_points(
     lons = []
     directions = []
 
+    state = get_process_state()
     for image in tqdm(process_file_list, desc="Loading geotag points"):
-        log_root = uploader.log_rootpath(image)
-        geotag_data = get_geotag_data(log_root, image, verbose)
+        geotag_data = get_geotag_data(image, verbose)
         if not geotag_data:
             create_and_log_process(image, "sequence_process", "failed", verbose=verbose)
             continue
@@ -933,9 +973,7 @@ def load_geotag_points(
         ) if "MAPCompassHeading" in geotag_data else directions.append(0.0)
 
         # remove previously created duplicate flags
-        duplicate_flag_path = os.path.join(log_root, "duplicate")
-        if os.path.isfile(duplicate_flag_path):
-            os.remove(duplicate_flag_path)
+        state.clear_flag(image, "duplicate")
 
     return file_list, capture_times, lats, lons, directions
 
@@ -975,7 +1013,7 @@ def split_sequences(
         capture_deltas = [t2 - t1 for t1, t2 in zip(capture_times, capture_times[1:])]
 
         # distance between consecutive images
-        distances = [gps_distance(ll1, ll2) for ll1, ll2 in zip(latlons, latlons[1:])]
+        distances = gps_distance_array(lats[:-1], lons[:-1], lats[1:], lons[1:])
 
         # if cutoff time is given use that, else assume cutoff is
         # 1.5x median time delta
@@ -1072,7 +1110,7 @@ def get_images_geotags(process_file_list):
     geotags = []
     missing_geotags = []
     for image in tqdm(sorted(process_file_list), desc="Reading gps data"):
-        exif = ExifRead(image)
+        exif = read_exif(image)
         timestamp = exif.extract_capture_time()
         lon, lat = exif.extract_lon_lat()
         altitude = exif.extract_altitude()
@@ -0,0 +1,164 @@
+import datetime
+import re
+import threading
+import time
+import typing as T
+
+"""
+Limit the upload rate with a token bucket shared by all uploads of a run.
+
+The rate may change with the time of day, following a schedule such as
+"08:00-18:00=512K,2M": at most 512 KiB/s during office hours and 2 MiB/s otherwise.
+The chunks are sent in blocks that each take their bytes from the bucket, so the
+limit applies while the chunk is being sent, and the request still completes as a
+whole for the progress callbacks.
+"""
+
+
+# bytes sent for each draw from the bucket
+BLOCK_SIZE = 64 * 1024
+# the bucket holds up to this number of seconds of the rate
+BURST_SECONDS = 1.0
+
+_RATE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+_RATE_REGEX = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?$", re.IGNORECASE)
+_WINDOW_REGEX = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$")
+
+
+def parse_rate(text: str) -> T.Optional[float]:
+    """
+    Parse a rate in bytes per second, such as 500000, 512K or 1.5M (binary units),
+    or "unlimited" for no limit
+    """
+    text = text.strip()
+    if text.lower() == "unlimited":
+        return None
+    match = _RATE_REGEX.match(text)
+    if not match:
+        raise ValueError(f"Invalid upload rate {text}, expect e.g. 512K or 2M")
+    rate = float(match.group(1)) * _RATE_UNITS[match.group(2).upper()]
+    if rate <= 0:
+        raise ValueError(f"Invalid upload rate {text}, expect a positive rate")
+    return rate
+
+
+class RateSchedule:
+    """
+    Upload rate by time of day: the rate of the first window that contains the time,
+    or the default rate. A window ends before its start if it spans midnight, and
+    None means no limit.
+    """
+
+    def __init__(
+        self,
+        default: T.Optional[float],
+        windows: T.Optional[
+            T.List[T.Tuple[datetime.time, datetime.time, T.Optional[float]]]
+        ] = None,
+    ) -> None:
+        self.default = default
+        self.windows = windows or []
+
+    def rate_at(self, t: datetime.time) -> T.Optional[float]:
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= t < end:
+                    return rate
+            else:
+                if t >= start or t < end:
+                    return rate
+        return self.default
+
+
+def parse_schedule(text: str) -> RateSchedule:
+    """
+    Parse a comma separated list of HH:MM-HH:MM=RATE windows and at most one RATE
+    for the rest of the day (unlimited if omitted)
+    """
+    default: T.Optional[float] = None
+    has_default = False
+    windows = []
+    for item in text.split(","):
+        item = item.strip()
+        match = _WINDOW_REGEX.match(item)
+        if match:
+            start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+            try:
+                start = datetime.time(int(start_hour), int(start_minute))
+                end = datetime.time(int(end_hour), int(end_minute))
+            except ValueError:
+                raise ValueError(f"Invalid time window {item}")
+            windows.append((start, end, parse_rate(rate)))
+        else:
+            if has_default:
+                raise ValueError(f"Multiple default upload rates in {text}")
+            default = parse_rate(item)
+            has_default = True
+    return RateSchedule(default, windows)
+
+
+class TokenBucket:
+    """
+    Token bucket of bytes, filled at the scheduled rate. A draw larger than the
+    bucket borrows from the next refills, and the caller sleeps until they are
+    filled, so concurrent senders share the rate in the order they draw.
+    """
+
+    def __init__(
+        self,
+        schedule: RateSchedule,
+        clock: T.Callable[[], float] = time.monotonic,
+        sleep: T.Callable[[float], None] = time.sleep,
+        now: T.Callable[[], datetime.datetime] = datetime.datetime.now,
+    ) -> None:
+        self.schedule = schedule
+        self._clock = clock
+        self._sleep = sleep
+        self._now = now
+        self._tokens = 0.0
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> float:
+        """
+        Take nbytes from the bucket, and return the seconds to wait before sending
+        them
+        """
+        with self._lock:
+            current = self._clock()
+            rate = self.schedule.rate_at(self._now().time())
+            elapsed = current - self._last
+            self._last = current
+            if rate is None:
+                self._tokens = 0.0
+                return 0.0
+            capacity = max(rate * BURST_SECONDS, BLOCK_SIZE)
+            self._tokens = min(capacity, self._tokens + elapsed * rate)
+            self._tokens -= nbytes
+            return -self._tokens / rate if self._tokens < 0 else 0.0
+
+    def consume(self, nbytes: int) -> None:
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            self._sleep(wait)
+
+
+class ThrottledData:
+    """
+    Request body that sends the chunk in blocks drawn from the bucket. It has a
+    length, so the request is sent with Content-Length instead of chunked.
+    """
+
+    def __init__(self, chunk: bytes, bucket: TokenBucket) -> None:
+        self.chunk = chunk
+        self.bucket = bucket
+
+    def __len__(self) -> int:
+        return len(self.chunk)
+
+    def __iter__(self) -> T.Iterator[bytes]:
+        view = memoryview(self.chunk)
+        for start in range(0, len(view), BLOCK_SIZE):
+            block = view[start : start + BLOCK_SIZE]
+            self.bucket.consume(len(block))
+            yield bytes(block)
@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import email.utils
+import logging
+import os
+import random
+import time
+import typing as T
+
+"""
+Retry policy of the upload requests.
+
+The delay before each retry is drawn uniformly between zero and an exponentially
+growing bound (full jitter), so that the uploads that failed together after a
+server blip do not retry together. An error is retried if it is a connection error,
+or an HTTP error with a retryable status (408, 429 and 5xx), as long as neither the
+number of attempts nor the deadline is exhausted. A Retry-After header of the
+response replaces the drawn delay.
+"""
+
+
+LOG = logging.getLogger()
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("MAPILLARY_TOOLS_RETRY_MAX_ATTEMPTS", 200))
+# the bound of the delay doubles from the base on every attempt up to the cap
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = float(os.getenv("MAPILLARY_TOOLS_RETRY_MAX_SECONDS", 16))
+# seconds spent retrying an operation since its last progress
+RETRY_DEADLINE = float(os.getenv("MAPILLARY_TOOLS_RETRY_DEADLINE", 3600))
+RETRYABLE_STATUS_CODES = frozenset([408, 429] + list(range(500, 600)))
+
+
+def _status_code(ex: BaseException) -> T.Optional[int]:
+    response = getattr(ex, "response", None)
+    if response is None:
+        return None
+    return getattr(response, "status_code", None)
+
+
+def parse_retry_after(value: str, now: T.Optional[datetime.datetime] = None) -> float:
+    """
+    Parse the Retry-After header, in seconds or an HTTP date, to the seconds to
+    wait
+    """
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        raise ValueError(f"Invalid Retry-After {value}")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0.0)
+
+
+class RetryPolicy:
+    """
+    Which errors are retried, and for how long. The errors without a status code
+    are retried if they are instances of retryable_errors, the others if their
+    status code is retryable.
+    """
+
+    def __init__(
+        self,
+        retryable_errors: T.Tuple[T.Type[BaseException], ...] = (ConnectionError,),
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_seconds: float = RETRY_BASE_SECONDS,
+        max_seconds: float = RETRY_MAX_SECONDS,
+        deadline: T.Optional[float] = RETRY_DEADLINE,
+        status_codes: T.AbstractSet[int] = RETRYABLE_STATUS_CODES,
+        clock: T.Callable[[], float] = time.monotonic,
+        uniform: T.Callable[[float, float], float] = random.uniform,
+    ) -> None:
+        if max_attempts < 1:
+            raise ValueError(f"Invalid number of attempts {max_attempts}")
+        self.retryable_errors = retryable_errors
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.deadline = deadline
+        self.status_codes = status_codes
+        self.clock = clock
+        self.uniform = uniform
+
+    def is_retryable(self, ex: BaseException) -> bool:
+        status_code = _status_code(ex)
+        if status_code is not None:
+            return status_code in self.status_codes
+        return isinstance(ex, self.retryable_errors)
+
+    def retry_after(self, ex: BaseException) -> T.Optional[float]:
+        response = getattr(ex, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        value = headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return parse_retry_after(value)
+        except ValueError:
+            LOG.debug(f"Ignoring the invalid Retry-After {value}")
+            return None
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Draw the delay before the given retry, starting from 1
+        """
+        bound = min(self.base_seconds * 2**attempt, self.max_seconds)
+        return self.uniform(0, bound)
+
+    def start(self) -> "Retrying":
+        return Retrying(self)
+
+    def call(
+        self,
+        func: T.Callable[[], T.Any],
+        sleep: T.Callable[[float], None] = time.sleep,
+        desc: str = "request",
+    ) -> T.Any:
+        """
+        Call func until it succeeds, sleeping between the retries
+        """
+        retrying = self.start()
+        while True:
+            try:
+                return func()
+            except Exception as ex:
+                delay = retrying.next_delay(ex)
+                if delay is None:
+                    raise
+                retrying.log(desc, delay)
+                sleep(delay)
+
+    async def call_async(
+        self,
+        func: T.Callable[[], T.Awaitable[T.Any]],
+        desc: str = "request",
+    ) -> T.Any:
+        """
+        Await func until it succeeds, sleeping between the retries without
+        blocking the event loop
+        """
+        retrying = self.start()
+        while True:
+            try:
+                return await func()
+            except Exception as ex:
+                delay = retrying.next_delay(ex)
+                if delay is None:
+                    raise
+                retrying.log(desc, delay)
+                await asyncio.sleep(delay)
+
+
+class Retrying:
+    """
+    Retries of one operation. reset() restarts the attempts and the deadline, when
+    the operation makes progress.
+    """
+
+    def __init__(self, policy: RetryPolicy) -> None:
+        self.policy = policy
+        self.reset()
+
+    def reset(self) -> None:
+        self.attempt = 0
+        self.started = self.policy.clock()
+
+    def next_delay(self, ex: BaseException) -> T.Optional[float]:
+        """
+        Return the seconds to wait before retrying after the error, or None if it
+        is not retried
+        """
+        policy = self.policy
+        if not policy.is_retryable(ex) or self.attempt + 1 >= policy.max_attempts:
+            return None
+        self.attempt += 1
+        delay = policy.retry_after(ex)
+        if delay is None:
+            delay = policy.backoff(self.attempt)
+        if policy.deadline is not None:
+            elapsed = policy.clock() - self.started
+            if elapsed + delay > policy.deadline:
+                return None
+        return delay
+
+    def log(self, desc: str, delay: float) -> None:
+        LOG.warning(
+            f"Error in {desc}, retrying in {delay:.1f} seconds (attempt {self.attempt + 1} of {self.policy.max_attempts})",
+            exc_info=True,
+        )
@@ -1,20 +1,59 @@
-import json
+import logging
 import os
+import sqlite3
 import sys
 
 from . import uploader
+from . import upload_scheduler
+from . import rate_limit
+from . import jpeg_optimize
+from . import upload_async
+from . import upload_ledger
+from . import upload_api_v4_async
 from . import processing
 from . import exif_read
+from .exif_cache import read_exif
+from .process_state import get_process_state
+
+LOG = logging.getLogger()
 
 
 def verify_mapillary_tag(filepath):
+    """
+    Check that image file has the required Mapillary tag
+    """
     filepath_keep_original = processing.processed_images_rootpath(filepath)
     if os.path.isfile(filepath_keep_original):
-        filepath = filepath_keep_original
+        # the copies are not tracked in the process state, hence not cached
+        return exif_read.ExifRead(filepath_keep_original).mapillary_tag_exists()
+    return read_exif(filepath).mapillary_tag_exists()
+
+
+def skip_uploaded_images(list_per_sequence_mapping, params, dry_run=False):
     """
-    Check that image file has the required Mapillary tag
+    Drop the images uploaded before according to the upload ledger, and flag them
+    as uploaded unless it is a dry run. All images are kept if the ledger can not
+    be read
     """
-    return exif_read.ExifRead(filepath).mapillary_tag_exists()
+    try:
+        list_per_sequence_mapping, skipped = upload_ledger.skip_uploaded(
+            list_per_sequence_mapping, params
+        )
+    except sqlite3.Error:
+        LOG.warning(
+            "Error reading the upload ledger, uploading all images", exc_info=True
+        )
+        return list_per_sequence_mapping
+
+    if skipped:
+        print(
+            f"Skipping {len(skipped)} images uploaded before according to the upload ledger"
+        )
+        if not dry_run:
+            for image in skipped:
+                uploader.create_upload_log(image, "upload_success")
+            uploader.flag_finalization(skipped)
+    return list_per_sequence_mapping
 
 
 def upload(
@@ -24,6 +63,11 @@ def upload(
     max_attempts=None,
     video_import_path=None,
     dry_run=False,
+    zip_compression="auto",
+    read_ahead_chunks=0,
+    max_upload_rate=None,
+    optimize_jpeg=False,
+    upload_engine="threads",
 ):
     """
     Upload local images to Mapillary
@@ -31,11 +75,42 @@ def upload(
         import_path: Directory path to where the images are stored.
         verbose: Print extra warnings and errors.
         skip_subfolders: Skip images stored in subdirectories.
+        number_threads: Number of sequences uploaded concurrently, probed if not specified.
+        zip_compression: Compression of the uploaded zip archives (stored, deflate or auto).
+        read_ahead_chunks: Number of chunks of a sequence read ahead while a chunk is uploaded.
+        max_upload_rate: Upload rate limit, e.g. 2M, or a time of day schedule such as 08:00-18:00=512K,2M.
+        optimize_jpeg: Upload losslessly optimized copies of the images (requires jpegtran).
+        upload_engine: Upload the sequences in a pool of threads ("threads") or on an event loop ("async", requires httpx).
 
     Returns:
         Images are uploaded to Mapillary and flagged locally as uploaded.
     """
 
+    rate_schedule = None
+    if max_upload_rate is not None:
+        try:
+            rate_schedule = rate_limit.parse_schedule(max_upload_rate)
+        except ValueError as ex:
+            print(f"Error, {ex}, exiting...")
+            sys.exit(1)
+
+    if optimize_jpeg:
+        try:
+            jpeg_optimize.check_jpegtran()
+        except RuntimeError as ex:
+            print(f"Error, {ex}, exiting...")
+            sys.exit(1)
+
+    if upload_engine == "async":
+        try:
+            upload_api_v4_async.check_httpx()
+        except RuntimeError as ex:
+            print(f"Error, {ex}, exiting...")
+            sys.exit(1)
+    elif upload_engine != "threads":
+        print(f"Error, invalid upload engine {upload_engine}, exiting...")
+        sys.exit(1)
+
     # in case of video processing, adjust the import path
     if video_import_path:
         # sanity check if video file is passed
@@ -66,14 +141,11 @@ def upload(
         sys.exit(1)
 
     # get list of file to process
-    total_file_list = uploader.get_total_file_list(import_path, skip_subfolders)
-    upload_file_list = uploader.get_upload_file_list(import_path, skip_subfolders)
-    success_file_list = uploader.get_success_upload_file_list(
-        import_path, skip_subfolders
-    )
-    to_finalize_file_list = uploader.get_finalize_file_list(
-        import_path, skip_subfolders
-    )
+    status_index = uploader.StatusIndex(import_path, skip_subfolders)
+    total_file_list = status_index.total_file_list()
+    upload_file_list = status_index.upload_file_list()
+    success_file_list = status_index.success_upload_file_list()
+    to_finalize_file_list = status_index.finalize_file_list()
 
     if len(success_file_list) == len(total_file_list):
         print("All images have already been uploaded")
@@ -95,31 +167,22 @@ def upload(
             params = {}
             list_per_sequence_mapping = {}
             direct_upload_file_list = []
+            state = get_process_state()
             for image in upload_file_list:
-                log_root = uploader.log_rootpath(image)
-
                 # read upload params
-                upload_params_path = os.path.join(
-                    log_root, "upload_params_process.json"
-                )
-                if os.path.isfile(upload_params_path):
-                    with open(upload_params_path, "r") as fp:
-                        params[image] = json.load(fp)
+                if state.has_data(image, "upload_params_process"):
+                    params[image] = state.load_data(image, "upload_params_process")
                     sequence = params[image]["key"]
                     list_per_sequence_mapping.setdefault(sequence, []).append(image)
                 else:
                     direct_upload_file_list.append(image)
 
                 # read image descriptions
-                description_path = os.path.join(
-                    log_root, "mapillary_image_description.json"
-                )
-                if not os.path.isfile(description_path):
+                if not state.has_data(image, "mapillary_image_description"):
                     raise RuntimeError(
-                        f"Please run process first because {description_path} is not generated"
+                        f"Please run process first because the image description of {image} is not generated"
                     )
-                with open(description_path, "r") as fp:
-                    description = json.load(fp)
+                description = state.load_data(image, "mapillary_image_description")
                 assert not set(description).intersection(
                     params.get(image, {})
                 ), f"Parameter conflicting {description} and {params.get(image, {})}"
@@ -137,35 +200,44 @@ def upload(
                     f"Found {len(direct_upload_file_list)} files for direct upload which is not supported in v4"
                 )
 
-            total_sequences = len(list_per_sequence_mapping)
-            for idx, sequence_uuid in enumerate(list_per_sequence_mapping):
-                metadata = {
-                    "total_sequences": total_sequences,
-                    "sequence_idx": idx,
-                }
-                uploader.upload_sequence_v4(
-                    list_per_sequence_mapping[sequence_uuid],
-                    sequence_uuid,
+            if upload_ledger.UPLOAD_LEDGER_ENABLED:
+                list_per_sequence_mapping = skip_uploaded_images(
+                    list_per_sequence_mapping, params, dry_run=dry_run
+                )
+
+            if upload_engine == "async":
+                upload_async.upload_sequences(
+                    list_per_sequence_mapping,
+                    params,
+                    concurrency=number_threads,
+                    dry_run=dry_run,
+                    zip_compression=zip_compression,
+                    rate_schedule=rate_schedule,
+                    optimize_jpeg=optimize_jpeg,
+                )
+            else:
+                upload_scheduler.upload_sequences(
+                    list_per_sequence_mapping,
                     params,
-                    metadata=metadata,
+                    number_threads=number_threads,
                     dry_run=dry_run,
+                    zip_compression=zip_compression,
+                    read_ahead_chunks=read_ahead_chunks,
+                    rate_schedule=rate_schedule,
+                    optimize_jpeg=optimize_jpeg,
                 )
 
         if to_finalize_file_list:
             params = {}
             sequences = []
+            state = get_process_state()
             for image in to_finalize_file_list:
-                log_root = uploader.log_rootpath(image)
-                upload_params_path = os.path.join(
-                    log_root, "upload_params_process.json"
-                )
-                if os.path.isfile(upload_params_path):
-                    with open(upload_params_path, "rb") as jf:
-                        image_params = json.load(jf)
-                        sequence = image_params["key"]
-                        if sequence not in sequences:
-                            params[image] = image_params
-                            sequences.append(sequence)
+                if state.has_data(image, "upload_params_process"):
+                    image_params = state.load_data(image, "upload_params_process")
+                    sequence = image_params["key"]
+                    if sequence not in sequences:
+                        params[image] = image_params
+                        sequences.append(sequence)
 
             uploader.flag_finalization(to_finalize_file_list)
 
@@ -1,14 +1,170 @@
 import requests
+import logging
 import os
 import io
+import threading
+import time
 import typing as T
+from collections import deque
+from concurrent import futures
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from .api_v4 import MAPILLARY_GRAPH_API_ENDPOINT
+from .rate_limit import ThrottledData, TokenBucket
+from .retry import RetryPolicy
 
 MAPILLARY_UPLOAD_ENDPOINT = os.getenv(
     "MAPILLARY_UPLOAD_ENDPOINT", "https://rupload.facebook.com/mapillary_public_uploads"
 )
 DEFAULT_CHUNK_SIZE = 1024 * 1024 * 64
+# the number of connections kept alive per host
+UPLOAD_POOL_SIZE = int(os.getenv("MAPILLARY_TOOLS_UPLOAD_POOL_SIZE", 10))
+# seconds to wait for connecting, and for the response after sending a request
+CONNECT_TIMEOUT = float(os.getenv("MAPILLARY_TOOLS_CONNECT_TIMEOUT", 30))
+READ_TIMEOUT = float(os.getenv("MAPILLARY_TOOLS_READ_TIMEOUT", 300))
+# the adaptive chunk size aims at chunks uploaded in this number of seconds
+TARGET_CHUNK_SECONDS = float(os.getenv("MAPILLARY_TOOLS_TARGET_CHUNK_SECONDS", 4))
+# the adaptive chunk size grows only after this number of successive chunks
+GROW_AFTER_SUCCESSES = 2
+# weight of the last chunk in the throughput estimate
+THROUGHPUT_SMOOTHING = 0.5
+LOG = logging.getLogger()
+
+
+class ChunkSizeController:
+    """
+    Adapt the chunk size of an upload session to the network. The chunk size
+    follows the measured throughput so that a chunk takes about target_seconds,
+    which amortizes the round trip of each request on fast networks, and limits the
+    bytes sent again after a failure on slow ones. It changes by at most a factor of
+    two per chunk, and is halved on every failure.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_size: int,
+        max_size: int,
+        target_seconds: float = TARGET_CHUNK_SECONDS,
+    ) -> None:
+        if not 0 < min_size <= max_size:
+            raise ValueError(f"Invalid chunk size range {min_size} to {max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.chunk_size = self._clamp(initial)
+        # bytes per second
+        self.throughput: T.Optional[float] = None
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def _resize(self, size: float, reason: str) -> None:
+        size = self._clamp(size)
+        if size != self.chunk_size:
+            LOG.debug(f"Chunk size {self.chunk_size} -> {size} bytes ({reason})")
+            self.chunk_size = size
+            self._successes = 0
+
+    def on_success(self, nbytes: int, seconds: float) -> None:
+        if not nbytes:
+            return
+        throughput = nbytes / max(seconds, 1e-6)
+        with self._lock:
+            if self.throughput is None:
+                self.throughput = throughput
+            else:
+                self.throughput += THROUGHPUT_SMOOTHING * (throughput - self.throughput)
+            self._successes += 1
+            desired = self.throughput * self.target_seconds
+            if desired > self.chunk_size:
+                if self._successes >= GROW_AFTER_SUCCESSES:
+                    self._resize(
+                        min(desired, self.chunk_size * 2),
+                        f"throughput {self.throughput:.0f} B/s",
+                    )
+            elif desired < self.chunk_size / 2:
+                self._resize(
+                    max(desired, self.chunk_size / 2),
+                    f"throughput {self.throughput:.0f} B/s",
+                )
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self._resize(self.chunk_size / 2, "failure")
+            self._successes = 0
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter that counts the connections its pools open
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.connections_opened = 0
+        self._count_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _count_connection(self) -> None:
+        with self._count_lock:
+            self.connections_opened += 1
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class _HTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                adapter._count_connection()
+                return super()._new_conn()
+
+        class _HTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                adapter._count_connection()
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
+
+def create_session(pool_size: int = UPLOAD_POOL_SIZE) -> requests.Session:
+    """
+    Create a session that keeps up to pool_size connections alive per host, to be
+    shared by the upload services of a run
+    """
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def connections_opened(session: requests.Session) -> int:
+    """
+    Return the number of connections the session has opened
+    """
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    return sum(
+        adapter.connections_opened
+        for adapter in adapters.values()
+        if isinstance(adapter, CountingHTTPAdapter)
+    )
+
+
+def create_retry_policy(**kwargs) -> RetryPolicy:
+    """
+    Create the retry policy of the requests of the upload services, which retries
+    the connection errors and timeouts, and the retryable HTTP statuses
+    """
+    return RetryPolicy(
+        retryable_errors=(requests.ConnectionError, requests.Timeout), **kwargs
+    )
 
 
 class UploadService:
@@ -17,65 +173,132 @@ class UploadService:
     entity_size: int
     session_key: str
     callbacks: T.List[T.Callable]
+    session: requests.Session
+    timeout: T.Tuple[float, float]
+    # adapts the chunk size if set, otherwise the chunk size given to upload is used
+    chunk_size_controller: T.Optional[ChunkSizeController]
+    # limits the upload rate if set, shared by the services of a run
+    rate_limiter: T.Optional[TokenBucket]
 
-    def __init__(self, user_access_token: str, session_key: str, entity_size: int):
+    def __init__(
+        self,
+        user_access_token: str,
+        session_key: str,
+        entity_size: int,
+        session: T.Optional[requests.Session] = None,
+        timeout: T.Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        chunk_size_controller: T.Optional[ChunkSizeController] = None,
+        rate_limiter: T.Optional[TokenBucket] = None,
+    ):
         if entity_size <= 0:
             raise ValueError(f"Expect positive entity size but got {entity_size}")
         self.user_access_token = user_access_token
         self.session_key = session_key
         self.entity_size = entity_size
         self.callbacks = []
+        # the session is shared if given, otherwise the service owns it
+        self._owns_session = session is None
+        self.session = create_session() if session is None else session
+        self.timeout = timeout
+        self.chunk_size_controller = chunk_size_controller
+        self.rate_limiter = rate_limiter
+
+    @property
+    def connections_opened(self) -> int:
+        return connections_opened(self.session)
+
+    def close(self) -> None:
+        """
+        Close the session if the service owns it, a shared session is left open
+        """
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self) -> "UploadService":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def fetch_offset(self) -> int:
         headers = {
             "Authorization": f"OAuth {self.user_access_token}",
         }
-        resp = requests.get(
-            f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}", headers=headers
+        resp = self.session.get(
+            f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
+            headers=headers,
+            timeout=self.timeout,
         )
         resp.raise_for_status()
         data = resp.json()
         return data["offset"]
 
+    def _post_chunk(self, chunk: bytes, offset: int) -> requests.Response:
+        headers = {
+            "Authorization": f"OAuth {self.user_access_token}",
+            "Offset": f"{offset}",
+            "X-Entity-Length": str(self.entity_size),
+            "X-Entity-Name": self.session_key,
+            "X-Entity-Type": "application/zip",
+        }
+        body: T.Union[bytes, ThrottledData] = chunk
+        if self.rate_limiter is not None and chunk:
+            body = ThrottledData(chunk, self.rate_limiter)
+        start = time.monotonic()
+        try:
+            resp = self.session.post(
+                f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
+                headers=headers,
+                data=body,
+                timeout=self.timeout,
+            )
+            resp.raise_for_status()
+        except Exception:
+            if self.chunk_size_controller is not None and chunk:
+                self.chunk_size_controller.on_failure()
+            raise
+        if self.chunk_size_controller is not None:
+            self.chunk_size_controller.on_success(len(chunk), time.monotonic() - start)
+        return resp
+
+    def _next_chunk_size(self, chunk_size: int) -> int:
+        if self.chunk_size_controller is not None:
+            return self.chunk_size_controller.chunk_size
+        return chunk_size
+
     def upload(
         self,
         data: T.IO[bytes],
         offset: T.Optional[int] = None,
         chunk_size: int = DEFAULT_CHUNK_SIZE,
+        read_ahead_chunks: int = 0,
     ) -> requests.Response:
         if chunk_size <= 0:
             raise ValueError("Expect positive chunk size")
+        if read_ahead_chunks < 0:
+            raise ValueError("Expect non-negative number of chunks read ahead")
 
         if offset is None:
             offset = self.fetch_offset()
 
         data.seek(offset, io.SEEK_CUR)
 
-        while True:
-            chunk = data.read(chunk_size)
-            # it is possible to upload an empty chunk here
-            # in order to return the handle
-            headers = {
-                "Authorization": f"OAuth {self.user_access_token}",
-                "Offset": f"{offset}",
-                "X-Entity-Length": str(self.entity_size),
-                "X-Entity-Name": self.session_key,
-                "X-Entity-Type": "application/zip",
-            }
-            resp = requests.post(
-                f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
-                headers=headers,
-                data=chunk,
+        if read_ahead_chunks:
+            offset = self._upload_read_ahead(
+                data, offset, chunk_size, read_ahead_chunks
             )
-            resp.raise_for_status()
-            offset += len(chunk)
-            for callback in self.callbacks:
-                callback(chunk, resp)
-            # we can assert that offset == self.fetch_offset(session_key)
-            # otherwise, server will throw
+        else:
+            while True:
+                chunk = data.read(self._next_chunk_size(chunk_size))
+                if not chunk:
+                    break
+                offset = self._commit_chunk(chunk, offset)
 
-            if not chunk:
-                break
+        # it is possible to upload an empty chunk here
+        # in order to return the handle
+        resp = self._post_chunk(b"", offset)
+        for callback in self.callbacks:
+            callback(b"", resp)
 
         assert (
             offset == self.entity_size
@@ -83,6 +306,45 @@ class UploadService:
 
         return resp
 
+    def _commit_chunk(self, chunk: bytes, offset: int) -> int:
+        resp = self._post_chunk(chunk, offset)
+        for callback in self.callbacks:
+            callback(chunk, resp)
+        # we can assert that offset == self.fetch_offset(session_key)
+        # otherwise, server will throw
+        return offset + len(chunk)
+
+    def _upload_read_ahead(
+        self, data: T.IO[bytes], offset: int, chunk_size: int, read_ahead_chunks: int
+    ) -> int:
+        """
+        Post the chunks one after another, since the server only accepts a chunk at
+        the committed offset, while the next read_ahead_chunks chunks are read from
+        the data in a background thread, so that reading the archive overlaps with
+        the upload. Return the offset after the last chunk.
+        """
+        reads: T.Deque[futures.Future] = deque()
+
+        def _read() -> bytes:
+            return data.read(self._next_chunk_size(chunk_size))
+
+        # a single reader thread keeps the reads in the order of the offsets
+        with futures.ThreadPoolExecutor(max_workers=1) as reader:
+            try:
+                for _ in range(read_ahead_chunks):
+                    reads.append(reader.submit(_read))
+                while True:
+                    chunk = reads.popleft().result()
+                    if not chunk:
+                        break
+                    reads.append(reader.submit(_read))
+                    offset = self._commit_chunk(chunk, offset)
+            finally:
+                for future in reads:
+                    future.cancel()
+
+        return offset
+
     def finish(
         self, file_handle: str, organization_id: T.Optional[T.Union[str, int]] = None
     ) -> requests.Response:
@@ -95,8 +357,11 @@ class UploadService:
         if organization_id is not None:
             data["organization_id"] = organization_id
 
-        return requests.post(
-            f"{MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload", headers=headers, json=data
+        return self.session.post(
+            f"{MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload",
+            headers=headers,
+            json=data,
+            timeout=self.timeout,
         )
 
 
@@ -124,23 +389,23 @@ if __name__ == "__main__":
     with open(path, "rb") as fp:
         md5sum, entity_size = _file_stats(fp)
     session_key = sys.argv[2] if sys.argv[2:] else f"mly_tools_test_{md5sum}"
-    service = UploadService(user_access_token, session_key, entity_size)
+    with UploadService(user_access_token, session_key, entity_size) as service:
+        print(f"session key: {session_key}")
+        print(f"entity size: {entity_size}")
+        print(f"initial offset: {service.fetch_offset()}")
 
-    print(f"session key: {session_key}")
-    print(f"entity size: {entity_size}")
-    print(f"initial offset: {service.fetch_offset()}")
-
-    with open(path, "rb") as fp:
-        with tqdm.tqdm(
-            total=entity_size,
-            initial=service.fetch_offset(),
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as pbar:
-            service.callbacks.append(lambda chunk, _: pbar.update(len(chunk)))
-            try:
-                resp = service.upload(fp)
-            except requests.HTTPError as ex:
-                raise wrap_http_exception(ex)
-    print(resp.json())
+        with open(path, "rb") as fp:
+            with tqdm.tqdm(
+                total=entity_size,
+                initial=service.fetch_offset(),
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024,
+            ) as pbar:
+                service.callbacks.append(lambda chunk, _: pbar.update(len(chunk)))
+                try:
+                    resp = service.upload(fp)
+                except requests.HTTPError as ex:
+                    raise wrap_http_exception(ex)
+        print(resp.json())
+        print(f"connections opened: {service.connections_opened}")
@@ -0,0 +1,216 @@
+import asyncio
+import io
+import logging
+import time
+import typing as T
+
+try:
+    import httpx
+except ImportError:
+    httpx = None  # type: ignore
+
+from . import upload_api_v4
+from .login import wrap_http_exception
+from .rate_limit import TokenBucket
+from .retry import RetryPolicy
+from .upload_api_v4 import (
+    CONNECT_TIMEOUT,
+    DEFAULT_CHUNK_SIZE,
+    READ_TIMEOUT,
+    UPLOAD_POOL_SIZE,
+    ChunkSizeController,
+)
+
+"""
+The upload protocol of upload_api_v4 on asyncio, with httpx as the HTTP client.
+The endpoints are those of upload_api_v4.
+
+AsyncUploadService fetches the offset, uploads the chunks and finishes the upload
+like UploadService, but its requests are coroutines, so that one event loop drives
+the uploads of many sequences over a shared connection pool. httpx is an optional
+dependency: install it with "pip install httpx" to use this module.
+"""
+
+
+LOG = logging.getLogger()
+
+
+def check_httpx() -> None:
+    if httpx is None:
+        raise RuntimeError(
+            'The async upload engine requires httpx. Please install it with "pip install httpx"'
+        )
+
+
+def create_client(max_connections: int = UPLOAD_POOL_SIZE) -> "httpx.AsyncClient":
+    """
+    Create a client that opens up to max_connections connections and keeps them
+    alive, to be shared by the upload services of a run
+    """
+    check_httpx()
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
+
+
+def create_retry_policy(**kwargs) -> RetryPolicy:
+    """
+    Create the retry policy of the requests of the async upload services, which
+    retries the connection errors and timeouts, and the retryable HTTP statuses
+    """
+    errors: T.Tuple[T.Type[BaseException], ...] = (
+        ConnectionError,
+        asyncio.TimeoutError,
+    )
+    if httpx is not None:
+        errors += (httpx.TransportError,)
+    return RetryPolicy(retryable_errors=errors, **kwargs)
+
+
+def wrap_http_error(ex: Exception) -> Exception:
+    """
+    Wrap the HTTP status errors of httpx like login.wrap_http_exception wraps those
+    of requests, and return the other errors as they are
+    """
+    if httpx is not None and isinstance(ex, httpx.HTTPStatusError):
+        return wrap_http_exception(T.cast(T.Any, ex))
+    return ex
+
+
+class AsyncUploadService:
+    user_access_token: str
+    entity_size: int
+    session_key: str
+    callbacks: T.List[T.Callable]
+    # an httpx.AsyncClient, or any client with the same get and post coroutines
+    client: T.Any
+    # adapts the chunk size if set, otherwise the chunk size given to upload is used
+    chunk_size_controller: T.Optional[ChunkSizeController]
+    # limits the upload rate if set, shared by the services of a run
+    rate_limiter: T.Optional[TokenBucket]
+
+    def __init__(
+        self,
+        user_access_token: str,
+        session_key: str,
+        entity_size: int,
+        client: T.Any,
+        chunk_size_controller: T.Optional[ChunkSizeController] = None,
+        rate_limiter: T.Optional[TokenBucket] = None,
+    ):
+        if entity_size <= 0:
+            raise ValueError(f"Expect positive entity size but got {entity_size}")
+        self.user_access_token = user_access_token
+        self.session_key = session_key
+        self.entity_size = entity_size
+        self.callbacks = []
+        self.client = client
+        self.chunk_size_controller = chunk_size_controller
+        self.rate_limiter = rate_limiter
+
+    async def fetch_offset(self) -> int:
+        headers = {
+            "Authorization": f"OAuth {self.user_access_token}",
+        }
+        resp = await self.client.get(
+            f"{upload_api_v4.MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
+            headers=headers,
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data["offset"]
+
+    async def _post_chunk(self, chunk: bytes, offset: int):
+        headers = {
+            "Authorization": f"OAuth {self.user_access_token}",
+            "Offset": f"{offset}",
+            "X-Entity-Length": str(self.entity_size),
+            "X-Entity-Name": self.session_key,
+            "X-Entity-Type": "application/zip",
+        }
+        if self.rate_limiter is not None and chunk:
+            # the whole chunk is drawn at once, and the debt is paid before sending
+            wait = self.rate_limiter.reserve(len(chunk))
+            if wait > 0:
+                await asyncio.sleep(wait)
+        start = time.monotonic()
+        try:
+            resp = await self.client.post(
+                f"{upload_api_v4.MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
+                headers=headers,
+                content=chunk,
+            )
+            resp.raise_for_status()
+        except Exception:
+            if self.chunk_size_controller is not None and chunk:
+                self.chunk_size_controller.on_failure()
+            raise
+        if self.chunk_size_controller is not None:
+            self.chunk_size_controller.on_success(len(chunk), time.monotonic() - start)
+        return resp
+
+    def _next_chunk_size(self, chunk_size: int) -> int:
+        if self.chunk_size_controller is not None:
+            return self.chunk_size_controller.chunk_size
+        return chunk_size
+
+    async def upload(
+        self,
+        data: T.IO[bytes],
+        offset: T.Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
+        if chunk_size <= 0:
+            raise ValueError("Expect positive chunk size")
+
+        if offset is None:
+            offset = await self.fetch_offset()
+
+        data.seek(offset, io.SEEK_CUR)
+
+        loop = asyncio.get_event_loop()
+        while True:
+            # the archive may read the files, which must not block the loop
+            chunk = await loop.run_in_executor(
+                None, data.read, self._next_chunk_size(chunk_size)
+            )
+            if not chunk:
+                break
+            resp = await self._post_chunk(chunk, offset)
+            offset += len(chunk)
+            for callback in self.callbacks:
+                callback(chunk, resp)
+
+        # it is possible to upload an empty chunk here
+        # in order to return the handle
+        resp = await self._post_chunk(b"", offset)
+        for callback in self.callbacks:
+            callback(b"", resp)
+
+        assert (
+            offset == self.entity_size
+        ), f"offset ends at {offset} but the entity size is {self.entity_size}"
+
+        return resp
+
+    async def finish(
+        self, file_handle: str, organization_id: T.Optional[T.Union[str, int]] = None
+    ):
+        headers = {
+            "Authorization": f"OAuth {self.user_access_token}",
+        }
+        data: T.Dict[str, T.Union[str, int]] = {
+            "file_handle": file_handle,
+        }
+        if organization_id is not None:
+            data["organization_id"] = organization_id
+
+        return await self.client.post(
+            f"{upload_api_v4.MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload",
+            headers=headers,
+            json=data,
+        )
@@ -0,0 +1,303 @@
+import asyncio
+import functools
+import io
+import logging
+import os
+import threading
+import typing as T
+from concurrent import futures
+
+from tqdm import tqdm
+
+from . import rate_limit, upload_journal, uploader
+from .upload_api_v4_async import (
+    AsyncUploadService,
+    create_client,
+    create_retry_policy,
+    wrap_http_error,
+)
+from .retry import RetryPolicy
+
+"""
+Upload sequences concurrently on an event loop.
+
+Each sequence is a task that waits for one of the concurrency slots, archives the
+sequence in a thread, and uploads the archive with AsyncUploadService. The tasks
+share one HTTP client, and their progress is aggregated in one progress bar. While
+a task waits for the server or backs off after an error, the other tasks proceed,
+so that hundreds of sequences are uploaded by one process without a thread per
+upload.
+"""
+
+
+LOG = logging.getLogger()
+
+# the number of sequences uploaded concurrently, if not specified
+ASYNC_CONCURRENCY = int(os.getenv("MAPILLARY_TOOLS_ASYNC_CONCURRENCY", 64))
+# the number of threads archiving the sequences and reading the archives
+ARCHIVE_WORKERS = int(os.getenv("MAPILLARY_TOOLS_ARCHIVE_WORKERS", os.cpu_count() or 4))
+
+
+class _OffsetJournal:
+    """
+    Journal the acknowledged offsets of an upload in the executor, so that the
+    state writes do not block the event loop. One offset is written at a time,
+    and the offsets acknowledged meanwhile are skipped to the latest one.
+    """
+
+    def __init__(self, file_list: T.List[str], session_key: str) -> None:
+        self.file_list = file_list
+        self.session_key = session_key
+        self._latest: T.Optional[int] = None
+        self._writing: T.Optional[asyncio.Future] = None
+
+    def save(self, offset: int) -> None:
+        self._latest = offset
+        if self._writing is None:
+            self._write(offset)
+
+    def _write(self, offset: int) -> None:
+        loop = asyncio.get_event_loop()
+        self._writing = loop.run_in_executor(
+            None, upload_journal.save_offset, self.file_list, self.session_key, offset
+        )
+        self._writing.add_done_callback(functools.partial(self._on_written, offset))
+
+    def _on_written(self, offset: int, future: asyncio.Future) -> None:
+        self._writing = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            LOG.warning(
+                f"Error journaling the upload offset of {self.file_list[0]}",
+                exc_info=future.exception(),
+            )
+        if self._latest is not None and self._latest != offset:
+            self._write(self._latest)
+
+    async def flush(self) -> None:
+        while self._writing is not None:
+            await asyncio.wait([self._writing])
+
+
+async def upload_sequence_archive(
+    archive: uploader.SequenceArchive,
+    client: T.Any,
+    dry_run=False,
+    on_progress: T.Optional[T.Callable[[int], None]] = None,
+    rate_limiter: T.Optional[rate_limit.TokenBucket] = None,
+    retry_policy: T.Optional[RetryPolicy] = None,
+) -> None:
+    """
+    Upload the prepared sequence archive and finish the upload, like
+    uploader.upload_sequence_archive_v4 but without blocking the event loop
+    """
+    loop = asyncio.get_event_loop()
+    file_list = archive.file_list
+    fp = archive.fp
+
+    chunk_size = uploader.initial_chunk_size(archive)
+
+    service = AsyncUploadService(
+        archive.user_access_token,
+        session_key=f"mly_tools_{fp.md5sum}",
+        entity_size=fp.size,
+        client=client,
+        chunk_size_controller=uploader.chunk_size_controller(chunk_size),
+        rate_limiter=rate_limiter,
+    )
+
+    if retry_policy is None:
+        retry_policy = create_retry_policy()
+    journal = _OffsetJournal(file_list, service.session_key)
+    attempts = uploader.UploadAttempts(
+        archive,
+        service.session_key,
+        retry_policy.start(),
+        on_progress if on_progress is not None else lambda _: None,
+        save_offset=journal.save,
+    )
+
+    completed = False
+    try:
+        try:
+            while True:
+                fp.seek(0, io.SEEK_SET)
+                try:
+                    offset = await service.fetch_offset()
+                    service.callbacks = attempts.start(offset)
+                    upload_resp = await service.upload(
+                        T.cast(T.IO[bytes], fp), chunk_size=chunk_size, offset=offset
+                    )
+                except Exception as ex:
+                    sleep_for = attempts.next_delay(ex)
+                    if sleep_for is None:
+                        if not dry_run:
+                            await loop.run_in_executor(
+                                None, uploader.log_upload_failed, archive
+                            )
+                        raise wrap_http_error(ex)
+                    await asyncio.sleep(sleep_for)
+                else:
+                    break
+        finally:
+            # before the journal is removed, or the loop closed
+            await journal.flush()
+
+        file_handle = uploader.read_file_handle(upload_resp)
+
+        if dry_run:
+            return
+
+        organization_id = uploader.print_finishing(archive)
+
+        async def _finish():
+            resp = await service.finish(file_handle, organization_id=organization_id)
+            resp.raise_for_status()
+            return resp
+
+        try:
+            finish_resp = await retry_policy.call_async(
+                _finish, desc=f"finishing {archive.sequence_uuid}"
+            )
+        except Exception as ex:
+            await loop.run_in_executor(None, uploader.log_upload_failed, archive)
+            raise wrap_http_error(ex)
+
+        # logs, records and flags the files of the sequence, off the event loop
+        await loop.run_in_executor(
+            None, uploader.complete_sequence, archive, finish_resp
+        )
+        completed = True
+    finally:
+        if not completed and not uploader.keeps_staging_dir(dry_run):
+            await loop.run_in_executor(None, uploader.discard_staging_dir, archive)
+
+
+def upload_sequences(
+    list_per_sequence_mapping: T.Dict[str, T.List[str]],
+    file_params: dict,
+    concurrency: T.Optional[int] = None,
+    dry_run=False,
+    zip_compression: str = "auto",
+    rate_schedule: T.Optional[rate_limit.RateSchedule] = None,
+    optimize_jpeg: bool = False,
+    client: T.Any = None,
+) -> None:
+    """
+    Archive and upload the sequences, concurrency of them at a time. After the first
+    failure, the sequences not started yet are skipped, and the failure is raised
+    once the uploads in progress finish. The HTTP client is created for the run
+    unless given.
+    """
+    sequences = list(list_per_sequence_mapping.items())
+    if not sequences:
+        return
+
+    if concurrency is None:
+        concurrency = ASYNC_CONCURRENCY
+    if concurrency < 1:
+        raise ValueError(f"Invalid number of concurrent uploads {concurrency}")
+    concurrency = min(concurrency, len(sequences))
+
+    # one bucket for all uploads, so that the rate limit is global
+    rate_limiter = (
+        rate_limit.TokenBucket(rate_schedule) if rate_schedule is not None else None
+    )
+    errors: T.List[BaseException] = []
+    # the progress bars are updated from the archiving threads too
+    lock = threading.Lock()
+
+    archive_pbar = tqdm(
+        total=sum(len(file_list) for _, file_list in sequences),
+        desc="Archiving",
+        unit="files",
+    )
+    upload_pbar = tqdm(
+        total=0,
+        desc=f"Uploading {len(sequences)} sequences",
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+    )
+
+    def _on_file(_: str) -> None:
+        with lock:
+            archive_pbar.update(1)
+
+    def _on_progress(nbytes: int) -> None:
+        with lock:
+            upload_pbar.update(nbytes)
+
+    async def _run() -> None:
+        loop = asyncio.get_event_loop()
+        # created in the loop, which the semaphore binds to on older Pythons
+        semaphore = asyncio.Semaphore(concurrency)
+        run_client = client if client is not None else create_client(concurrency)
+
+        async def _upload(idx: int, sequence_uuid: str, file_list: T.List[str]):
+            async with semaphore:
+                if errors:
+                    return
+                try:
+                    metadata = {
+                        "total_sequences": len(sequences),
+                        "sequence_idx": idx,
+                    }
+                    archive = await loop.run_in_executor(
+                        None,
+                        functools.partial(
+                            uploader.prepare_sequence_v4,
+                            file_list,
+                            sequence_uuid,
+                            file_params,
+                            metadata=metadata,
+                            zip_compression=zip_compression,
+                            on_file=_on_file,
+                            optimize_jpeg=optimize_jpeg,
+                        ),
+                    )
+                    with lock:
+                        upload_pbar.total += archive.size
+                        upload_pbar.refresh()
+                    with archive.fp:
+                        await upload_sequence_archive(
+                            archive,
+                            run_client,
+                            dry_run=dry_run,
+                            on_progress=_on_progress,
+                            rate_limiter=rate_limiter,
+                        )
+                except Exception as ex:
+                    errors.append(ex)
+
+        try:
+            await asyncio.gather(
+                *(
+                    _upload(idx, sequence_uuid, file_list)
+                    for idx, (sequence_uuid, file_list) in enumerate(sequences)
+                )
+            )
+        finally:
+            if client is None:
+                await run_client.aclose()
+
+    loop = asyncio.new_event_loop()
+    executor = futures.ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS)
+    loop.set_default_executor(executor)
+    try:
+        task = loop.create_task(_run())
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            loop.run_until_complete(asyncio.wait([task]))
+            raise
+    finally:
+        archive_pbar.close()
+        upload_pbar.close()
+        loop.close()
+        executor.shutdown(wait=True)
+
+    if errors:
+        raise errors[0]
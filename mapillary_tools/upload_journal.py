@@ -0,0 +1,164 @@
+import base64
+import logging
+import os
+import typing as T
+
+from . import zip_stream
+from .process_state import get_process_state
+
+"""
+Journal of the sequence uploads, so that an upload interrupted by a crash or a
+restart resumes without archiving the sequence again.
+
+The journal of a sequence is saved in the process state of its first image. It
+records the manifest of the archived files (relative path, size and mtime), the
+compression policy, the segments of the archive (its headers and the ranges of the
+files, or the deflated archive kept on disk), its size and MD5, and the offset
+acknowledged by the upload server. As long as the manifest matches the files, the
+archive is rebuilt from the journal without reading the files. The upload session is
+named after the MD5, so the server resumes it from the acknowledged offset.
+"""
+
+
+LOG = logging.getLogger()
+
+UPLOAD_JOURNAL_ENABLED = os.getenv("MAPILLARY_TOOLS_UPLOAD_JOURNAL", "YES") == "YES"
+JOURNAL_DATA_NAME = "upload_journal"
+JOURNAL_OFFSET_DATA_NAME = "upload_journal_offset"
+JOURNAL_VERSION = 1
+
+
+def _manifest(file_list: T.List[str], root_dir: str) -> T.List[list]:
+    manifest = []
+    for path in file_list:
+        stat = os.stat(path)
+        manifest.append(
+            [os.path.relpath(path, root_dir), stat.st_size, stat.st_mtime_ns]
+        )
+    return manifest
+
+
+def _dump_segments(
+    segments: T.List[zip_stream.Segment], root_dir: str
+) -> T.List[T.Union[str, list]]:
+    dumped: T.List[T.Union[str, list]] = []
+    for segment in segments:
+        if isinstance(segment, bytes):
+            dumped.append(base64.b64encode(segment).decode("ascii"))
+        else:
+            path, offset, size = segment
+            dumped.append([os.path.relpath(path, root_dir), offset, size])
+    return dumped
+
+
+def _load_segments(
+    dumped: T.List[T.Union[str, list]], root_dir: str
+) -> T.List[zip_stream.Segment]:
+    segments: T.List[zip_stream.Segment] = []
+    for segment in dumped:
+        if isinstance(segment, str):
+            segments.append(base64.b64decode(segment))
+        else:
+            relpath, offset, size = segment
+            segments.append((os.path.join(root_dir, relpath), offset, size))
+    return segments
+
+
+def deflate_path(file_list: T.List[str], sequence_uuid: str) -> str:
+    """
+    Return the path where the deflated archive of the sequence is kept until the
+    sequence is uploaded
+    """
+    return os.path.join(
+        os.path.dirname(file_list[0]), ".mapillary", "uploads", f"{sequence_uuid}.zip"
+    )
+
+
+def save_journal(
+    file_list: T.List[str],
+    root_dir: str,
+    sequence_uuid: str,
+    compression: str,
+    stream: zip_stream.ZipStream,
+    optimize_jpeg: bool = False,
+) -> None:
+    entry = {
+        "version": JOURNAL_VERSION,
+        "sequence_uuid": sequence_uuid,
+        "compression": compression,
+        "optimize_jpeg": optimize_jpeg,
+        "manifest": _manifest(file_list, root_dir),
+        "segments": _dump_segments(stream.segments, root_dir),
+        "session_key": f"mly_tools_{stream.md5sum}",
+        "md5sum": stream.md5sum,
+        "entity_size": stream.size,
+    }
+    state = get_process_state()
+    with state.transaction():
+        state.save_data(file_list[0], JOURNAL_DATA_NAME, entry)
+        state.remove_data(file_list[0], JOURNAL_OFFSET_DATA_NAME)
+
+
+def load_archive(
+    file_list: T.List[str],
+    root_dir: str,
+    compression: str,
+    optimize_jpeg: bool = False,
+) -> T.Optional[zip_stream.ZipStream]:
+    """
+    Return the archive recorded in the journal of the sequence, or None if there is
+    no journal or the files have changed since
+    """
+    state = get_process_state()
+    entry = state.load_data(file_list[0], JOURNAL_DATA_NAME)
+    if not entry:
+        return None
+    try:
+        if (
+            entry["version"] != JOURNAL_VERSION
+            or entry["compression"] != compression
+            or entry.get("optimize_jpeg", False) != optimize_jpeg
+            or entry["manifest"] != _manifest(file_list, root_dir)
+        ):
+            return None
+        stream = zip_stream.ZipStream(
+            _load_segments(entry["segments"], root_dir), entry["md5sum"]
+        )
+        if stream.size != entry["entity_size"]:
+            return None
+        for segment in stream.segments:
+            if not isinstance(segment, bytes):
+                path, offset, size = segment
+                if os.path.getsize(path) < offset + size:
+                    return None
+    except (KeyError, TypeError, ValueError, OSError):
+        LOG.warning(f"Ignoring the invalid upload journal of {file_list[0]}")
+        return None
+    return stream
+
+
+def acknowledged_offset(file_list: T.List[str]) -> int:
+    state = get_process_state()
+    return state.load_data(file_list[0], JOURNAL_OFFSET_DATA_NAME).get("offset", 0)
+
+
+def save_offset(file_list: T.List[str], session_key: str, offset: int) -> None:
+    state = get_process_state()
+    state.save_data(
+        file_list[0],
+        JOURNAL_OFFSET_DATA_NAME,
+        {"session_key": session_key, "offset": offset},
+    )
+
+
+def remove_journal(file_list: T.List[str], sequence_uuid: str) -> None:
+    """
+    Remove the journal of the uploaded sequence, and its deflated archive if any
+    """
+    state = get_process_state()
+    with state.transaction():
+        state.remove_data(file_list[0], JOURNAL_DATA_NAME)
+        state.remove_data(file_list[0], JOURNAL_OFFSET_DATA_NAME)
+    path = deflate_path(file_list, sequence_uuid)
+    if os.path.isfile(path):
+        os.remove(path)
@@ -0,0 +1,199 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import typing as T
+from concurrent import futures
+
+from .config import GLOBAL_CONFIG_FILEPATH
+from .exif_cache import RACY_MTIME_WINDOW_NS
+from .process_state import get_process_state, register_cache_data
+
+"""
+Ledger of the uploaded image contents, to skip the images uploaded before from
+another path, such as an overlapping import or a copied folder.
+
+The ledger is a SQLite database shared by all import paths, next to the global
+config. It maps the SHA-256 of the bytes of each uploaded image, per user, to the
+sequence and the cluster it was uploaded in. The hash of an image is cached in its
+process state for as long as the image keeps its size and modification time, so
+the images are read once.
+"""
+
+
+LOG = logging.getLogger()
+
+UPLOAD_LEDGER_ENABLED = os.getenv("MAPILLARY_TOOLS_UPLOAD_LEDGER", "YES") == "YES"
+UPLOAD_LEDGER_PATH = os.getenv(
+    "MAPILLARY_TOOLS_UPLOAD_LEDGER_PATH",
+    os.path.join(
+        os.path.dirname(os.path.dirname(GLOBAL_CONFIG_FILEPATH)), "uploads.db"
+    ),
+)
+CONTENT_HASH_DATA_NAME = register_cache_data("content_sha256")
+HASH_BLOCK_SIZE = 1024 * 1024
+# the number of hashes looked up per query, below the SQLite variable limit
+LOOKUP_BATCH_SIZE = 500
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    user_name TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    sequence_uuid TEXT NOT NULL,
+    cluster_id TEXT,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (user_name, sha256)
+);
+"""
+
+
+def _hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def content_hash(path: str) -> str:
+    """
+    Return the SHA-256 of the image, from its process state if the image has not
+    changed since it was hashed
+    """
+    stat = os.stat(path)
+    state = get_process_state()
+    entry = state.load_data(path, CONTENT_HASH_DATA_NAME)
+    if (
+        entry.get("size") == stat.st_size
+        and entry.get("mtime_ns") == stat.st_mtime_ns
+        and isinstance(entry.get("sha256"), str)
+    ):
+        return entry["sha256"]
+    digest = _hash_file(path)
+    if int(time.time() * 1e9) - stat.st_mtime_ns >= RACY_MTIME_WINDOW_NS:
+        state.save_data(
+            path,
+            CONTENT_HASH_DATA_NAME,
+            {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest},
+        )
+    return digest
+
+
+def content_hashes(
+    paths: T.List[str], max_workers: T.Optional[int] = None
+) -> T.Dict[str, str]:
+    """
+    Return the SHA-256 of the images keyed by path, hashed in a pool of workers
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(content_hash, paths)))
+
+
+@contextlib.contextmanager
+def _connect(path: str) -> T.Generator[sqlite3.Connection, None, None]:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SQLITE_SCHEMA)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def lookup(
+    user_name: str, hashes: T.Iterable[str], path: T.Optional[str] = None
+) -> T.Dict[str, T.Tuple[str, T.Optional[str]]]:
+    """
+    Return the sequence and the cluster of the hashes uploaded by the user, keyed
+    by hash
+    """
+    hashes = sorted(set(hashes))
+    found: T.Dict[str, T.Tuple[str, T.Optional[str]]] = {}
+    if not hashes:
+        return found
+    with _connect(path or UPLOAD_LEDGER_PATH) as conn:
+        for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[start : start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT sha256, sequence_uuid, cluster_id FROM uploads WHERE user_name = ? AND sha256 IN ({placeholders})",
+                [user_name] + batch,
+            )
+            for sha256, sequence_uuid, cluster_id in rows:
+                found[sha256] = (sequence_uuid, cluster_id)
+    return found
+
+
+def record(
+    user_name: str,
+    hashes: T.Iterable[str],
+    sequence_uuid: str,
+    cluster_id: T.Optional[T.Union[str, int]],
+    path: T.Optional[str] = None,
+) -> None:
+    now = time.time()
+    with _connect(path or UPLOAD_LEDGER_PATH) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO uploads (user_name, sha256, sequence_uuid, cluster_id, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    user_name,
+                    sha256,
+                    sequence_uuid,
+                    None if cluster_id is None else str(cluster_id),
+                    now,
+                )
+                for sha256 in hashes
+            ],
+        )
+
+
+def record_sequence(
+    file_list: T.List[str],
+    user_name: str,
+    sequence_uuid: str,
+    cluster_id: T.Optional[T.Union[str, int]],
+) -> None:
+    """
+    Record the images of the uploaded sequence in the ledger
+    """
+    hashes = content_hashes(file_list)
+    record(user_name, hashes.values(), sequence_uuid, cluster_id)
+
+
+def skip_uploaded(
+    list_per_sequence_mapping: T.Dict[str, T.List[str]], file_params: dict
+) -> T.Tuple[T.Dict[str, T.List[str]], T.List[str]]:
+    """
+    Split the images of the sequences into those to upload, grouped per sequence,
+    and those already uploaded by the same user according to the ledger
+    """
+    images = [
+        path for file_list in list_per_sequence_mapping.values() for path in file_list
+    ]
+    hashes = content_hashes(images)
+    by_user: T.Dict[str, T.List[str]] = {}
+    for path in images:
+        by_user.setdefault(file_params[path]["user_name"], []).append(hashes[path])
+    uploaded = {
+        (user_name, sha256)
+        for user_name, user_hashes in by_user.items()
+        for sha256 in lookup(user_name, user_hashes)
+    }
+
+    to_upload: T.Dict[str, T.List[str]] = {}
+    skipped: T.List[str] = []
+    for sequence_uuid, file_list in list_per_sequence_mapping.items():
+        for path in file_list:
+            if (file_params[path]["user_name"], hashes[path]) in uploaded:
+                skipped.append(path)
+            else:
+                to_upload.setdefault(sequence_uuid, []).append(path)
+    return to_upload, skipped
@@ -0,0 +1,252 @@
+import logging
+import os
+import queue
+import threading
+import time
+import typing as T
+
+from tqdm import tqdm
+
+from . import rate_limit, upload_api_v4, uploader
+
+"""
+Upload sequences concurrently.
+
+The sequences are archived one after another by a single thread, ahead of the
+uploads, so that archiving the next sequence overlaps with uploading the current
+ones. The archives are uploaded by a number of workers, and the progress of all
+workers is aggregated in one progress bar.
+
+The number of concurrent uploads is either given, or found by probing: it starts
+with one upload, and one more upload is allowed as long as it increases the total
+upload throughput.
+"""
+
+
+LOG = logging.getLogger()
+
+# the number of concurrent uploads, found by probing if not specified
+NUMBER_THREADS = os.getenv("NUMBER_THREADS")
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAPILLARY_TOOLS_MAX_CONCURRENT_UPLOADS", 8))
+# one more upload is allowed if it increases the throughput by at least this ratio
+PROBE_MIN_GAIN = 0.1
+# the throughput is measured over at least this number of seconds
+PROBE_MIN_SECONDS = 5.0
+
+
+class ConcurrencyProbe:
+    """
+    Limit the number of concurrent uploads. Without a fixed limit, the limit starts
+    at one and grows by one whenever the throughput measured with the current limit
+    improves on the throughput measured with the previous limit.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENT_UPLOADS,
+        fixed: T.Optional[int] = None,
+    ) -> None:
+        if fixed is not None:
+            if fixed < 1:
+                raise ValueError(f"Invalid number of concurrent uploads {fixed}")
+            self.limit = fixed
+            self.probing = False
+        else:
+            self.limit = 1
+            self.probing = True
+        self.max_concurrency = max(max_concurrency, self.limit)
+        self.active = 0
+        self._best_throughput = 0.0
+        self._bytes = 0
+        self._since = time.monotonic()
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._probe()
+            self._cond.notify_all()
+
+    def add_bytes(self, nbytes: int) -> None:
+        with self._cond:
+            self._bytes += nbytes
+
+    def _probe(self) -> None:
+        if not self.probing:
+            return
+        elapsed = time.monotonic() - self._since
+        if elapsed < PROBE_MIN_SECONDS:
+            return
+        throughput = self._bytes / elapsed
+        if (
+            throughput > self._best_throughput * (1 + PROBE_MIN_GAIN)
+            and self.limit < self.max_concurrency
+        ):
+            self._best_throughput = throughput
+            self.limit += 1
+            self._bytes = 0
+            self._since = time.monotonic()
+            LOG.debug(
+                f"Throughput {throughput:.0f} B/s, increasing concurrent uploads to {self.limit}"
+            )
+        else:
+            self.probing = False
+            LOG.debug(
+                f"Throughput {throughput:.0f} B/s, keeping {self.limit} concurrent uploads"
+            )
+
+
+def _resolve_number_threads(number_threads: T.Optional[int]) -> T.Optional[int]:
+    if number_threads is not None:
+        return number_threads
+    if NUMBER_THREADS:
+        return int(NUMBER_THREADS)
+    return None
+
+
+def upload_sequences(
+    list_per_sequence_mapping: T.Dict[str, T.List[str]],
+    file_params: dict,
+    number_threads: T.Optional[int] = None,
+    dry_run=False,
+    zip_compression: str = "auto",
+    read_ahead_chunks: int = 0,
+    rate_schedule: T.Optional[rate_limit.RateSchedule] = None,
+    optimize_jpeg: bool = False,
+) -> None:
+    """
+    Archive and upload the sequences, number_threads of them concurrently, or as
+    many as the probing finds if not specified. After the first failure, the
+    sequences not started yet are skipped, and the failure is raised once the
+    uploads in progress finish.
+    """
+    sequences = list(list_per_sequence_mapping.items())
+    if not sequences:
+        return
+
+    probe = ConcurrencyProbe(fixed=_resolve_number_threads(number_threads))
+    num_workers = min(probe.max_concurrency, len(sequences))
+    # at most one archive waits for a worker, the next one is archived meanwhile
+    prepared: "queue.Queue[T.Optional[uploader.SequenceArchive]]" = queue.Queue(
+        maxsize=1
+    )
+    # one session for all uploads, so that the connections are kept alive across
+    # the chunks and the sequences
+    session = upload_api_v4.create_session(
+        pool_size=max(upload_api_v4.UPLOAD_POOL_SIZE, num_workers)
+    )
+    # one bucket for all uploads, so that the rate limit is global
+    rate_limiter = (
+        rate_limit.TokenBucket(rate_schedule) if rate_schedule is not None else None
+    )
+    failed = threading.Event()
+    errors: T.List[BaseException] = []
+    lock = threading.Lock()
+
+    archive_pbar = tqdm(
+        total=sum(len(file_list) for _, file_list in sequences),
+        desc="Archiving",
+        unit="files",
+    )
+    upload_pbar = tqdm(
+        total=0,
+        desc=f"Uploading {len(sequences)} sequences",
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+    )
+
+    def _fail(ex: BaseException) -> None:
+        with lock:
+            errors.append(ex)
+        failed.set()
+
+    def _on_file(_: str) -> None:
+        with lock:
+            archive_pbar.update(1)
+
+    def _on_progress(nbytes: int) -> None:
+        probe.add_bytes(nbytes)
+        with lock:
+            upload_pbar.update(nbytes)
+
+    def _archive() -> None:
+        try:
+            for idx, (sequence_uuid, file_list) in enumerate(sequences):
+                if failed.is_set():
+                    break
+                metadata = {
+                    "total_sequences": len(sequences),
+                    "sequence_idx": idx,
+                }
+                archive = uploader.prepare_sequence_v4(
+                    file_list,
+                    sequence_uuid,
+                    file_params,
+                    metadata=metadata,
+                    zip_compression=zip_compression,
+                    on_file=_on_file,
+                    optimize_jpeg=optimize_jpeg,
+                )
+                with lock:
+                    upload_pbar.total += archive.size
+                    upload_pbar.refresh()
+                prepared.put(archive)
+        except BaseException as ex:
+            _fail(ex)
+        finally:
+            for _ in range(num_workers):
+                prepared.put(None)
+
+    def _upload() -> None:
+        while True:
+            probe.acquire()
+            try:
+                archive = prepared.get()
+                if archive is None:
+                    return
+                with archive.fp:
+                    if failed.is_set():
+                        continue
+                    try:
+                        uploader.upload_sequence_archive_v4(
+                            archive,
+                            dry_run=dry_run,
+                            on_progress=_on_progress,
+                            session=session,
+                            read_ahead_chunks=read_ahead_chunks,
+                            rate_limiter=rate_limiter,
+                        )
+                    except BaseException as ex:
+                        _fail(ex)
+            finally:
+                probe.release()
+
+    threads = [threading.Thread(target=_archive, daemon=True)]
+    threads.extend(
+        threading.Thread(target=_upload, daemon=True) for _ in range(num_workers)
+    )
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        failed.set()
+        raise
+    finally:
+        archive_pbar.close()
+        upload_pbar.close()
+        LOG.debug(
+            f"Opened {upload_api_v4.connections_opened(session)} connections for {len(sequences)} sequences"
+        )
+        session.close()
+
+    if errors:
+        raise errors[0]
@@ -1,24 +1,30 @@
 import io
-from typing import List, Optional, Iterable, Generator
+from typing import IO, Callable, Dict, List, Optional, Iterable, Generator, Set, cast
 import os
 import sys
-import tempfile
-import hashlib
 import logging
+import sqlite3
 
 import time
-import zipfile
 
 import requests
 from tqdm import tqdm
 
 from . import upload_api_v4
+from . import zip_stream
+from . import upload_journal
+from . import upload_ledger
+from . import rate_limit
+from . import jpeg_optimize
 from . import ipc
+from .retry import RetryPolicy, Retrying
 from .login import authenticate_user, wrap_http_exception
-
+from .process_state import get_process_state
 
 MIN_CHUNK_SIZE = 1024 * 1024  # 1MB
 MAX_CHUNK_SIZE = 1024 * 1024 * 32  # 32MB
+# adapt the chunk size to the measured throughput and failures
+ADAPTIVE_CHUNK_SIZE = os.getenv("MAPILLARY_TOOLS_ADAPTIVE_CHUNK_SIZE", "YES") == "YES"
 LOG = logging.getLogger()
 
 
@@ -33,9 +39,10 @@ def is_video_file(path: str) -> bool:
 
 
 def flag_finalization(finalize_file_list):
-    for file in finalize_file_list:
-        finalize_flag = os.path.join(log_rootpath(file), "upload_finalized")
-        open(finalize_flag, "a").close()
+    state = get_process_state()
+    with state.transaction():
+        for file in finalize_file_list:
+            state.set_flag(file, "upload_finalized")
 
 
 def iterate_files(root: str, recursive=False) -> Generator[str, None, None]:
@@ -48,11 +55,82 @@ def iterate_files(root: str, recursive=False) -> Generator[str, None, None]:
             yield os.path.join(dirpath, file)
 
 
+class StatusIndex:
+    """
+    Index of the image files under an import path and their process state flags,
+    built in one directory walk so that all the file list queries below are
+    answered from memory.
+    """
+
+    def __init__(self, import_path: str, skip_subfolders: bool = False) -> None:
+        self.import_path = import_path
+        self.skip_subfolders = skip_subfolders
+        # image path -> flags, sorted by image path
+        self.flags: Dict[str, Set[str]] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        state = get_process_state()
+        flags: Dict[str, Set[str]] = {}
+        pending = [self.import_path]
+        while pending:
+            dirpath = pending.pop()
+            image_names = []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # same as os.walk: symlinked directories are not followed
+                        if (
+                            not self.skip_subfolders
+                            and not entry.name.startswith(".")
+                            and not entry.is_symlink()
+                        ):
+                            pending.append(entry.path)
+                    elif is_image_file(entry.name):
+                        image_names.append(entry.name)
+            if image_names:
+                for name, image_flags in state.directory_flags(
+                    dirpath, image_names
+                ).items():
+                    flags[os.path.join(dirpath, name)] = image_flags
+        self.flags = {image: flags[image] for image in sorted(flags)}
+
+    def _filter(self, predicate: Callable[[Set[str]], bool]) -> List[str]:
+        return [image for image, flags in self.flags.items() if predicate(flags)]
+
+    def total_file_list(self) -> List[str]:
+        return list(self.flags)
+
+    def upload_file_list(self) -> List[str]:
+        return self._filter(_preform_upload)
+
+    def failed_upload_file_list(self) -> List[str]:
+        return self._filter(_failed_upload)
+
+    def success_upload_file_list(self) -> List[str]:
+        return self._filter(_success_upload)
+
+    def success_only_manual_upload_file_list(self) -> List[str]:
+        return self._filter(_success_only_manual_upload)
+
+    def finalize_file_list(self) -> List[str]:
+        return self._filter(_preform_finalize)
+
+    def duplicate_file_list(self) -> List[str]:
+        return self._filter(lambda flags: "duplicate" in flags)
+
+    def process_file_list(self, process: str, rerun: bool = False) -> List[str]:
+        return self._filter(
+            lambda flags: "upload_success" not in flags
+            and (f"{process}_success" not in flags or rerun)
+        )
+
+    def process_status_file_list(self, process: str, status: str) -> List[str]:
+        return self._filter(lambda flags: f"{process}_{status}" in flags)
+
+
 def get_upload_file_list(import_path: str, skip_subfolders: bool = False) -> List[str]:
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file for file in files if is_image_file(file) and preform_upload(file)
-    )
+    return StatusIndex(import_path, skip_subfolders).upload_file_list()
 
 
 # get a list of video files in a video_file
@@ -62,80 +140,71 @@ def get_video_file_list(video_file, skip_subfolders=False):
 
 
 def get_total_file_list(import_path: str, skip_subfolders: bool = False) -> List[str]:
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(file for file in files if is_image_file(file))
+    return StatusIndex(import_path, skip_subfolders).total_file_list()
 
 
 def get_failed_upload_file_list(
     import_path: str, skip_subfolders: bool = False
 ) -> List[str]:
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(file for file in files if is_image_file(file) and failed_upload(file))
+    return StatusIndex(import_path, skip_subfolders).failed_upload_file_list()
 
 
 def get_success_upload_file_list(
     import_path: str, skip_subfolders: bool = False
 ) -> List[str]:
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file for file in files if is_image_file(file) and success_upload(file)
-    )
+    return StatusIndex(import_path, skip_subfolders).success_upload_file_list()
 
 
 def success_upload(file_path: str) -> bool:
-    log_root = log_rootpath(file_path)
-    upload_success = os.path.join(log_root, "upload_success")
-    upload_finalization = os.path.join(log_root, "upload_finalized")
-    manual_upload = os.path.join(log_root, "manual_upload")
-    success = (
-        os.path.isfile(upload_success) and not os.path.isfile(manual_upload)
-    ) or (
-        os.path.isfile(upload_success)
-        and os.path.isfile(manual_upload)
-        and os.path.isfile(upload_finalization)
+    return _success_upload(get_process_state().flags(file_path))
+
+
+def _success_upload(flags: Set[str]) -> bool:
+    success = ("upload_success" in flags and "manual_upload" not in flags) or (
+        "upload_success" in flags
+        and "manual_upload" in flags
+        and "upload_finalized" in flags
     )
     return success
 
 
 def get_success_only_manual_upload_file_list(import_path, skip_subfolders=False):
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file
-        for file in files
-        if is_image_file(file) and success_only_manual_upload(file)
-    )
+    return StatusIndex(
+        import_path, skip_subfolders
+    ).success_only_manual_upload_file_list()
 
 
 def success_only_manual_upload(file_path: str):
-    log_root = log_rootpath(file_path)
-    upload_success = os.path.join(log_root, "upload_success")
-    manual_upload = os.path.join(log_root, "manual_upload")
-    success = os.path.isfile(upload_success) and os.path.isfile(manual_upload)
+    return _success_only_manual_upload(get_process_state().flags(file_path))
+
+
+def _success_only_manual_upload(flags: Set[str]) -> bool:
+    success = "upload_success" in flags and "manual_upload" in flags
     return success
 
 
 def preform_upload(file_path: str) -> bool:
-    log_root = log_rootpath(file_path)
-    process_success = os.path.join(log_root, "mapillary_image_description_success")
-    duplicate = os.path.join(log_root, "duplicate")
-    upload_succes = os.path.join(log_root, "upload_success")
+    return _preform_upload(get_process_state().flags(file_path))
+
+
+def _preform_upload(flags: Set[str]) -> bool:
     upload = (
-        not os.path.isfile(upload_succes)
-        and os.path.isfile(process_success)
-        and not os.path.isfile(duplicate)
+        "upload_success" not in flags
+        and "mapillary_image_description_success" in flags
+        and "duplicate" not in flags
     )
     return upload
 
 
 def failed_upload(file_path: str) -> bool:
-    log_root = log_rootpath(file_path)
-    process_failed = os.path.join(log_root, "mapillary_image_description_failed")
-    duplicate = os.path.join(log_root, "duplicate")
-    upload_failed = os.path.join(log_root, "upload_failed")
+    return _failed_upload(get_process_state().flags(file_path))
+
+
+def _failed_upload(flags: Set[str]) -> bool:
     failed = (
-        os.path.isfile(upload_failed)
-        and not os.path.isfile(process_failed)
-        and not os.path.isfile(duplicate)
+        "upload_failed" in flags
+        and "mapillary_image_description_failed" not in flags
+        and "duplicate" not in flags
     )
     return failed
 
@@ -143,21 +212,18 @@ def failed_upload(file_path: str) -> bool:
 def get_finalize_file_list(
     import_path: str, skip_subfolders: bool = False
 ) -> List[str]:
-    files = iterate_files(import_path, not skip_subfolders)
-    return sorted(
-        file for file in files if is_image_file(file) and preform_finalize(file)
-    )
+    return StatusIndex(import_path, skip_subfolders).finalize_file_list()
 
 
 def preform_finalize(file_path: str) -> bool:
-    log_root = log_rootpath(file_path)
-    upload_succes = os.path.join(log_root, "upload_success")
-    upload_finalized = os.path.join(log_root, "upload_finalized")
-    manual_upload = os.path.join(log_root, "manual_upload")
+    return _preform_finalize(get_process_state().flags(file_path))
+
+
+def _preform_finalize(flags: Set[str]) -> bool:
     finalize = (
-        os.path.isfile(upload_succes)
-        and not os.path.isfile(upload_finalized)
-        and os.path.isfile(manual_upload)
+        "upload_success" in flags
+        and "upload_finalized" not in flags
+        and "manual_upload" in flags
     )
     return finalize
 
@@ -182,13 +248,56 @@ def find_root_dir(file_list: Iterable[str]) -> Optional[str]:
         return find_root_dir(dirs)
 
 
-def upload_sequence_v4(
+class SequenceArchive:
+    """
+    The zip archive of a sequence prepared for uploading
+    """
+
+    def __init__(
+        self,
+        sequence_uuid: str,
+        file_list: List[str],
+        root_dir: str,
+        first_image: dict,
+        user_access_token: str,
+        fp: zip_stream.ZipStream,
+        metadata: dict,
+    ) -> None:
+        self.sequence_uuid = sequence_uuid
+        self.file_list = file_list
+        self.root_dir = root_dir
+        self.first_image = first_image
+        self.user_access_token = user_access_token
+        self.fp = fp
+        self.metadata = metadata
+
+    @property
+    def size(self) -> int:
+        return self.fp.size
+
+    def build_desc(self, desc: str) -> str:
+        total = self.metadata.get("total_sequences")
+        idx = self.metadata.get("sequence_idx")
+        if total is not None and idx is not None:
+            return f"{desc} {idx + 1}/{total}"
+        else:
+            return desc
+
+
+def prepare_sequence_v4(
     file_list: list,
     sequence_uuid: str,
     file_params: dict,
     metadata: Optional[dict] = None,
-    dry_run=False,
-):
+    zip_compression: str = "auto",
+    on_file: Optional[Callable[[str], None]] = None,
+    optimize_jpeg: bool = False,
+) -> SequenceArchive:
+    """
+    Authenticate the user of the sequence and build its zip archive, of the
+    losslessly optimized copies of the images if optimize_jpeg. The archive has to
+    be closed after uploading.
+    """
     if metadata is None:
         metadata = {}
 
@@ -208,152 +317,236 @@ def upload_sequence_v4(
     credentials = authenticate_user(user_name)
     user_access_token = credentials["user_upload_token"]
 
-    def _gen_notify_progress(uploaded_bytes: int):
-        def _notify_progress(chunk: bytes, _):
-            nonlocal uploaded_bytes
-            uploaded_bytes += len(chunk)
-            assert uploaded_bytes <= entity_size
-            payload = {
-                "chunk_size": len(chunk),
-                "sequence_path": root_dir,
-                "sequence_uuid": sequence_uuid,
-                "total_bytes": entity_size,
-                "uploaded_bytes": uploaded_bytes,
-            }
-            if metadata:
-                payload.update(metadata)
-            ipc.send("upload", payload)
-
-        return _notify_progress
-
-    def _build_desc(desc: str) -> str:
-        if metadata is not None:
-            total = metadata.get("total_sequences")
-            idx = metadata.get("sequence_idx")
-            if total is not None and idx is not None:
-                return f"{desc} {idx + 1}/{total}"
-            else:
-                return desc
-        else:
-            return desc
+    archive = SequenceArchive(
+        sequence_uuid,
+        file_list,
+        root_dir,
+        first_image,
+        user_access_token,
+        cast(zip_stream.ZipStream, None),
+        metadata,
+    )
 
-    with tempfile.NamedTemporaryFile() as fp:
-        # compressing
-        with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as ziph:
-            with tqdm(
-                total=len(file_list), desc=_build_desc("Compressing"), unit="files"
-            ) as pbar:
-                for fullpath in file_list:
-                    relpath = os.path.relpath(fullpath, root_dir)
-                    ziph.write(fullpath, relpath)
-                    pbar.update(1)
-        fp.seek(0, io.SEEK_END)
-        entity_size = fp.tell()
-
-        # chunk size
-        avg_image_size = int(entity_size / len(file_list))
-        chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
-
-        # md5sum
-        fp.seek(0, io.SEEK_SET)
-        md5 = hashlib.md5()
-        while True:
-            buf = fp.read(MAX_CHUNK_SIZE)
-            if not buf:
-                break
-            md5.update(buf)
-        md5sum = md5.hexdigest()
-
-        # uploading
-        service = upload_api_v4.UploadService(
-            user_access_token,
-            session_key=f"mly_tools_{md5sum}",
-            entity_size=entity_size,
+    def _optimize_images() -> List[str]:
+        with tqdm(
+            total=len(file_list), desc=archive.build_desc("Optimizing"), unit="files"
+        ) as pbar:
+            results = jpeg_optimize.optimize_images(
+                file_list,
+                root_dir,
+                jpeg_optimize.staging_dir(file_list, sequence_uuid),
+                on_file=lambda _: pbar.update(1),
+            )
+        print(jpeg_optimize.summarize(results))
+        return [result.path for result in results]
+
+    def _load_zip() -> Optional[zip_stream.ZipStream]:
+        fp = upload_journal.load_archive(
+            file_list, root_dir, zip_compression, optimize_jpeg=optimize_jpeg
         )
-
-        retryable_errors = (
-            requests.HTTPError,
-            requests.ConnectionError,
-            requests.Timeout,
+        if fp is not None:
+            offset = upload_journal.acknowledged_offset(file_list)
+            LOG.info(
+                f"Resuming sequence {sequence_uuid} from the upload journal at {offset} of {fp.size} bytes"
+            )
+            if on_file is not None:
+                for path in file_list:
+                    on_file(path)
+        return fp
+
+    def _build_zip(
+        paths: List[str], on_file: Callable[[str], None]
+    ) -> zip_stream.ZipStream:
+        journaled = upload_journal.UPLOAD_JOURNAL_ENABLED
+        deflate_path = (
+            upload_journal.deflate_path(file_list, sequence_uuid) if journaled else None
         )
+        # the optimized copies are archived under the names of the images
+        fp = zip_stream.build_zip(
+            paths,
+            root_dir,
+            compression=zip_compression,
+            on_file=on_file,
+            deflate_path=deflate_path,
+            arcnames=[os.path.relpath(path, root_dir) for path in file_list],
+        )
+        if journaled:
+            upload_journal.save_journal(
+                file_list,
+                root_dir,
+                sequence_uuid,
+                zip_compression,
+                fp,
+                optimize_jpeg=optimize_jpeg,
+            )
+        return fp
+
+    fp = _load_zip() if upload_journal.UPLOAD_JOURNAL_ENABLED else None
+    if fp is not None:
+        archive.fp = fp
+        return archive
+
+    paths = _optimize_images() if optimize_jpeg else file_list
+
+    # archiving: stored archives are read once for the size and the MD5 of the
+    # archive, and read again while uploading, without writing the archive to disk
+    if on_file is None:
+        with tqdm(
+            total=len(file_list), desc=archive.build_desc("Archiving"), unit="files"
+        ) as pbar:
+            archive.fp = _build_zip(paths, lambda _: pbar.update(1))
+    else:
+        archive.fp = _build_zip(paths, on_file)
+
+    return archive
+
 
-        retries = 0
+def notify_progress_callback(
+    archive: SequenceArchive, uploaded_bytes: int
+) -> Callable[[bytes, object], None]:
+    """
+    Return the upload callback that sends the progress of the sequence over IPC,
+    starting from uploaded_bytes
+    """
+    entity_size = archive.size
+
+    def _notify_progress(chunk: bytes, _):
+        nonlocal uploaded_bytes
+        uploaded_bytes += len(chunk)
+        assert uploaded_bytes <= entity_size
+        payload = {
+            "chunk_size": len(chunk),
+            "sequence_path": archive.root_dir,
+            "sequence_uuid": archive.sequence_uuid,
+            "total_bytes": entity_size,
+            "uploaded_bytes": uploaded_bytes,
+        }
+        if archive.metadata:
+            payload.update(archive.metadata)
+        ipc.send("upload", payload)
+
+    return _notify_progress
+
+
+class UploadAttempts:
+    """
+    The attempts to upload a sequence archive, shared by the upload engines. It
+    keeps the bytes reported to the progress and the offset acknowledged by the
+    server across the attempts, journals the offset, and resets the retries when
+    a chunk is uploaded. The offset is journaled with save_offset if given.
+    """
 
+    def __init__(
+        self,
+        archive: SequenceArchive,
+        session_key: str,
+        retrying: Retrying,
+        on_progress: Callable[[int], None],
+        save_offset: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.archive = archive
+        self.session_key = session_key
+        self.retrying = retrying
+        self.on_progress = on_progress
+        self.save_offset = save_offset or self._save_offset
+        # bytes reported to the progress so far
+        self.reported_bytes = 0
+        # offset acknowledged by the server
+        self.acknowledged = 0
+
+    def _save_offset(self, offset: int) -> None:
+        upload_journal.save_offset(self.archive.file_list, self.session_key, offset)
+
+    def report_progress(self, nbytes: int) -> None:
+        self.reported_bytes += nbytes
+        self.on_progress(nbytes)
+
+    def _on_chunk(self, chunk: bytes, _) -> None:
+        self.report_progress(len(chunk))
         # when it progresses, we reset retries
-        def _reset_retries(_, __):
-            nonlocal retries
-            retries = 0
+        self.retrying.reset()
+        self.acknowledged += len(chunk)
+        if upload_journal.UPLOAD_JOURNAL_ENABLED:
+            self.save_offset(self.acknowledged)
+
+    def start(self, offset: int) -> List[Callable[[bytes, object], None]]:
+        """
+        Start an attempt from the offset fetched from the server, and return the
+        callbacks of its upload
+        """
+        self.acknowledged = offset
+        if offset > self.reported_bytes:
+            self.report_progress(offset - self.reported_bytes)
+        return [self._on_chunk, notify_progress_callback(self.archive, offset)]
+
+    def next_delay(self, ex: BaseException) -> Optional[float]:
+        """
+        Return how long to wait before the next attempt after the error, or None if
+        the upload has failed
+        """
+        sleep_for = self.retrying.next_delay(ex)
+        if sleep_for is not None:
+            self.retrying.log(f"uploading {self.archive.sequence_uuid}", sleep_for)
+        return sleep_for
+
+
+def initial_chunk_size(archive: SequenceArchive) -> int:
+    # the average image size within the chunk size range
+    avg_image_size = int(archive.size / len(archive.file_list))
+    return min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+def chunk_size_controller(
+    chunk_size: int,
+) -> Optional[upload_api_v4.ChunkSizeController]:
+    # the average image size is the initial chunk size of the adaptive chunk size
+    if ADAPTIVE_CHUNK_SIZE:
+        return upload_api_v4.ChunkSizeController(
+            chunk_size, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+        )
+    return None
 
-        while True:
-            update_pbar = lambda chunk, _: pbar.update(len(chunk))
-            service.callbacks = [update_pbar, _reset_retries]
-            with tqdm(
-                total=entity_size,
-                desc=_build_desc("Uploading"),
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as pbar:
-                fp.seek(0, io.SEEK_SET)
-                try:
-                    offset = service.fetch_offset()
-                    pbar.update(offset)
-                    service.callbacks.append(_gen_notify_progress(offset))
-                    upload_resp = service.upload(
-                        fp, chunk_size=chunk_size, offset=offset
-                    )
-                except Exception as ex:
-                    if retries < 200 and isinstance(ex, retryable_errors):
-                        retries += 1
-                        sleep_for = min(2 ** retries, 16)
-                        LOG.warning(
-                            f"Error uploading, resuming in {sleep_for} seconds",
-                            exc_info=True,
-                        )
-                        time.sleep(sleep_for)
-                    else:
-                        if not dry_run:
-                            for path in file_list:
-                                create_upload_log(path, "upload_failed")
-                        raise wrap_http_exception(ex) if isinstance(
-                            ex, requests.HTTPError
-                        ) else ex
-                else:
-                    break
 
-    upload_resp_json = upload_resp.json()
+def log_upload_failed(archive: SequenceArchive) -> None:
+    for path in archive.file_list:
+        create_upload_log(path, "upload_failed")
+
+
+def read_file_handle(upload_resp) -> str:
     try:
-        file_handle = upload_resp_json["h"]
+        return upload_resp.json()["h"]
     except KeyError:
         raise RuntimeError(
             f"File handle not found in the upload response {upload_resp.text}"
         )
 
-    if dry_run:
-        return
-
-    organization_id = first_image.get("MAPOrganizationKey")
 
+def print_finishing(archive: SequenceArchive) -> Optional[str]:
+    """
+    Print that the upload of the sequence is finishing and return its organization
+    """
+    organization_id = archive.first_image.get("MAPOrganizationKey")
     if organization_id is None:
-        print(f"Finishing upload {sequence_uuid}")
+        print(f"Finishing upload {archive.sequence_uuid}")
     else:
-        print(f"Finishing upload {sequence_uuid} for organization {organization_id}")
+        print(
+            f"Finishing upload {archive.sequence_uuid} for organization {organization_id}"
+        )
+    return organization_id
 
-    # TODO: retry here
-    finish_resp = service.finish(file_handle, organization_id=organization_id)
-    try:
-        finish_resp.raise_for_status()
-    except requests.HTTPError as ex:
-        for path in file_list:
-            create_upload_log(path, "upload_failed")
-        raise wrap_http_exception(ex)
+
+def complete_sequence(archive: SequenceArchive, finish_resp) -> None:
+    """
+    Check the response of the finished upload, and log the sequence as uploaded
+    """
+    file_list = archive.file_list
+    sequence_uuid = archive.sequence_uuid
 
     # check cluster id
     finish_data = finish_resp.json()
     cluster_id = finish_data.get("cluster_id")
     if cluster_id is None:
-        for path in file_list:
-            create_upload_log(path, "upload_failed")
+        log_upload_failed(archive)
         raise RuntimeError(
             f"Upload server error: failed to create the cluster {finish_resp.text}"
         )
@@ -363,37 +556,194 @@ def upload_sequence_v4(
     for path in file_list:
         create_upload_log(path, "upload_success")
 
+    if upload_ledger.UPLOAD_LEDGER_ENABLED:
+        try:
+            upload_ledger.record_sequence(
+                file_list, archive.first_image["user_name"], sequence_uuid, cluster_id
+            )
+        except (sqlite3.Error, OSError):
+            LOG.warning(
+                f"Error recording sequence {sequence_uuid} in the upload ledger",
+                exc_info=True,
+            )
+
+    if upload_journal.UPLOAD_JOURNAL_ENABLED:
+        upload_journal.remove_journal(file_list, sequence_uuid)
+    jpeg_optimize.remove_staging_dir(file_list, sequence_uuid)
+
     flag_finalization(file_list)
 
 
-def log_rootpath(filepath: str) -> str:
-    return os.path.join(
-        os.path.dirname(filepath),
-        ".mapillary",
-        "logs",
-        os.path.splitext(os.path.basename(filepath))[0],
+def discard_staging_dir(archive: SequenceArchive) -> None:
+    """
+    Remove the optimized copies of a sequence whose upload did not complete, with
+    the journal that refers to them
+    """
+    file_list = archive.file_list
+    sequence_uuid = archive.sequence_uuid
+    if os.path.isdir(jpeg_optimize.staging_dir(file_list, sequence_uuid)):
+        if upload_journal.UPLOAD_JOURNAL_ENABLED:
+            upload_journal.remove_journal(file_list, sequence_uuid)
+        jpeg_optimize.remove_staging_dir(file_list, sequence_uuid)
+
+
+def keeps_staging_dir(dry_run=False) -> bool:
+    """
+    Whether an upload that did not complete keeps the optimized copies, for the
+    journal to resume it from them
+    """
+    return upload_journal.UPLOAD_JOURNAL_ENABLED and not dry_run
+
+
+def upload_sequence_archive_v4(
+    archive: SequenceArchive,
+    dry_run=False,
+    on_progress: Optional[Callable[[int], None]] = None,
+    session: Optional[requests.Session] = None,
+    read_ahead_chunks: int = 0,
+    rate_limiter: Optional[rate_limit.TokenBucket] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+):
+    """
+    Upload the prepared sequence archive and finish the upload. The progress is
+    shown in its own progress bar unless on_progress is given, which is called with
+    the number of bytes uploaded. The HTTP session and the rate limiter are shared
+    if given. After an error, the upload resumes from the offset fetched again, as
+    long as the retry policy allows.
+    """
+    file_list = archive.file_list
+    fp = archive.fp
+    entity_size = fp.size
+    md5sum = fp.md5sum
+
+    chunk_size = initial_chunk_size(archive)
+
+    # uploading
+    service = upload_api_v4.UploadService(
+        archive.user_access_token,
+        session_key=f"mly_tools_{md5sum}",
+        entity_size=entity_size,
+        session=session,
+        chunk_size_controller=chunk_size_controller(chunk_size),
+        rate_limiter=rate_limiter,
     )
 
+    completed = False
+    try:
+        if retry_policy is None:
+            retry_policy = upload_api_v4.create_retry_policy()
+        attempts = UploadAttempts(
+            archive,
+            service.session_key,
+            retry_policy.start(),
+            (
+                on_progress
+                if on_progress is not None
+                else lambda nbytes: pbar.update(nbytes)
+            ),
+        )
+
+        while True:
+            with tqdm(
+                total=entity_size,
+                initial=attempts.reported_bytes,
+                desc=archive.build_desc("Uploading"),
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024,
+                disable=on_progress is not None,
+            ) as pbar:
+                fp.seek(0, io.SEEK_SET)
+                try:
+                    offset = service.fetch_offset()
+                    service.callbacks = attempts.start(offset)
+                    upload_resp = service.upload(
+                        cast(IO[bytes], fp),
+                        chunk_size=chunk_size,
+                        offset=offset,
+                        read_ahead_chunks=read_ahead_chunks,
+                    )
+                except Exception as ex:
+                    sleep_for = attempts.next_delay(ex)
+                    if sleep_for is None:
+                        if not dry_run:
+                            log_upload_failed(archive)
+                        raise (
+                            wrap_http_exception(ex)
+                            if isinstance(ex, requests.HTTPError)
+                            else ex
+                        )
+                    time.sleep(sleep_for)
+                else:
+                    break
+
+        file_handle = read_file_handle(upload_resp)
+
+        if dry_run:
+            return
+
+        organization_id = print_finishing(archive)
+
+        def _finish() -> requests.Response:
+            resp = service.finish(file_handle, organization_id=organization_id)
+            resp.raise_for_status()
+            return resp
+
+        try:
+            finish_resp = retry_policy.call(
+                _finish, desc=f"finishing {archive.sequence_uuid}"
+            )
+        except Exception as ex:
+            log_upload_failed(archive)
+            raise (
+                wrap_http_exception(ex) if isinstance(ex, requests.HTTPError) else ex
+            )
+
+        complete_sequence(archive, finish_resp)
+        completed = True
+    finally:
+        # closes the session unless it is shared
+        service.close()
+        if not completed and not keeps_staging_dir(dry_run):
+            discard_staging_dir(archive)
+
+
+def upload_sequence_v4(
+    file_list: list,
+    sequence_uuid: str,
+    file_params: dict,
+    metadata: Optional[dict] = None,
+    dry_run=False,
+    zip_compression: str = "auto",
+    read_ahead_chunks: int = 0,
+    rate_limiter: Optional[rate_limit.TokenBucket] = None,
+    optimize_jpeg: bool = False,
+):
+    archive = prepare_sequence_v4(
+        file_list,
+        sequence_uuid,
+        file_params,
+        metadata=metadata,
+        zip_compression=zip_compression,
+        optimize_jpeg=optimize_jpeg,
+    )
+    with archive.fp:
+        upload_sequence_archive_v4(
+            archive,
+            dry_run=dry_run,
+            read_ahead_chunks=read_ahead_chunks,
+            rate_limiter=rate_limiter,
+        )
+
 
 def create_upload_log(filepath: str, status: str) -> None:
     assert status in ["upload_success", "upload_failed"], f"invalid status {status}"
-    upload_log_root = log_rootpath(filepath)
-    upload_log_filepath = os.path.join(upload_log_root, status)
     opposite_status = {
         "upload_success": "upload_failed",
         "upload_failed": "upload_success",
     }
-    upload_opposite_log_filepath = os.path.join(
-        upload_log_root, opposite_status[status]
-    )
-    suffix = str(time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime()))
-    if not os.path.isdir(upload_log_root):
-        os.makedirs(upload_log_root)
-        open(upload_log_filepath, "w").close()
-        open(f"{upload_log_filepath}_{suffix}", "w").close()
-    else:
-        if not os.path.isfile(upload_log_filepath):
-            open(upload_log_filepath, "w").close()
-            open(f"{upload_log_filepath}_{suffix}", "w").close()
-        if os.path.isfile(upload_opposite_log_filepath):
-            os.remove(upload_opposite_log_filepath)
+    state = get_process_state()
+    with state.transaction():
+        if not state.has_flag(filepath, status):
+            state.set_flag(filepath, status, record_history=True)
+        state.clear_flag(filepath, opposite_status[status])
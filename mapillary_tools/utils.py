@@ -1,3 +1,12 @@
+import concurrent.futures
+import typing as T
+
+from tqdm import tqdm
+
+A = T.TypeVar("A")
+R = T.TypeVar("R")
+
+
 def force_decode(string, codecs=None):
     if codecs is None:
         codecs = ["utf8", "cp1252"]
@@ -10,3 +19,39 @@ def force_decode(string, codecs=None):
             pass
     print(f"cannot decode string: {string}")
     return string.decode("utf8", errors="replace")
+
+
+def map_with_workers(
+    func: T.Callable[[A], R],
+    items: T.Sequence[A],
+    workers: T.Optional[int] = None,
+    worker_type: str = "thread",
+    desc: T.Optional[str] = None,
+) -> T.List[R]:
+    """
+    Apply func to each item with a pool of workers and return the results in the
+    order of the items. Use threads for I/O-bound work (e.g. images on network
+    storage) and processes for CPU-bound work (func must be picklable).
+    """
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [func(item) for item in tqdm(items, desc=desc)]
+
+    executor: concurrent.futures.Executor
+    if worker_type == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+    elif worker_type == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        # amortize the inter-process communication over several items
+        chunksize = max(1, len(items) // (workers * 4))
+    else:
+        raise ValueError(f"Invalid worker type {worker_type}, expect thread or process")
+
+    with executor:
+        return list(
+            tqdm(
+                executor.map(func, items, chunksize=chunksize),
+                total=len(items),
+                desc=desc,
+            )
+        )
@@ -0,0 +1,395 @@
+import bisect
+import hashlib
+import io
+import os
+import tempfile
+import typing as T
+import zipfile
+import zlib
+
+"""
+Zip archives of files that are streamed from the files themselves, without
+writing the archive to disk or loading it to memory.
+
+The archive is built once with zipfile in its unseekable mode, so that each entry
+is written as its header, the file data and a data descriptor with the CRC that
+follows the data. Instead of keeping the bytes written, only the headers are kept,
+and the file data is recorded as ranges of the source files. The size and the MD5
+of the archive are known after this single read of the files, and reading the
+archive reads the file data again from the source files.
+
+Compressed archives can not be streamed this way, they are written to a temporary
+file instead.
+
+The entries have a fixed timestamp and mode, so that the archive bytes, and hence
+the MD5 that the upload session is named after, depend only on the names and the
+contents of the files.
+"""
+
+
+READ_BUFFER_SIZE = 1024 * 1024
+ZIP_COMPRESSIONS = ["stored", "deflate", "auto"]
+# how many files the auto compression compresses to pick the compression
+AUTO_SAMPLE_FILES = 3
+# the auto compression deflates if it saves at least this ratio of the sample size
+AUTO_MIN_DEFLATE_SAVING = 0.05
+# timestamp and mode of all entries, instead of those of the files
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0o644
+
+# a segment of the archive is either bytes, or a (path, offset, size) range of a file
+Segment = T.Union[bytes, T.Tuple[str, int, int]]
+
+
+def _segment_size(segment: Segment) -> int:
+    if isinstance(segment, bytes):
+        return len(segment)
+    return segment[2]
+
+
+class _ZipRecorder:
+    """
+    Write target of zipfile that records the archive as segments
+    """
+
+    def __init__(self) -> None:
+        self.segments: T.List[Segment] = []
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self._source: T.Optional[str] = None
+        self._source_offset = 0
+
+    def begin_file(self, path: str) -> None:
+        self._source = path
+        self._source_offset = 0
+
+    def end_file(self) -> None:
+        self._source = None
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        if not size:
+            return 0
+        self.md5.update(data)
+        last = self.segments[-1] if self.segments else None
+        if self._source is None:
+            if isinstance(last, bytes):
+                self.segments[-1] = last + bytes(data)
+            else:
+                self.segments.append(bytes(data))
+        else:
+            if isinstance(last, tuple) and last[0] == self._source:
+                self.segments[-1] = (last[0], last[1], last[2] + size)
+            else:
+                self.segments.append((self._source, self._source_offset, size))
+            self._source_offset += size
+        self.size += size
+        return size
+
+
+def _zip_info(fullpath: str, relpath: str, compress_type: int) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(relpath, date_time=ZIP_DATE_TIME)
+    zinfo.external_attr = ZIP_FILE_MODE << 16
+    zinfo.file_size = os.path.getsize(fullpath)
+    zinfo.compress_type = compress_type
+    return zinfo
+
+
+def _write_entry(
+    ziph: zipfile.ZipFile,
+    fullpath: str,
+    zinfo: zipfile.ZipInfo,
+    recorder: T.Optional["_ZipRecorder"] = None,
+) -> None:
+    with open(fullpath, "rb") as src, ziph.open(zinfo, "w") as dst:
+        if recorder is not None:
+            recorder.begin_file(fullpath)
+        while True:
+            buf = src.read(READ_BUFFER_SIZE)
+            if not buf:
+                break
+            dst.write(buf)
+        if recorder is not None:
+            recorder.end_file()
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Read-only file object of a zip archive built by build_zip_stream or build_zip_file
+    """
+
+    def __init__(
+        self,
+        segments: T.List[Segment],
+        md5sum: str,
+        temporary_path: T.Optional[str] = None,
+    ) -> None:
+        super().__init__()
+        self.segments = segments
+        self.md5sum = md5sum
+        # the file that holds the archive, removed when the stream is closed
+        self.temporary_path = temporary_path
+        self._starts: T.List[int] = []
+        size = 0
+        for segment in segments:
+            self._starts.append(size)
+            size += _segment_size(segment)
+        self.size = size
+        self._position = 0
+        self._source: T.Optional[str] = None
+        self._source_fp: T.Optional[T.BinaryIO] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def _read_source(self, path: str, offset: int, size: int) -> bytes:
+        if self._source != path:
+            self._close_source()
+            self._source_fp = open(path, "rb")
+            self._source = path
+        assert self._source_fp is not None
+        self._source_fp.seek(offset)
+        data = self._source_fp.read(size)
+        if len(data) != size:
+            raise RuntimeError(f"File {path} has changed since it was archived")
+        return data
+
+    def _close_source(self) -> None:
+        if self._source_fp is not None:
+            self._source_fp.close()
+        self._source_fp = None
+        self._source = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size
+        end = min(self._position + size, self.size)
+        chunks = []
+        idx = bisect.bisect_right(self._starts, self._position) - 1
+        while self._position < end:
+            segment = self.segments[idx]
+            skip = self._position - self._starts[idx]
+            count = min(_segment_size(segment) - skip, end - self._position)
+            if isinstance(segment, bytes):
+                chunks.append(segment[skip : skip + count])
+            else:
+                path, offset, _ = segment
+                chunks.append(self._read_source(path, offset + skip, count))
+            self._position += count
+            idx += 1
+        return b"".join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        self._close_source()
+        if self.temporary_path is not None:
+            if os.path.isfile(self.temporary_path):
+                os.remove(self.temporary_path)
+            self.temporary_path = None
+        super().close()
+
+
+def _arcnames(
+    file_list: T.List[str], root_dir: str, arcnames: T.Optional[T.List[str]]
+) -> T.List[str]:
+    if arcnames is None:
+        return [os.path.relpath(fullpath, root_dir) for fullpath in file_list]
+    if len(arcnames) != len(file_list):
+        raise ValueError(f"Expect {len(file_list)} names but got {len(arcnames)}")
+    return arcnames
+
+
+def build_zip_stream(
+    file_list: T.List[str],
+    root_dir: str,
+    on_file: T.Optional[T.Callable[[str], None]] = None,
+    arcnames: T.Optional[T.List[str]] = None,
+) -> ZipStream:
+    """
+    Record the zip archive of the files, stored uncompressed under their paths
+    relative to root_dir (or the given names), and return the stream to read it
+    """
+    recorder = _ZipRecorder()
+    with zipfile.ZipFile(
+        T.cast(T.IO[bytes], recorder), "w", zipfile.ZIP_STORED
+    ) as ziph:
+        for fullpath, relpath in zip(
+            file_list, _arcnames(file_list, root_dir, arcnames)
+        ):
+            zinfo = _zip_info(fullpath, relpath, zipfile.ZIP_STORED)
+            _write_entry(ziph, fullpath, zinfo, recorder)
+            if on_file is not None:
+                on_file(fullpath)
+    return ZipStream(recorder.segments, recorder.md5.hexdigest())
+
+
+def build_zip_file(
+    file_list: T.List[str],
+    root_dir: str,
+    compression: int = zipfile.ZIP_DEFLATED,
+    on_file: T.Optional[T.Callable[[str], None]] = None,
+    path: T.Optional[str] = None,
+    arcnames: T.Optional[T.List[str]] = None,
+) -> ZipStream:
+    """
+    Write the zip archive of the files, compressed, to a temporary file, and return
+    the stream to read it. The file is removed when the stream is closed, unless
+    the path to keep it at is given.
+    """
+    names = _arcnames(file_list, root_dir, arcnames)
+    if path is None:
+        fd, zip_path = tempfile.mkstemp(prefix="mly_tools_", suffix=".zip")
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, zip_path = tempfile.mkstemp(
+            prefix="mly_tools_", suffix=".zip", dir=os.path.dirname(path)
+        )
+    try:
+        with os.fdopen(fd, "wb") as fp, zipfile.ZipFile(fp, "w", compression) as ziph:
+            for fullpath, relpath in zip(file_list, names):
+                _write_entry(ziph, fullpath, _zip_info(fullpath, relpath, compression))
+                if on_file is not None:
+                    on_file(fullpath)
+        md5 = hashlib.md5()
+        with open(zip_path, "rb") as zip_fp:
+            while True:
+                buf = zip_fp.read(READ_BUFFER_SIZE)
+                if not buf:
+                    break
+                md5.update(buf)
+        if path is not None:
+            os.replace(zip_path, path)
+            zip_path = path
+    except BaseException:
+        os.remove(zip_path)
+        raise
+    return ZipStream(
+        [(zip_path, 0, os.path.getsize(zip_path))],
+        md5.hexdigest(),
+        temporary_path=zip_path if path is None else None,
+    )
+
+
+def deflate_saving(file_list: T.List[str]) -> float:
+    """
+    Return the ratio of the total size of the files that deflate saves
+    """
+    total = 0
+    compressed = 0
+    for path in file_list:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        with open(path, "rb") as fp:
+            while True:
+                buf = fp.read(READ_BUFFER_SIZE)
+                if not buf:
+                    break
+                total += len(buf)
+                compressed += len(compressor.compress(buf))
+        compressed += len(compressor.flush())
+    if not total:
+        return 0.0
+    return 1 - compressed / total
+
+
+def resolve_compression(compression: str, file_list: T.List[str]) -> int:
+    """
+    Return the zipfile compression of the compression policy. The auto policy
+    deflates only if it saves enough on the first files, which is rarely the case
+    for the already compressed JPEG images.
+    """
+    if compression == "stored":
+        return zipfile.ZIP_STORED
+    elif compression == "deflate":
+        return zipfile.ZIP_DEFLATED
+    elif compression == "auto":
+        saving = deflate_saving(file_list[:AUTO_SAMPLE_FILES])
+        if saving < AUTO_MIN_DEFLATE_SAVING:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+    else:
+        raise ValueError(
+            f"Invalid zip compression {compression}, expect one of {ZIP_COMPRESSIONS}"
+        )
+
+
+def build_zip(
+    file_list: T.List[str],
+    root_dir: str,
+    compression: str = "auto",
+    on_file: T.Optional[T.Callable[[str], None]] = None,
+    deflate_path: T.Optional[str] = None,
+    arcnames: T.Optional[T.List[str]] = None,
+) -> ZipStream:
+    """
+    Build the zip archive of the files with the compression policy, streamed from
+    the files if they are stored. Deflated archives are kept at deflate_path if
+    given.
+    """
+    if resolve_compression(compression, file_list) == zipfile.ZIP_STORED:
+        return build_zip_stream(file_list, root_dir, on_file=on_file, arcnames=arcnames)
+    return build_zip_file(
+        file_list,
+        root_dir,
+        zipfile.ZIP_DEFLATED,
+        on_file=on_file,
+        path=deflate_path,
+        arcnames=arcnames,
+    )
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    # compare the throughput and the archive size of the compressions
+    # usage: python -m mapillary_tools.zip_stream IMAGE_DIR
+    image_dir = sys.argv[1]
+    images = sorted(
+        os.path.join(image_dir, name)
+        for name in os.listdir(image_dir)
+        if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg")
+    )
+    if not images:
+        raise RuntimeError(f"No JPEG images found in {image_dir}")
+    total_size = sum(os.path.getsize(image) for image in images)
+    print(f"{len(images)} images, {total_size / 1024 / 1024:.1f} MiB")
+    auto = resolve_compression("auto", images)
+    print(f"auto: {'stored' if auto == zipfile.ZIP_STORED else 'deflate'}")
+    for name in ["stored", "deflate"]:
+        start = time.perf_counter()
+        with build_zip(images, image_dir, compression=name) as stream:
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name}: {total_size / elapsed / 1024 / 1024:.1f} MiB/s, "
+                f"archive {stream.size} bytes ({stream.size / total_size:.2%})"
+            )
@@ -1,4 +1,8 @@
+import multiprocessing
+
 from mapillary_tools.__main__ import main
 
 if __name__ == '__main__':
+    # the frozen worker processes run the worker instead of main
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pytest
+
+from mapillary_tools import exif_cache, exif_read, process_state
+
+EXIF_FILE = os.path.join(os.path.dirname(__file__), "data", "test_exif.jpg")
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def state(request, monkeypatch):
+    if request.param == "files":
+        state = process_state.FileProcessState()
+    else:
+        state = process_state.SQLiteProcessState()
+    monkeypatch.setattr(process_state, "_STATE", state)
+    return state
+
+
+def _copy_image(tmpdir):
+    image = str(tmpdir.join("a.jpg"))
+    shutil.copy(EXIF_FILE, image)
+    # files modified just now are not cached
+    os.utime(image, (1600000000, 1600000000))
+    return image
+
+
+def test_read_exif(tmpdir, state):
+    image = _copy_image(tmpdir)
+    exif = exif_read.ExifRead(image)
+
+    for _ in range(2):
+        cached = exif_cache.read_exif(image)
+        assert isinstance(cached, exif_cache.CachedExifRead)
+        assert cached.extract_capture_time() == exif.extract_capture_time()
+        assert cached.extract_lon_lat() == exif.extract_lon_lat()
+        assert cached.extract_altitude() == exif.extract_altitude()
+        assert cached.extract_direction() == exif.extract_direction()
+        assert cached.extract_make() == exif.extract_make()
+        assert cached.extract_model() == exif.extract_model()
+        assert cached.extract_orientation() == exif.extract_orientation()
+        assert cached.extract_image_size() == exif.extract_image_size()
+        assert cached.mapillary_tag_exists() == exif.mapillary_tag_exists()
+    assert state.has_data(image, exif_cache.EXIF_CACHE_DATA_NAME)
+
+
+def test_read_exif_invalidated(tmpdir, state):
+    image = _copy_image(tmpdir)
+    entry = {
+        "version": exif_cache.EXIF_CACHE_VERSION,
+        "size": os.stat(image).st_size,
+        "mtime_ns": os.stat(image).st_mtime_ns,
+        "fields": {"make": "cached"},
+    }
+    state.save_data(image, exif_cache.EXIF_CACHE_DATA_NAME, entry)
+    assert exif_cache.read_exif(image).extract_make() == "cached"
+    with pytest.raises(ValueError):
+        exif_cache.read_exif(image).extract_model()
+
+    with open(image, "ab") as fp:
+        fp.write(b"\0")
+    assert (
+        exif_cache.read_exif(image).extract_make()
+        == exif_read.ExifRead(image).extract_make()
+    )
+
+
+def test_read_exif_racy(tmpdir, state):
+    image = str(tmpdir.join("a.jpg"))
+    shutil.copy(EXIF_FILE, image)
+    exif_cache.read_exif(image)
+    assert not state.has_data(image, exif_cache.EXIF_CACHE_DATA_NAME)
+
+
+def test_read_exif_not_processed(tmpdir, state):
+    image = _copy_image(tmpdir)
+    exif_cache.read_exif(image)
+    assert state.has_data(image, exif_cache.EXIF_CACHE_DATA_NAME)
+    # an image read but never processed has no process state
+    assert exif_cache.EXIF_CACHE_DATA_NAME in process_state.CACHE_DATA_NAMES
+    assert not state.has_state(image)
+
+    state.set_flag(image, "geotag_process_success")
+    assert state.has_state(image)
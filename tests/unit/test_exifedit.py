@@ -1,7 +1,13 @@
+import json
 import os
 import unittest
+import piexif
 from PIL import Image, ExifTags, TiffImagePlugin
-from mapillary_tools.exif_write import ExifEdit
+from mapillary_tools.exif_write import (
+    EXIF_SEGMENT_ALIGNMENT,
+    ExifEdit,
+    exif_segment_range,
+)
 from mapillary_tools.geo import decimal_to_dms
 import datetime
 import shutil
@@ -292,6 +298,53 @@ class ExifEditTests(unittest.TestCase):
         assert "S" == exif_gps_info[EXIF_GPS_TAGS_DICT["GPSLatitudeRef"]]
         assert "W" == exif_gps_info[EXIF_GPS_TAGS_DICT["GPSLongitudeRef"]]
 
+    def test_write_in_place(self):
+
+        exifedit = ExifEdit(EMPTY_EXIF_FILE_TEST)
+        exifedit.add_image_description({"key": "a" * 100})
+        exifedit.write()
+        with open(EMPTY_EXIF_FILE_TEST, "rb") as fp:
+            end, exif_start = exif_segment_range(fp)
+        size = os.path.getsize(EMPTY_EXIF_FILE_TEST)
+        inode = os.stat(EMPTY_EXIF_FILE_TEST).st_ino
+        # the rewritten segment is padded for later edits
+        self.assertEqual(0, (end - exif_start) % EXIF_SEGMENT_ALIGNMENT)
+
+        exifedit = ExifEdit(EMPTY_EXIF_FILE_TEST)
+        exifedit.add_image_description({"key": "b"})
+        exifedit.write()
+
+        self.assertEqual(size, os.path.getsize(EMPTY_EXIF_FILE_TEST))
+        self.assertEqual(inode, os.stat(EMPTY_EXIF_FILE_TEST).st_ino)
+        self.assertEqual(
+            b'{"key": "b"}',
+            piexif.load(EMPTY_EXIF_FILE_TEST)["0th"][piexif.ImageIFD.ImageDescription],
+        )
+
+    def test_write_larger_segment(self):
+
+        with open(EMPTY_EXIF_FILE_TEST, "rb") as fp:
+            end, _ = exif_segment_range(fp)
+            fp.seek(end)
+            image_data = fp.read()
+
+        exifedit = ExifEdit(EMPTY_EXIF_FILE_TEST)
+        exifedit.add_image_description({"key": "a" * 2000})
+        exifedit.write()
+
+        with open(EMPTY_EXIF_FILE_TEST, "rb") as fp:
+            end, _ = exif_segment_range(fp)
+            fp.seek(end)
+            self.assertEqual(image_data, fp.read())
+        self.assertEqual(
+            {"key": "a" * 2000},
+            json.loads(
+                piexif.load(EMPTY_EXIF_FILE_TEST)["0th"][
+                    piexif.ImageIFD.ImageDescription
+                ]
+            ),
+        )
+
     # REPEAT CERTAIN TESTS AND ADD ADDITIONAL TESTS FOR THE CORRUPT EXIF
     def test_load_and_dump_corrupt_exif(self):
 
@@ -1,7 +1,8 @@
 import os
 import unittest
 from PIL import Image, ExifTags
-from mapillary_tools.exif_read import ExifRead
+import exifread
+from mapillary_tools.exif_read import ExifRead, read_exif_segment, parse_exif_tags
 
 """Initialize all the neccessary data"""
 
@@ -134,6 +135,22 @@ def read_direction_general(test_obj, filename):
     test_obj.assertEqual(direction_value_PIL, direction_ExifRead)
 
 
+def read_exif_header_general(test_obj, filename):
+    with open(filename, "rb") as fp:
+        tiff = read_exif_segment(fp, initial_size=16)
+        # only the header is read
+        test_obj.assertLess(fp.tell(), os.path.getsize(filename))
+    test_obj.assertIsNotNone(tiff)
+    tags = parse_exif_tags(tiff)
+
+    with open(filename, "rb") as fp:
+        exifread_tags = exifread.process_file(fp, details=False)
+    for key, tag in tags.items():
+        test_obj.assertEqual(str(tag.values), str(exifread_tags[key].values), key)
+    for key in ["Image Orientation", "EXIF DateTimeOriginal", "GPS GPSLatitude"]:
+        test_obj.assertIn(key, tags)
+
+
 class ExifReadTests(unittest.TestCase):
     """tests for main functions."""
 
@@ -158,6 +175,9 @@ class ExifReadTests(unittest.TestCase):
     def test_read_direction(self):
         read_direction_general(self, TEST_EXIF_FILE)
 
+    def test_read_exif_header(self):
+        read_exif_header_general(self, TEST_EXIF_FILE)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,107 @@
+import datetime
+import random
+
+import pytest
+
+from mapillary_tools import geo, gps_parser
+
+
+def _trace(count, start=datetime.datetime(2021, 1, 1, 12, 0, 0)):
+    random.seed(count)
+    points = []
+    for idx in range(count):
+        points.append(
+            (
+                start
+                + datetime.timedelta(milliseconds=idx * 55 + random.randint(0, 1)),
+                48.0 + random.random() * 0.01,
+                11.0 + random.random() * 0.01,
+                500 + random.random() * 10,
+            )
+        )
+    return points
+
+
+def _linear_interpolate(points, t):
+    for idx, point in enumerate(points):
+        if t < point[0]:
+            return geo._interpolate_between(points[idx - 1], point, t)
+    raise AssertionError("not within the trace")
+
+
+def test_interpolate():
+    points = _trace(1000)
+    trace = geo.GpsTrace(points)
+    start = points[0][0]
+    times = [
+        start + datetime.timedelta(milliseconds=random.randint(1, 54000))
+        for _ in range(200)
+    ]
+    expected = [_linear_interpolate(points, t) for t in times]
+    assert [trace.interpolate(t) for t in times] == expected
+    assert trace.interpolate_many(times) == expected
+    assert [geo.interpolate_lat_lon(points, t) for t in times] == expected
+
+
+def test_interpolate_edges():
+    points = _trace(10)
+    trace = geo.GpsTrace(points, tolerant=1)
+    start, end = points[0][0], points[-1][0]
+    times = [
+        end,
+        start,
+        start - datetime.timedelta(milliseconds=500),
+        end + datetime.timedelta(milliseconds=500),
+    ]
+    results = trace.interpolate_many(times)
+    assert results == [trace.interpolate(t) for t in times]
+    assert results[0][0] == points[-1][1]
+    assert results[1][0] == points[0][1]
+
+    with pytest.raises(geo.MapillaryInterpolationError):
+        trace.interpolate_many(times + [start - datetime.timedelta(seconds=2)])
+    with pytest.raises(geo.MapillaryInterpolationError):
+        trace.interpolate(end + datetime.timedelta(seconds=2))
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_array_kernels(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(geo, "np", None)
+    elif geo.np is None:
+        pytest.skip("NumPy is not installed")
+    points = _trace(100)
+    lats = [p[1] for p in points] + [10.0, -10.0]
+    lons = [p[2] for p in points] + [179.9, -179.9]
+
+    distances = geo.gps_distance_array(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    bearings = geo.compute_bearing_array(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+    assert len(distances) == len(bearings) == len(lats) - 1
+    for idx, (distance, bearing) in enumerate(zip(distances, bearings)):
+        start = (lats[idx], lons[idx])
+        end = (lats[idx + 1], lons[idx + 1])
+        assert distance == pytest.approx(geo.gps_distance(start, end), abs=1e-6)
+        assert bearing == pytest.approx(
+            geo.compute_bearing(start[0], start[1], end[0], end[1]), abs=1e-9
+        )
+    assert geo.gps_distance_array([], [], [], []) == []
+
+
+@pytest.mark.parametrize("local_time", [False, True])
+def test_points_as_read_from_gpx(tmpdir, local_time):
+    points = _trace(100)
+    # a point without a fix, and unsorted points like a video may have
+    points[10] = (points[10][0], 0.0, 0.0, 0.0)
+    points.reverse()
+
+    gpx_path = str(tmpdir.join("trace.gpx"))
+    geo.write_gpx(gpx_path, points)
+    from_gpx = gps_parser.get_lat_lon_time_from_gpx(gpx_path, local_time)
+    from_points = gps_parser.get_lat_lon_time_from_points(points, local_time)
+
+    assert len(from_points) == len(from_gpx) == 99
+    for a, b in zip(from_points, from_gpx):
+        # the GPX times are in milliseconds
+        assert abs((a[0] - b[0].replace(tzinfo=None)).total_seconds()) < 0.001
+        assert a[1:] == pytest.approx(b[1:])
@@ -0,0 +1,218 @@
+import datetime
+import struct
+
+import pytest
+
+from mapillary_tools import gpmf, gpx_from_gopro, utils
+
+
+def _klv(key, type_, size, repeat, payload):
+    assert len(payload) == size * repeat
+    return (
+        key
+        + struct.pack(">cBH", type_, size, repeat)
+        + payload
+        + b"\x00" * (-len(payload) % 4)
+    )
+
+
+def _container(key, *entries):
+    payload = b"".join(entries)
+    return _klv(key, b"\x00", 4, len(payload) // 4, payload)
+
+
+def _payload(gpsu, gps, accl):
+    gps_scale = [10000000, 10000000, 1000, 1000, 100]
+    return _container(
+        b"DEVC",
+        _klv(b"DVID", b"L", 4, 1, struct.pack(">I", 1)),
+        _container(
+            b"STRM",
+            _klv(b"GPSF", b"L", 4, 1, struct.pack(">I", 3)),
+            _klv(b"GPSU", b"U", 16, 1, gpsu),
+            _klv(b"GPSP", b"S", 2, 1, struct.pack(">H", 500)),
+            _klv(b"SCAL", b"l", 4, 5, struct.pack(">5l", *gps_scale)),
+            _klv(
+                b"GPS5",
+                b"l",
+                20,
+                len(gps),
+                b"".join(
+                    struct.pack(
+                        ">5l", *(round(v * s) for v, s in zip(sample, gps_scale))
+                    )
+                    for sample in gps
+                ),
+            ),
+        ),
+        _container(
+            b"STRM",
+            _klv(b"STNM", b"c", 1, 13, b"Accelerometer"),
+            _klv(b"SCAL", b"s", 2, 1, struct.pack(">h", 418)),
+            _klv(
+                b"ACCL",
+                b"s",
+                6,
+                len(accl),
+                b"".join(struct.pack(">3h", *sample) for sample in accl),
+            ),
+        ),
+    )
+
+
+GPS = [
+    [(47.1, 8.5, 400.0, 1.5, 1.25), (47.2, 8.6, 401.0, 2.5, 2.25)],
+    [(47.3, 8.7, 402.0, 3.5, 3.25)],
+]
+ACCL = [[(418, -836, 4180), (0, 0, 418), (0, 418, 0)], [(836, 0, 0)]]
+
+
+@pytest.fixture(params=["numpy", "struct"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(gpmf, "np", None)
+    return request.param
+
+
+def test_parse_gpmf(backend):
+    frames = gpmf.parse_gpmf(
+        _payload(b"210101120000.000", GPS[0], ACCL[0])
+        + _payload(b"210101120001.000", GPS[1], ACCL[1])
+    )
+
+    assert len(frames) == 2
+    for frame, gps, accl in zip(frames, GPS, ACCL):
+        assert frame.gps_fix == 3
+        assert frame.gps_precision == 500
+        assert [tuple(sample) for sample in frame.gps] == [
+            pytest.approx(sample) for sample in gps
+        ]
+        assert [tuple(sample) for sample in frame.accl] == [
+            pytest.approx(tuple(v / 418 for v in sample)) for sample in accl
+        ]
+        assert len(frame.gyro) == 0
+    assert frames[0].time == datetime.datetime(2021, 1, 1, 12, 0, 0)
+    assert frames[1].time == datetime.datetime(2021, 1, 1, 12, 0, 1)
+
+
+def test_parse_empty(backend):
+    assert gpmf.parse_gpmf(b"") == []
+    # a payload without GPS samples
+    assert gpmf.parse_gpmf(_payload(b"210101120000.000", [], ACCL[0])) == []
+
+
+def _box(box_type, *payloads):
+    payload = b"".join(payloads)
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def _full_box(box_type, *payloads):
+    return _box(box_type, b"\x00\x00\x00\x00", *payloads)
+
+
+def _trak(sample_format, sizes, chunk_offsets, samples_per_chunk, deltas):
+    sample_entry = _box(sample_format, b"\x00" * 6, struct.pack(">H", 1))
+    stbl = _box(
+        b"stbl",
+        _full_box(b"stsd", struct.pack(">I", 1), sample_entry),
+        _full_box(
+            b"stts",
+            struct.pack(">I", len(deltas)),
+            *(struct.pack(">II", count, delta) for count, delta in deltas),
+        ),
+        _full_box(b"stsc", struct.pack(">IIII", 1, 1, samples_per_chunk, 1)),
+        _full_box(
+            b"stsz",
+            struct.pack(">II", 0, len(sizes)),
+            *(struct.pack(">I", size) for size in sizes),
+        ),
+        _full_box(
+            b"co64",
+            struct.pack(">I", len(chunk_offsets)),
+            *(struct.pack(">Q", offset) for offset in chunk_offsets),
+        ),
+    )
+    # timescale 1000
+    mdhd = _full_box(b"mdhd", struct.pack(">IIIIHH", 0, 0, 1000, 0, 0x55C4, 0))
+    return _box(b"trak", _box(b"mdia", mdhd, _box(b"minf", stbl)))
+
+
+def _gopro_video(path, samples, telemetry=True):
+    ftyp = _box(b"ftyp", b"mp41\x00\x00\x00\x00")
+    # video data between the telemetry chunks
+    video = b"\xff" * 1000
+    mdat = _box(b"mdat", video, samples[0], samples[1], video, samples[2])
+    mdat_start = len(ftyp) + 8
+    chunk_offsets = [
+        mdat_start + len(video),
+        mdat_start + 2 * len(video) + len(samples[0]) + len(samples[1]),
+    ]
+    traks = [
+        _trak(b"avc1", [len(video)] * 2, [mdat_start, chunk_offsets[1]], 1, [(2, 1500)])
+    ]
+    if telemetry:
+        traks.append(
+            _trak(
+                b"gpmd",
+                [len(sample) for sample in samples],
+                chunk_offsets,
+                2,
+                [(2, 1001), (1, 1000)],
+            )
+        )
+    path.write_binary(ftyp + mdat + _box(b"moov", *traks))
+
+
+def test_extract_telemetry(tmpdir, backend):
+    samples = [
+        _payload(b"210101120000.000", GPS[0], ACCL[0]),
+        _payload(b"210101120001.000", GPS[1], ACCL[1]),
+        _payload(b"210101120002.000", GPS[0], ACCL[0]),
+    ]
+    path = tmpdir.join("GOPR0001.MP4")
+    _gopro_video(path, samples)
+
+    telemetry = gpx_from_gopro.extract_telemetry(str(path))
+    assert telemetry.gps_epoch == datetime.datetime(2021, 1, 1, 12, 0, 0)
+    assert list(telemetry.gps_times) == pytest.approx([0, 0.5005, 1.001, 2.002, 2.502])
+    assert telemetry.gps_fix == [3] * 5
+    # every accelerometer sample, spread over its payload
+    assert len(telemetry.accl) == 7
+    assert list(telemetry.accl_times) == pytest.approx(
+        [0, 1.001 / 3, 2.002 / 3, 1.001, 2.002, 2.002 + 1 / 3, 2.002 + 2 / 3]
+    )
+    assert len(telemetry.gyro) == len(telemetry.gyro_times) == 0
+
+    points = gpx_from_gopro.get_points_from_gpmf(str(path))
+    assert [point[1:4] for point in points] == [
+        pytest.approx(sample[:3]) for sample in GPS[0] + GPS[1] + GPS[0]
+    ]
+    assert points[-1][0] == datetime.datetime(2021, 1, 1, 12, 0, 2, 502000)
+
+    # a video without telemetry
+    _gopro_video(path, samples, telemetry=False)
+    with pytest.raises(IOError):
+        gpx_from_gopro.extract_telemetry(str(path))
+
+
+def test_gopro_traces_in_processes(tmpdir):
+    paths = []
+    for idx in range(3):
+        path = tmpdir.join(f"GOPR000{idx}.MP4")
+        _gopro_video(
+            path,
+            [
+                _payload(f"21010112{idx}000.000".encode(), GPS[0], ACCL[0]),
+                _payload(f"21010112{idx}001.000".encode(), GPS[1], ACCL[1]),
+                _payload(f"21010112{idx}002.000".encode(), GPS[0], ACCL[0]),
+            ],
+        )
+        paths.append(str(path))
+
+    traces = utils.map_with_workers(
+        gpx_from_gopro.gopro_trace, paths, workers=2, worker_type="process"
+    )
+    assert traces == [gpx_from_gopro.gopro_trace(path) for path in paths]
+    assert [trace[0][0].minute for trace in traces] == [0, 10, 20]
@@ -0,0 +1,105 @@
+import io
+import os
+import shutil
+import struct
+import sys
+import zipfile
+
+import piexif
+import pytest
+
+from mapillary_tools import jpeg_optimize, zip_stream
+
+EXIF_FILE = os.path.join(os.path.dirname(__file__), "data", "test_exif.jpg")
+
+# stands in for jpegtran: drops the COM segments, which makes the copy smaller
+# and leaves the EXIF as it is
+FAKE_JPEGTRAN = """#!{python}
+import struct, sys
+output, image = sys.argv[-2], sys.argv[-1]
+with open(image, "rb") as fp:
+    data = fp.read()
+out, offset = [data[:2]], 2
+while data[offset : offset + 2] != b"\\xff\\xda":
+    (length,) = struct.unpack(">H", data[offset + 2 : offset + 4])
+    if data[offset : offset + 2] != b"\\xff\\xfe":
+        out.append(data[offset : offset + 2 + length])
+    offset += 2 + length
+out.append(data[offset:])
+with open(output, "wb") as fp:
+    fp.write(b"".join(out))
+"""
+
+
+def _image_with_comment(path, comment_size):
+    with open(EXIF_FILE, "rb") as fp:
+        data = fp.read()
+    comment = b"\xff\xfe" + struct.pack(">H", comment_size + 2) + b"x" * comment_size
+    with open(path, "wb") as fp:
+        fp.write(data[:2] + comment + data[2:])
+
+
+@pytest.fixture
+def fake_jpegtran(tmpdir, monkeypatch):
+    path = tmpdir.join("bin", "jpegtran")
+    path.write(FAKE_JPEGTRAN.format(python=sys.executable), ensure=True)
+    os.chmod(str(path), 0o755)
+    monkeypatch.setattr(jpeg_optimize, "JPEGTRAN", str(path))
+    return str(path)
+
+
+def test_optimize_images(tmpdir, fake_jpegtran):
+    root_dir = str(tmpdir.join("images"))
+    file_list = []
+    for idx, comment_size in enumerate([1000, 0, 5000]):
+        path = os.path.join(root_dir, f"{idx}.jpg")
+        os.makedirs(root_dir, exist_ok=True)
+        if comment_size:
+            _image_with_comment(path, comment_size)
+        else:
+            shutil.copy(EXIF_FILE, path)
+        file_list.append(path)
+    originals = [open(path, "rb").read() for path in file_list]
+
+    output_dir = str(tmpdir.join("staging"))
+    results = jpeg_optimize.optimize_images(file_list, root_dir, output_dir)
+
+    assert [result.image for result in results] == file_list
+    assert [result.saved_bytes for result in results] == [1004, 0, 5004]
+    # the copy is not used if it is not smaller
+    assert results[1].path == file_list[1]
+    assert not os.path.exists(os.path.join(output_dir, "1.jpg"))
+    for result in [results[0], results[2]]:
+        assert result.path == os.path.join(output_dir, os.path.basename(result.image))
+        assert piexif.load(result.path) == piexif.load(result.image)
+        assert result.cpu_seconds >= 0
+    # the images are left as they are
+    assert [open(path, "rb").read() for path in file_list] == originals
+    assert "saved 6008 bytes" in jpeg_optimize.summarize(results)
+
+    # the copies are archived under the names of the images
+    with zip_stream.build_zip_stream(
+        [result.path for result in results],
+        root_dir,
+        arcnames=[os.path.relpath(path, root_dir) for path in file_list],
+    ) as stream:
+        data = stream.read()
+    with zipfile.ZipFile(io.BytesIO(data)) as ziph:
+        assert ziph.namelist() == ["0.jpg", "1.jpg", "2.jpg"]
+        assert ziph.read("1.jpg") == originals[1]
+        assert len(ziph.read("2.jpg")) == len(originals[2]) - 5004
+
+
+def test_jpegtran_not_found(tmpdir, monkeypatch):
+    monkeypatch.setattr(jpeg_optimize, "JPEGTRAN", str(tmpdir.join("jpegtran")))
+    with pytest.raises(RuntimeError):
+        jpeg_optimize.check_jpegtran()
+
+
+@pytest.mark.skipif(shutil.which("jpegtran") is None, reason="jpegtran not found")
+def test_jpegtran(tmpdir):
+    image = str(tmpdir.join("a.jpg"))
+    shutil.copy(EXIF_FILE, image)
+    result = jpeg_optimize.optimize_image(image, str(tmpdir.join("out", "a.jpg")))
+    assert result.optimized_size <= result.original_size
+    assert piexif.load(result.path) == piexif.load(image)
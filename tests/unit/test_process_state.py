@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from mapillary_tools import process_state, uploader
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def state(request):
+    if request.param == "files":
+        return process_state.FileProcessState()
+    else:
+        return process_state.SQLiteProcessState()
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "a").close()
+
+
+def test_flags(tmpdir, state):
+    image = str(tmpdir.join("a.jpg"))
+    _touch(image)
+    assert state.flags(image) == set()
+    assert not state.has_state(image)
+
+    state.set_flag(image, "geotag_process_success", record_history=True)
+    state.set_flag(image, "duplicate")
+    assert state.has_state(image)
+    assert state.flags(image) == {"geotag_process_success", "duplicate"}
+    assert state.has_flag(image, "duplicate")
+
+    state.clear_flag(image, "duplicate")
+    assert not state.has_flag(image, "duplicate")
+    assert state.flags(image) == {"geotag_process_success"}
+
+
+def test_data(tmpdir, state):
+    image = str(tmpdir.join("a.jpg"))
+    _touch(image)
+    assert not state.has_data(image, "geotag_process")
+    assert state.load_data(image, "geotag_process") == {}
+
+    with state.transaction():
+        state.save_data(image, "geotag_process", {"MAPLatitude": 1.0})
+        state.set_flag(image, "geotag_process_success")
+    assert state.has_data(image, "geotag_process")
+    assert state.load_data(image, "geotag_process") == {"MAPLatitude": 1.0}
+
+    state.remove_data(image, "geotag_process")
+    assert not state.has_data(image, "geotag_process")
+
+
+def test_move(tmpdir, state):
+    image = str(tmpdir.join("a.jpg"))
+    destination = str(tmpdir.join("uploaded", "b.jpg"))
+    _touch(image)
+    state.set_flag(image, "upload_success")
+    state.save_data(image, "sequence_process", {"MAPSequenceUUID": "abc"})
+
+    _touch(destination)
+    os.remove(image)
+    state.move(image, destination)
+
+    assert state.flags(image) == set()
+    assert state.flags(destination) == {"upload_success"}
+    assert state.load_data(destination, "sequence_process") == {
+        "MAPSequenceUUID": "abc"
+    }
+
+
+def test_migrate_logs(tmpdir):
+    image = str(tmpdir.join("a.jpg"))
+    _touch(image)
+    files_state = process_state.FileProcessState()
+    files_state.set_flag(image, "sequence_process_success", record_history=True)
+    files_state.set_flag(image, "duplicate")
+    files_state.save_data(image, "sequence_process", {"MAPSequenceUUID": "abc"})
+
+    sqlite_state = process_state.SQLiteProcessState()
+    assert sqlite_state.flags(image) == {"sequence_process_success", "duplicate"}
+    assert sqlite_state.load_data(image, "sequence_process") == {
+        "MAPSequenceUUID": "abc"
+    }
+    assert os.path.isfile(process_state.state_db_path(str(tmpdir)))
+
+
+def test_status_index(tmpdir):
+    state = process_state.get_process_state()
+    uploaded = str(tmpdir.join("a.jpg"))
+    duplicate = str(tmpdir.join("sub", "b.jpg"))
+    processed = str(tmpdir.join("sub", "c.JPG"))
+    for path in [uploaded, duplicate, processed, str(tmpdir.join("notes.txt"))]:
+        _touch(path)
+    _touch(str(tmpdir.join(".hidden", "d.jpg")))
+    state.set_flag(uploaded, "mapillary_image_description_success")
+    state.set_flag(uploaded, "upload_success")
+    state.set_flag(duplicate, "duplicate")
+    state.set_flag(duplicate, "sequence_process_success")
+    state.set_flag(processed, "mapillary_image_description_success")
+    state.set_flag(processed, "sequence_process_success")
+
+    index = uploader.StatusIndex(str(tmpdir))
+    assert index.total_file_list() == [uploaded, duplicate, processed]
+    assert index.upload_file_list() == [processed]
+    assert index.success_upload_file_list() == [uploaded]
+    assert index.duplicate_file_list() == [duplicate]
+    assert index.process_file_list("sequence_process") == []
+    assert index.process_file_list("geotag_process") == [duplicate, processed]
+    assert index.process_file_list("sequence_process", rerun=True) == [
+        duplicate,
+        processed,
+    ]
+    assert index.process_status_file_list("sequence_process", "success") == [
+        duplicate,
+        processed,
+    ]
+    assert uploader.StatusIndex(str(tmpdir), skip_subfolders=True).flags == {
+        uploaded: {"mapillary_image_description_success", "upload_success"}
+    }
@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+
+from mapillary_tools import rate_limit
+
+
+def test_parse_rate():
+    assert rate_limit.parse_rate("500000") == 500000
+    assert rate_limit.parse_rate("512K") == 512 * 1024
+    assert rate_limit.parse_rate("1.5m") == 1.5 * 1024 * 1024
+    assert rate_limit.parse_rate("2MiB/s") == 2 * 1024 * 1024
+    assert rate_limit.parse_rate("unlimited") is None
+    for text in ["", "0", "fast", "2T"]:
+        with pytest.raises(ValueError):
+            rate_limit.parse_rate(text)
+
+
+def test_parse_schedule():
+    schedule = rate_limit.parse_schedule("08:00-18:00=512K, 22:00-06:00=unlimited, 2M")
+    assert schedule.rate_at(datetime.time(9, 30)) == 512 * 1024
+    assert schedule.rate_at(datetime.time(18, 0)) == 2 * 1024 * 1024
+    assert schedule.rate_at(datetime.time(23, 0)) is None
+    assert schedule.rate_at(datetime.time(5, 59)) is None
+    assert (
+        rate_limit.parse_schedule("08:00-18:00=1M").rate_at(datetime.time(20)) is None
+    )
+    for text in ["1M,2M", "25:00-26:00=1M", "08:00-18:00=fast"]:
+        with pytest.raises(ValueError):
+            rate_limit.parse_schedule(text)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = _Clock()
+    day = [datetime.datetime(2021, 1, 1, 12, 0)]
+    schedule = rate_limit.parse_schedule("12:00-13:00=64K,unlimited")
+    bucket = rate_limit.TokenBucket(
+        schedule, clock=clock, sleep=clock.sleep, now=lambda: day[0]
+    )
+    data = rate_limit.ThrottledData(bytes(640 * 1024), bucket)
+    assert len(data) == 640 * 1024
+    assert b"".join(data) == bytes(640 * 1024)
+    assert clock.now == pytest.approx(10)
+
+    # the bucket refills at most one second of the rate while idle
+    clock.now += 100
+    bucket.consume(128 * 1024)
+    assert clock.now == pytest.approx(111)
+
+    # no limit outside the window
+    day[0] = datetime.datetime(2021, 1, 1, 14, 0)
+    bucket.consume(1024 * 1024 * 1024)
+    assert clock.now == pytest.approx(111)
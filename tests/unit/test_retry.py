@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+
+import pytest
+import requests
+
+from mapillary_tools import retry, upload_api_v4
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _http_error(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return requests.HTTPError(f"HTTP {status_code}", response=response)
+
+
+def _policy(clock, **kwargs):
+    # the upper bound of the jitter
+    return upload_api_v4.create_retry_policy(
+        clock=clock, uniform=lambda low, high: high, **kwargs
+    )
+
+
+def test_is_retryable():
+    policy = upload_api_v4.create_retry_policy()
+    assert policy.is_retryable(requests.ConnectionError())
+    assert policy.is_retryable(requests.Timeout())
+    for status_code in [408, 429, 500, 502, 503, 504]:
+        assert policy.is_retryable(_http_error(status_code))
+    for status_code in [400, 401, 403, 404]:
+        assert not policy.is_retryable(_http_error(status_code))
+    assert not policy.is_retryable(ValueError())
+
+
+def test_full_jitter():
+    policy = upload_api_v4.create_retry_policy(max_seconds=16)
+    delays = [policy.backoff(attempt) for attempt in range(1, 8) for _ in range(100)]
+    assert all(0 <= delay <= 16 for delay in delays)
+    assert len(set(delays)) > 100
+    assert max(policy.backoff(1) for _ in range(100)) <= 2
+
+
+def test_retry_after():
+    clock = _Clock()
+    retrying = _policy(clock).start()
+    assert retrying.next_delay(_http_error(503)) == 2
+    assert retrying.next_delay(_http_error(429, {"Retry-After": "7"})) == 7
+    assert retrying.next_delay(_http_error(503, {"Retry-After": "soon"})) == 8
+
+    now = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    assert retry.parse_retry_after("Fri, 01 Jan 2021 00:00:30 GMT", now) == 30
+    assert retry.parse_retry_after("Thu, 31 Dec 2020 00:00:00 GMT", now) == 0
+    with pytest.raises(ValueError):
+        retry.parse_retry_after("soon")
+
+
+def test_limits():
+    clock = _Clock()
+    retrying = _policy(clock, max_attempts=3, deadline=None).start()
+    assert retrying.next_delay(_http_error(400)) is None
+    assert retrying.next_delay(requests.ConnectionError()) == 2
+    assert retrying.next_delay(requests.ConnectionError()) == 4
+    assert retrying.next_delay(requests.ConnectionError()) is None
+    # progress restarts the attempts
+    retrying.reset()
+    assert retrying.next_delay(requests.ConnectionError()) == 2
+
+    retrying = _policy(clock, deadline=10).start()
+    assert retrying.next_delay(requests.ConnectionError()) == 2
+    clock.now += 5
+    assert retrying.next_delay(requests.ConnectionError()) == 4
+    clock.now += 4
+    # the next retry would end after the deadline
+    assert retrying.next_delay(requests.ConnectionError()) is None
+    assert retrying.next_delay(_http_error(503, {"Retry-After": "1"})) == 1
+
+
+def test_call():
+    clock = _Clock()
+    policy = _policy(clock)
+    errors = [requests.ConnectionError(), _http_error(503), _http_error(429)]
+
+    def _request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert policy.call(_request, sleep=clock.sleep) == "ok"
+    assert clock.now == 2 + 4 + 8
+
+    errors = [_http_error(503), _http_error(404)]
+    with pytest.raises(requests.HTTPError, match="404"):
+        policy.call(_request, sleep=clock.sleep)
+
+
+def test_call_async(monkeypatch):
+    clock = _Clock()
+    errors = [ConnectionError(), ConnectionError()]
+
+    async def _sleep(seconds):
+        clock.sleep(seconds)
+
+    async def _request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    monkeypatch.setattr(asyncio, "sleep", _sleep)
+    loop = asyncio.new_event_loop()
+    try:
+        policy = retry.RetryPolicy(clock=clock, uniform=lambda low, high: high)
+        assert loop.run_until_complete(policy.call_async(_request)) == "ok"
+    finally:
+        loop.close()
+    assert clock.now == 2 + 4
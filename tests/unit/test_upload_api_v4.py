@@ -0,0 +1,389 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+
+import pytest
+import requests
+
+from mapillary_tools import (
+    jpeg_optimize,
+    process_state,
+    rate_limit,
+    upload_api_v4,
+    upload_journal,
+    uploader,
+)
+
+
+class _UploadHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        session_key = self.path.lstrip("/")
+        self._respond(200, {"offset": self.server.committed(session_key)})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/finish_upload":
+            self._respond(200, {"cluster_id": json.loads(body)["file_handle"]})
+            return
+        session_key = self.path.lstrip("/")
+        offset = int(self.headers["Offset"])
+        entity_size = int(self.headers["X-Entity-Length"])
+        status, data = self.server.write(session_key, offset, entity_size, body)
+        self._respond(status, data)
+
+
+class _UploadServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Stand-in of the upload server. It accepts a chunk only at the committed offset,
+    and returns the handle once all the bytes are committed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _UploadHandler)
+        # session key -> {offset: chunk}
+        self.chunks = {}
+        self.offsets = []
+        self.fail_offsets = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def committed(self, session_key):
+        with self.lock:
+            chunks = self.chunks.get(session_key, {})
+            offset = 0
+            while chunks.get(offset):
+                offset += len(chunks[offset])
+            return offset
+
+    def assembled(self, session_key):
+        chunks = self.chunks[session_key]
+        return b"".join(chunks[offset] for offset in sorted(chunks))
+
+    def write(self, session_key, offset, entity_size, chunk):
+        committed = self.committed(session_key)
+        if not chunk:
+            if committed != entity_size:
+                return 412, {"error": f"{committed} of {entity_size} bytes uploaded"}
+            return 200, {"h": session_key}
+        with self.lock:
+            if offset in self.fail_offsets:
+                self.fail_offsets.remove(offset)
+                return 500, {"error": "try again"}
+            if offset + len(chunk) > entity_size:
+                return 412, {"error": f"offset {offset} beyond {entity_size}"}
+            if offset != committed:
+                return 412, {"error": f"offset {offset} != {committed}"}
+            chunks = self.chunks.setdefault(session_key, {})
+            if chunks.get(offset, chunk) != chunk:
+                return 412, {"error": f"offset {offset} overwritten"}
+            chunks[offset] = chunk
+            self.offsets.append(offset)
+        return 200, {"h": session_key}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = _UploadServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(upload_api_v4, "MAPILLARY_UPLOAD_ENDPOINT", server.url)
+    monkeypatch.setattr(upload_api_v4, "MAPILLARY_GRAPH_API_ENDPOINT", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload(server):
+    data = bytes(range(256)) * 1000
+    with upload_api_v4.UploadService("token", "key", len(data)) as service:
+        resp = service.upload(io.BytesIO(data), chunk_size=10000)
+        assert resp.json()["h"] == "key"
+        assert server.assembled("key") == data
+        assert service.fetch_offset() == len(data)
+        assert service.finish("key").json()["cluster_id"] == "key"
+        # all requests are sent over one kept alive connection
+        assert service.connections_opened == 1
+        closed = []
+        service.session.close = lambda: closed.append(True)
+    # the service closes the session it created
+    assert closed == [True]
+
+
+def test_shared_session(server):
+    session = upload_api_v4.create_session(pool_size=2)
+    for idx in range(3):
+        data = str(idx).encode("utf-8") * 1000
+        service = upload_api_v4.UploadService(
+            "token", f"key{idx}", len(data), session=session
+        )
+        with service:
+            service.upload(io.BytesIO(data), chunk_size=300)
+        assert server.assembled(f"key{idx}") == data
+    # the shared session is left open, and its connection reused
+    assert upload_api_v4.connections_opened(session) == 1
+
+
+def test_upload_rate_limit(server):
+    data = bytes(range(256)) * 2048
+    bucket = rate_limit.TokenBucket(rate_limit.RateSchedule(1024 * 1024))
+    service = upload_api_v4.UploadService(
+        "token", "key", len(data), rate_limiter=bucket
+    )
+    start = time.monotonic()
+    service.upload(io.BytesIO(data), chunk_size=100000)
+    # the bucket starts empty, so 512 KiB at 1 MiB/s take half a second
+    assert time.monotonic() - start >= 0.4
+    assert server.assembled("key") == data
+
+
+@pytest.mark.parametrize("read_ahead_chunks", [1, 4])
+def test_upload_read_ahead(server, read_ahead_chunks):
+    data = bytes(range(256)) * 1000
+    service = upload_api_v4.UploadService("token", "key", len(data))
+    committed = []
+    service.callbacks.append(lambda chunk, _: committed.append(len(chunk)))
+    resp = service.upload(
+        io.BytesIO(data), chunk_size=10000, read_ahead_chunks=read_ahead_chunks
+    )
+    assert resp.json()["h"] == "key"
+    assert server.assembled("key") == data
+    # the server only accepts the chunks in order
+    assert server.offsets == list(range(0, len(data), 10000))
+    assert committed == [10000] * 25 + [6000, 0]
+    assert service.connections_opened == 1
+
+
+def test_upload_read_ahead_resume(server):
+    data = bytes(range(256)) * 1000
+    server.fail_offsets.add(50000)
+    service = upload_api_v4.UploadService("token", "key", len(data))
+    committed = []
+    service.callbacks.append(lambda chunk, _: committed.append(len(chunk)))
+    with pytest.raises(requests.HTTPError):
+        service.upload(io.BytesIO(data), chunk_size=10000, read_ahead_chunks=4)
+    # only the chunks before the failed one are committed
+    assert sum(committed) == 50000
+    offset = service.fetch_offset()
+    assert offset == 50000
+    fp = io.BytesIO(data)
+    service.upload(fp, offset=offset, chunk_size=10000, read_ahead_chunks=4)
+    assert server.assembled("key") == data
+
+
+MiB = 1024 * 1024
+
+
+class _Response:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class _SimulatedNetwork:
+    """
+    Session that simulates a network on a virtual clock. Each request takes the
+    latency plus its bytes over the bandwidth, and fails on the way with the
+    failure rate per MiB sent.
+    """
+
+    def __init__(self, bandwidth, latency, failure_rate, seed=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.uploaded = 0
+        self.chunk_sizes = []
+
+    def monotonic(self):
+        return self.now
+
+    def get(self, url, headers, timeout):
+        self.now += self.latency
+        return _Response({"offset": self.uploaded})
+
+    def post(self, url, headers, data, timeout):
+        size = len(data)
+        failure = 1 - (1 - self.failure_rate) ** (size / MiB)
+        if self.random.random() < failure:
+            self.now += self.latency + self.random.random() * size / self.bandwidth
+            raise requests.ConnectionError("simulated failure")
+        self.now += self.latency + size / self.bandwidth
+        assert int(headers["Offset"]) == self.uploaded
+        self.uploaded += size
+        if size:
+            self.chunk_sizes.append(size)
+        return _Response({"h": "handle"})
+
+
+def _simulate_upload(network, data, chunk_size, adaptive):
+    controller = (
+        upload_api_v4.ChunkSizeController(chunk_size, MiB, 32 * MiB)
+        if adaptive
+        else None
+    )
+    service = upload_api_v4.UploadService(
+        "token",
+        "key",
+        len(data),
+        session=network,
+        chunk_size_controller=controller,
+    )
+    while True:
+        try:
+            offset = service.fetch_offset()
+            service.upload(io.BytesIO(data), offset=offset, chunk_size=chunk_size)
+        except requests.ConnectionError:
+            continue
+        else:
+            break
+    assert network.uploaded == len(data)
+    return network.now
+
+
+@pytest.mark.parametrize(
+    "network, chunk_size",
+    [
+        # fibre: small chunks waste round trips
+        (dict(bandwidth=100 * MiB, latency=0.1, failure_rate=0), MiB),
+        # flaky LTE: large chunks waste retries
+        (dict(bandwidth=MiB / 2, latency=0.3, failure_rate=0.05), 32 * MiB),
+    ],
+    ids=["fibre", "lte"],
+)
+def test_adaptive_chunk_size(monkeypatch, network, chunk_size):
+    data = bytes(64 * MiB)
+    elapsed = {}
+    for adaptive in [False, True]:
+        # total over a few seeds, since a single upload may be lucky
+        elapsed[adaptive] = 0.0
+        for seed in range(5):
+            simulated = _SimulatedNetwork(seed=seed, **network)
+            monkeypatch.setattr(upload_api_v4, "time", simulated)
+            elapsed[adaptive] += _simulate_upload(simulated, data, chunk_size, adaptive)
+    assert elapsed[True] < elapsed[False] * 0.75
+
+
+def test_chunk_size_controller():
+    controller = upload_api_v4.ChunkSizeController(
+        4 * MiB, MiB, 32 * MiB, target_seconds=4
+    )
+    # grows at most twice per chunk after successive fast chunks
+    controller.on_success(4 * MiB, 0.1)
+    assert controller.chunk_size == 4 * MiB
+    controller.on_success(4 * MiB, 0.1)
+    assert controller.chunk_size == 8 * MiB
+    for _ in range(10):
+        controller.on_success(controller.chunk_size, 0.1)
+    assert controller.chunk_size == 32 * MiB
+    # halves on failures, down to the minimum
+    controller.on_failure()
+    assert controller.chunk_size == 16 * MiB
+    for _ in range(10):
+        controller.on_failure()
+    assert controller.chunk_size == MiB
+    with pytest.raises(ValueError):
+        upload_api_v4.ChunkSizeController(MiB, 2 * MiB, MiB)
+
+
+class _FakeStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.size = len(data)
+        self.md5sum = hashlib.md5(data).hexdigest()
+
+
+@pytest.mark.parametrize(
+    "dry_run, fail, journal, kept",
+    [
+        (True, False, True, False),
+        (False, True, True, True),
+        (False, True, False, False),
+    ],
+)
+def test_upload_sequence_staging_dir(
+    tmpdir, server, monkeypatch, dry_run, fail, journal, kept
+):
+    monkeypatch.setattr(process_state, "_STATE", process_state.FileProcessState())
+    monkeypatch.setattr(upload_journal, "UPLOAD_JOURNAL_ENABLED", journal)
+    image = tmpdir.join("images", "0.jpg")
+    image.write_binary(b"x" * 1000, ensure=True)
+    staging_dir = jpeg_optimize.staging_dir([str(image)], "seq")
+    os.makedirs(staging_dir)
+    archive = uploader.SequenceArchive(
+        "seq",
+        [str(image)],
+        str(image.dirpath()),
+        {},
+        "token",
+        _FakeStream(b"y" * 1000),
+        {},
+    )
+
+    def _upload():
+        uploader.upload_sequence_archive_v4(
+            archive,
+            dry_run=dry_run,
+            on_progress=lambda _: None,
+            retry_policy=upload_api_v4.create_retry_policy(max_attempts=1),
+        )
+
+    if fail:
+        server.fail_offsets.add(0)
+        with pytest.raises(Exception):
+            _upload()
+    else:
+        _upload()
+    # the optimized copies are kept only for the journal to resume the upload
+    assert os.path.isdir(staging_dir) == kept
+
+
+def test_upload_sequence_finish_error(tmpdir, server, monkeypatch):
+    monkeypatch.setattr(process_state, "_STATE", process_state.FileProcessState())
+    image = tmpdir.join("images", "0.jpg")
+    image.write_binary(b"x" * 1000, ensure=True)
+    archive = uploader.SequenceArchive(
+        "seq", [str(image)], str(image.dirpath()), {}, "token", _FakeStream(b"y"), {}
+    )
+
+    def _finish(*args, **kwargs):
+        raise requests.ConnectionError("connection reset")
+
+    monkeypatch.setattr(upload_api_v4.UploadService, "finish", _finish)
+    with pytest.raises(requests.ConnectionError):
+        uploader.upload_sequence_archive_v4(
+            archive,
+            on_progress=lambda _: None,
+            retry_policy=upload_api_v4.create_retry_policy(max_attempts=1),
+        )
+    # the failure is logged once the finish retries run out, whatever the error
+    assert uploader.failed_upload(str(image))
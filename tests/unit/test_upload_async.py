@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import io
+import threading
+
+import pytest
+
+from mapillary_tools import upload_api_v4_async, upload_async, upload_journal, uploader
+
+
+class _FakeStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.size = len(data)
+        self.md5sum = hashlib.md5(data).hexdigest()
+
+
+class _FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+        self.text = str(data)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}: {self.text}")
+
+    def json(self):
+        return self.data
+
+
+class _FakeClient:
+    """
+    Stand-in of httpx.AsyncClient talking to the upload server. It fails the chunks
+    at fail_offsets once with a connection error, and the sequences in fail_sessions
+    with a client error.
+    """
+
+    def __init__(self):
+        # session key -> uploaded bytes
+        self.sessions = {}
+        self.finished = []
+        self.fail_offsets = set()
+        self.fail_sessions = set()
+        self.active = 0
+        self.max_active = 0
+
+    async def get(self, url, headers=None):
+        session_key = url.rsplit("/", 1)[1]
+        return _FakeResponse(200, {"offset": len(self.sessions.get(session_key, b""))})
+
+    async def post(self, url, headers=None, content=None, json=None):
+        if url.endswith("/finish_upload"):
+            self.finished.append(json["file_handle"])
+            return _FakeResponse(200, {"cluster_id": len(self.finished)})
+        session_key = url.rsplit("/", 1)[1]
+        offset = int(headers["Offset"])
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.active -= 1
+        if session_key in self.fail_sessions:
+            return _FakeResponse(400, {"error": "bad request"})
+        if offset in self.fail_offsets:
+            self.fail_offsets.remove(offset)
+            raise ConnectionError("connection reset")
+        uploaded = self.sessions.setdefault(session_key, b"")
+        if offset != len(uploaded):
+            return _FakeResponse(412, {"error": f"offset {offset} != {len(uploaded)}"})
+        self.sessions[session_key] = uploaded + content
+        return _FakeResponse(200, {"h": session_key})
+
+
+def _data(sequence_uuid):
+    return sequence_uuid.encode("utf-8") * 50000
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    archives = {}
+    completed = []
+
+    def _prepare(file_list, sequence_uuid, file_params, metadata=None, **kwargs):
+        assert threading.current_thread() is not threading.main_thread()
+        for path in file_list:
+            kwargs["on_file"](path)
+        archive = uploader.SequenceArchive(
+            sequence_uuid,
+            file_list,
+            "/",
+            {},
+            "token",
+            _FakeStream(_data(sequence_uuid)),
+            metadata,
+        )
+        archives[sequence_uuid] = archive
+        return archive
+
+    sleep = asyncio.sleep
+    # no backoff
+    monkeypatch.setattr(
+        asyncio, "sleep", lambda seconds, *args: sleep(min(seconds, 0.01), *args)
+    )
+    monkeypatch.setattr(uploader, "MIN_CHUNK_SIZE", 10000)
+    monkeypatch.setattr(uploader, "ADAPTIVE_CHUNK_SIZE", False)
+    monkeypatch.setattr(upload_journal, "UPLOAD_JOURNAL_ENABLED", False)
+    monkeypatch.setattr(uploader, "prepare_sequence_v4", _prepare)
+
+    def _log_upload_failed(archive):
+        assert threading.current_thread() is not threading.main_thread()
+        completed.append(None)
+
+    def _complete_sequence(archive, resp):
+        # the files are logged, recorded and flagged off the event loop
+        assert threading.current_thread() is not threading.main_thread()
+        completed.append(archive.sequence_uuid)
+
+    monkeypatch.setattr(uploader, "log_upload_failed", _log_upload_failed)
+    monkeypatch.setattr(uploader, "complete_sequence", _complete_sequence)
+    return archives, completed
+
+
+def _sequences(count):
+    return {
+        f"seq{idx}": [f"/seq{idx}/{i}.jpg" for i in range(3)] for idx in range(count)
+    }
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_upload_sequences(uploads, concurrency):
+    archives, completed = uploads
+    client = _FakeClient()
+    client.fail_offsets.add(20000)
+    upload_async.upload_sequences(
+        _sequences(20), {}, concurrency=concurrency, client=client
+    )
+    assert sorted(completed) == sorted(_sequences(20))
+    assert len(client.finished) == 20
+    for sequence_uuid, archive in archives.items():
+        assert client.sessions[f"mly_tools_{archive.fp.md5sum}"] == _data(sequence_uuid)
+    assert client.max_active == concurrency
+
+
+def test_upload_sequences_failure(uploads):
+    archives, completed = uploads
+    client = _FakeClient()
+    client.fail_sessions.add(f"mly_tools_{hashlib.md5(_data('seq0')).hexdigest()}")
+    with pytest.raises(RuntimeError, match="HTTP 400"):
+        upload_async.upload_sequences(_sequences(10), {}, concurrency=2, client=client)
+    # the upload in progress finishes, the others are skipped
+    assert None in completed
+    assert len(archives) == 2
+    assert len(client.finished) == 1
+
+
+def test_upload_journal_offsets(uploads, monkeypatch):
+    archives, completed = uploads
+    saved = []
+
+    def _save_offset(file_list, session_key, offset):
+        assert threading.current_thread() is not threading.main_thread()
+        saved.append(offset)
+
+    monkeypatch.setattr(upload_journal, "UPLOAD_JOURNAL_ENABLED", True)
+    monkeypatch.setattr(upload_journal, "save_offset", _save_offset)
+    upload_async.upload_sequences(_sequences(1), {}, client=_FakeClient())
+    assert completed == ["seq0"]
+    # written one at a time, ending at the last acknowledged offset
+    assert saved == sorted(saved)
+    assert saved[-1] == archives["seq0"].size
+
+
+def test_upload_httpx(monkeypatch):
+    pytest.importorskip("httpx")
+    from test_upload_api_v4 import _UploadServer
+
+    server = _UploadServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        upload_api_v4_async.upload_api_v4, "MAPILLARY_UPLOAD_ENDPOINT", server.url
+    )
+    try:
+        data = bytes(range(256)) * 1000
+
+        async def _upload():
+            client = upload_api_v4_async.create_client()
+            try:
+                service = upload_api_v4_async.AsyncUploadService(
+                    "token", "key", len(data), client
+                )
+                resp = await service.upload(io.BytesIO(data), chunk_size=10000)
+                return resp.json(), await service.fetch_offset()
+            finally:
+                await client.aclose()
+
+        loop = asyncio.new_event_loop()
+        try:
+            resp, offset = loop.run_until_complete(_upload())
+        finally:
+            loop.close()
+        assert resp["h"] == "key"
+        assert offset == len(data)
+        assert server.assembled("key") == data
+    finally:
+        server.shutdown()
+        server.server_close()
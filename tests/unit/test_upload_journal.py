@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from mapillary_tools import process_state, upload_journal, zip_stream
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def state(request, monkeypatch):
+    if request.param == "files":
+        state = process_state.FileProcessState()
+    else:
+        state = process_state.SQLiteProcessState()
+    monkeypatch.setattr(process_state, "_STATE", state)
+    return state
+
+
+@pytest.fixture
+def file_list(tmpdir):
+    paths = []
+    for idx in range(3):
+        path = tmpdir.join("images", f"{idx}.jpg")
+        path.write_binary(os.urandom(1000 * (idx + 1)), ensure=True)
+        paths.append(str(path))
+    return paths
+
+
+def test_deterministic_archive(tmpdir, file_list):
+    root_dir = str(tmpdir)
+    with zip_stream.build_zip_stream(file_list, root_dir) as stream:
+        md5sum = stream.md5sum
+    for path in file_list:
+        os.utime(path, (1600000000, 1600000000))
+        os.chmod(path, 0o600)
+    with zip_stream.build_zip_stream(file_list, root_dir) as stream:
+        assert stream.md5sum == md5sum
+    with zip_stream.build_zip_file(file_list, root_dir) as first:
+        with zip_stream.build_zip_file(file_list, root_dir) as second:
+            assert first.md5sum == second.md5sum
+
+
+@pytest.mark.parametrize("compression", ["stored", "deflate"])
+def test_load_archive(tmpdir, state, file_list, compression):
+    root_dir = str(tmpdir)
+    assert upload_journal.load_archive(file_list, root_dir, compression) is None
+
+    deflate_path = upload_journal.deflate_path(file_list, "seq")
+    with zip_stream.build_zip(
+        file_list, root_dir, compression=compression, deflate_path=deflate_path
+    ) as stream:
+        data = stream.read()
+        upload_journal.save_journal(file_list, root_dir, "seq", compression, stream)
+    assert os.path.isfile(deflate_path) == (compression == "deflate")
+    upload_journal.save_offset(file_list, f"mly_tools_{stream.md5sum}", 1234)
+
+    with upload_journal.load_archive(file_list, root_dir, compression) as loaded:
+        assert loaded.md5sum == stream.md5sum
+        assert loaded.size == stream.size
+        assert loaded.read() == data
+    assert upload_journal.acknowledged_offset(file_list) == 1234
+    assert upload_journal.load_archive(file_list, root_dir, "auto") is None
+
+    # changed files invalidate the journal
+    os.utime(file_list[1], (1600000000, 1600000000))
+    assert upload_journal.load_archive(file_list, root_dir, compression) is None
+
+    upload_journal.remove_journal(file_list, "seq")
+    assert not state.has_data(file_list[0], upload_journal.JOURNAL_DATA_NAME)
+    assert upload_journal.acknowledged_offset(file_list) == 0
+    assert not os.path.exists(deflate_path)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import shutil
+
+import pytest
+
+from mapillary_tools import process_state, upload, upload_ledger
+
+
+@pytest.fixture
+def ledger(tmpdir, monkeypatch):
+    monkeypatch.setattr(process_state, "_STATE", process_state.FileProcessState())
+    path = str(tmpdir.join("config", "uploads.db"))
+    monkeypatch.setattr(upload_ledger, "UPLOAD_LEDGER_PATH", path)
+    return path
+
+
+def _images(dirpath, count):
+    paths = []
+    for idx in range(count):
+        path = dirpath.join(f"{idx}.jpg")
+        path.write_binary(os.urandom(1000 + idx), ensure=True)
+        os.utime(str(path), (1600000000, 1600000000))
+        paths.append(str(path))
+    return paths
+
+
+def test_content_hash(tmpdir, ledger):
+    (path,) = _images(tmpdir.join("images"), 1)
+    with open(path, "rb") as fp:
+        digest = hashlib.sha256(fp.read()).hexdigest()
+    assert upload_ledger.content_hash(path) == digest
+    state = process_state.get_process_state()
+    assert (
+        state.load_data(path, upload_ledger.CONTENT_HASH_DATA_NAME)["sha256"] == digest
+    )
+    assert upload_ledger.CONTENT_HASH_DATA_NAME in process_state.CACHE_DATA_NAMES
+    assert not state.has_state(path)
+
+    # a changed image is hashed again
+    with open(path, "ab") as fp:
+        fp.write(b"x")
+    os.utime(path, (1600000001, 1600000001))
+    assert upload_ledger.content_hash(path) != digest
+
+
+def test_record_lookup(ledger):
+    assert upload_ledger.lookup("alice", ["a", "b"]) == {}
+    upload_ledger.record("alice", ["a", "b"], "seq1", 123)
+    upload_ledger.record("bob", ["c"], "seq2", None)
+    assert upload_ledger.lookup("alice", ["a", "c", "d"]) == {"a": ("seq1", "123")}
+    assert upload_ledger.lookup("bob", ["a", "c"]) == {"c": ("seq2", None)}
+    assert os.path.isfile(ledger)
+
+
+def test_skip_uploaded(tmpdir, ledger):
+    uploaded = _images(tmpdir.join("first"), 3)
+    upload_ledger.record_sequence(uploaded, "alice", "seq1", 123)
+
+    # an overlapping import: two images copied from the first one, and a new one
+    second = tmpdir.join("second")
+    copies = []
+    for path in uploaded[:2]:
+        copy = str(second.join(os.path.basename(path)))
+        os.makedirs(str(second), exist_ok=True)
+        shutil.copy(path, copy)
+        copies.append(copy)
+    (new,) = _images(tmpdir.join("third"), 1)
+
+    sequences = {"seq2": copies + [new], "seq3": [copies[0]]}
+    params = {path: {"user_name": "alice"} for path in copies + [new]}
+    to_upload, skipped = upload_ledger.skip_uploaded(sequences, params)
+    assert to_upload == {"seq2": [new]}
+    assert sorted(skipped) == sorted(copies + [copies[0]])
+
+    # uploaded by another user
+    params = {path: {"user_name": "bob"} for path in copies + [new]}
+    to_upload, skipped = upload_ledger.skip_uploaded(sequences, params)
+    assert to_upload == sequences
+    assert skipped == []
+
+
+def test_skip_uploaded_images(tmpdir, ledger):
+    uploaded = _images(tmpdir.join("first"), 2)
+    upload_ledger.record_sequence(uploaded, "alice", "seq1", 123)
+    (new,) = _images(tmpdir.join("second"), 1)
+    sequences = {"seq2": uploaded + [new]}
+    params = {path: {"user_name": "alice"} for path in uploaded + [new]}
+    state = process_state.get_process_state()
+
+    # a dry run skips the uploaded images without flagging them
+    to_upload = upload.skip_uploaded_images(sequences, params, dry_run=True)
+    assert to_upload == {"seq2": [new]}
+    assert not any(state.has_flag(path, "upload_success") for path in uploaded)
+    assert not any(state.has_flag(path, "upload_finalized") for path in uploaded)
+
+    to_upload = upload.skip_uploaded_images(sequences, params)
+    assert to_upload == {"seq2": [new]}
+    assert all(state.has_flag(path, "upload_success") for path in uploaded)
+    assert all(state.has_flag(path, "upload_finalized") for path in uploaded)
+    assert not state.has_flag(new, "upload_success")
+
+
+def test_skip_uploaded_images_unreadable_ledger(tmpdir, ledger):
+    # not a SQLite database
+    os.makedirs(os.path.dirname(ledger))
+    with open(ledger, "wb") as fp:
+        fp.write(b"x" * 4096)
+    paths = _images(tmpdir.join("images"), 2)
+    sequences = {"seq1": paths}
+    params = {path: {"user_name": "alice"} for path in paths}
+    assert upload.skip_uploaded_images(sequences, params) == sequences
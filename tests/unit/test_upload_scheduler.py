@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from mapillary_tools import upload_scheduler, uploader
+
+
+class _FakeStream:
+    def __init__(self, size):
+        self.size = size
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+
+class _FakeUploads:
+    def __init__(self, fail=None, delay=0.02):
+        self.fail = fail
+        self.delay = delay
+        self.archives = []
+        self.uploaded = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def prepare(self, file_list, sequence_uuid, file_params, metadata=None, **kwargs):
+        archive = uploader.SequenceArchive(
+            sequence_uuid,
+            file_list,
+            "/",
+            {},
+            "token",
+            _FakeStream(len(file_list) * 100),
+            metadata,
+        )
+        for path in file_list:
+            kwargs["on_file"](path)
+        self.archives.append(archive)
+        return archive
+
+    def upload(self, archive, on_progress=None, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if archive.sequence_uuid == self.fail:
+                raise RuntimeError(f"failed {archive.sequence_uuid}")
+            on_progress(archive.size)
+            self.uploaded.append(archive.sequence_uuid)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    fake = _FakeUploads()
+    monkeypatch.setattr(uploader, "prepare_sequence_v4", fake.prepare)
+    monkeypatch.setattr(uploader, "upload_sequence_archive_v4", fake.upload)
+    return fake
+
+
+def _sequences(count):
+    return {
+        f"seq{idx}": [f"/seq{idx}/{i}.jpg" for i in range(3)] for idx in range(count)
+    }
+
+
+@pytest.mark.parametrize("number_threads", [1, 3])
+def test_upload_sequences(uploads, number_threads):
+    upload_scheduler.upload_sequences(_sequences(10), {}, number_threads=number_threads)
+    assert sorted(uploads.uploaded) == sorted(_sequences(10))
+    assert uploads.max_active <= number_threads
+    if number_threads == 1:
+        assert uploads.uploaded == list(_sequences(10))
+    assert [archive.metadata["sequence_idx"] for archive in uploads.archives] == list(
+        range(10)
+    )
+    assert all(archive.fp.closed for archive in uploads.archives)
+
+
+def test_upload_sequences_failure(uploads):
+    uploads.fail = "seq1"
+    with pytest.raises(RuntimeError, match="failed seq1"):
+        upload_scheduler.upload_sequences(_sequences(10), {}, number_threads=1)
+    assert uploads.uploaded == ["seq0"]
+    # no more than the archive waiting for a worker and the one being archived
+    assert len(uploads.archives) <= 4
+    assert all(archive.fp.closed for archive in uploads.archives)
+
+
+def test_concurrency_probe(monkeypatch):
+    monkeypatch.setattr(upload_scheduler, "PROBE_MIN_SECONDS", 0)
+    clock = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+
+    probe = upload_scheduler.ConcurrencyProbe(max_concurrency=4)
+    assert probe.limit == 1
+    for throughput in [100, 200, 210]:
+        probe.acquire()
+        clock[0] += 1
+        probe.add_bytes(throughput)
+        probe.release()
+    # 200 improves on 100, 210 does not improve enough on 200
+    assert probe.limit == 3
+    assert not probe.probing
+
+    probe = upload_scheduler.ConcurrencyProbe(fixed=2)
+    assert probe.limit == 2 and not probe.probing
+    with pytest.raises(ValueError):
+        upload_scheduler.ConcurrencyProbe(fixed=0)
@@ -0,0 +1,61 @@
+import functools
+import os
+import shutil
+
+import pytest
+
+from mapillary_tools import exif_cache, process_state, processing, utils
+
+EXIF_FILE = os.path.join(os.path.dirname(__file__), "data", "test_exif.jpg")
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def state(request, monkeypatch):
+    if request.param == "files":
+        state = process_state.FileProcessState()
+    else:
+        state = process_state.SQLiteProcessState()
+    monkeypatch.setattr(process_state, "_STATE", state)
+    return state
+
+
+def test_map_with_workers_order():
+    items = list(range(50))
+    for worker_type in ["thread", "process"]:
+        assert (
+            utils.map_with_workers(
+                abs, [-i for i in items], workers=4, worker_type=worker_type
+            )
+            == items
+        )
+    with pytest.raises(ValueError):
+        utils.map_with_workers(abs, items, workers=4, worker_type="fiber")
+
+
+def test_map_with_threads_over_images(tmpdir, state):
+    images = []
+    for idx in range(20):
+        image = str(tmpdir.join(f"{idx}.jpg"))
+        shutil.copy(EXIF_FILE, image)
+        # files modified just now are not cached
+        os.utime(image, (1600000000, 1600000000))
+        images.append(image)
+
+    func = functools.partial(processing.get_geotag_properties_from_exif, verbose=False)
+    expected = [func(image) for image in images]
+    assert all(properties is not None for properties in expected)
+    # drop the cache entries of the serial run, to write them from the threads
+    for image in images:
+        state.remove_data(image, exif_cache.EXIF_CACHE_DATA_NAME)
+
+    results = utils.map_with_workers(func, images, workers=8, worker_type="thread")
+    assert results == expected
+
+    capture_time = exif_cache.read_exif(images[0]).extract_capture_time()
+    for image in images:
+        entry = state.load_data(image, exif_cache.EXIF_CACHE_DATA_NAME)
+        assert entry["version"] == exif_cache.EXIF_CACHE_VERSION
+        assert entry["size"] == os.path.getsize(image)
+        assert isinstance(exif_cache.read_exif(image), exif_cache.CachedExifRead)
+        assert exif_cache.read_exif(image).extract_capture_time() == capture_time
+        assert not state.has_state(image)
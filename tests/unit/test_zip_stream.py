@@ -0,0 +1,86 @@
+import hashlib
+import io
+import os
+import zipfile
+
+import pytest
+
+from mapillary_tools import zip_stream
+
+
+@pytest.fixture
+def file_list(tmpdir):
+    paths = []
+    for idx, size in enumerate([0, 1, 1000, 3 * zip_stream.READ_BUFFER_SIZE + 7]):
+        path = tmpdir.join("images", f"{idx}.jpg")
+        path.write_binary(os.urandom(size), ensure=True)
+        paths.append(str(path))
+    return paths
+
+
+def test_build_zip_stream(tmpdir, file_list):
+    stream = zip_stream.build_zip_stream(file_list, str(tmpdir))
+    data = stream.read()
+
+    assert len(data) == stream.size
+    assert hashlib.md5(data).hexdigest() == stream.md5sum
+    with zipfile.ZipFile(io.BytesIO(data)) as ziph:
+        assert ziph.testzip() is None
+        for path in file_list:
+            info = ziph.getinfo(os.path.relpath(path, str(tmpdir)))
+            assert info.compress_type == zipfile.ZIP_STORED
+            with open(path, "rb") as fp:
+                assert ziph.read(info) == fp.read()
+
+
+def test_read_chunks(tmpdir, file_list):
+    stream = zip_stream.build_zip_stream(file_list, str(tmpdir))
+    data = stream.read()
+
+    stream.seek(0)
+    chunks = []
+    while True:
+        chunk = stream.read(1234)
+        if not chunk:
+            break
+        assert len(chunk) == 1234 or stream.tell() == stream.size
+        chunks.append(chunk)
+    assert b"".join(chunks) == data
+
+    stream.seek(100)
+    stream.seek(50, io.SEEK_CUR)
+    assert stream.read(5000) == data[150:5150]
+    stream.seek(-10, io.SEEK_END)
+    assert stream.read() == data[-10:]
+
+
+def test_file_changed(tmpdir, file_list):
+    stream = zip_stream.build_zip_stream(file_list, str(tmpdir))
+    with open(file_list[-1], "wb") as fp:
+        fp.write(b"short")
+    with pytest.raises(RuntimeError):
+        stream.read()
+
+
+def test_build_zip_compression(tmpdir, file_list):
+    text = tmpdir.join("images", "notes.txt")
+    text.write_binary(b"mapillary " * 10000)
+    text = str(text)
+
+    assert zip_stream.resolve_compression("stored", [text]) == zipfile.ZIP_STORED
+    assert zip_stream.resolve_compression("auto", [text]) == zipfile.ZIP_DEFLATED
+    assert zip_stream.resolve_compression("auto", file_list) == zipfile.ZIP_STORED
+    with pytest.raises(ValueError):
+        zip_stream.resolve_compression("lzma", file_list)
+
+    with zip_stream.build_zip(file_list + [text], str(tmpdir), "deflate") as stream:
+        temporary_path = stream.temporary_path
+        data = stream.read()
+        assert len(data) == stream.size
+        assert hashlib.md5(data).hexdigest() == stream.md5sum
+        with zipfile.ZipFile(io.BytesIO(data)) as ziph:
+            assert ziph.testzip() is None
+            info = ziph.getinfo(os.path.relpath(text, str(tmpdir)))
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.compress_size < info.file_size
+    assert not os.path.exists(temporary_path)